@@ -0,0 +1,218 @@
+"""
+Бенчмарк очистки markdown: однопроходный strip_markdown против прежней реализации (12 вызовов re.sub)
+
+Корпус - синтетические ответы психолога размером с типичный ответ GigaChat (~2000 токенов):
+абзацы текста, заголовки, списки, жирный/курсив, ссылки, изредка строчный код и блоки кода.
+Замеряется очистка готового ответа и потоковая очистка (IncrementalMarkdownCleaner по фрагментам).
+
+Результат отличается от прежнего в трех местах, все - исправления: блоки кода удаляются целиком
+(раньше строчный код обрабатывался первым и оставлял от блока "``"), пустая строка перед
+списком сохраняется (раньше маркер списка удалялся вместе с предшествующими переносами строк),
+а пробелы вокруг разрыва абзацев убираются, как при потоковой очистке (иначе текст, показанный
+пользователю по ходу генерации, расходился с сохраненным в историю).
+Поэтому результат сверяется с эталоном - прежней реализацией с этими исправлениями: и для
+ответа целиком, и для потоковой очистки. Любое расхождение - ошибка, скрипт завершается с кодом 1.
+
+Запуск: python benchmarks/bench_clean_markdown.py [--responses 50] [--repeat 5]
+"""
+
+import argparse
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Импорт бота создает файлы хранилищ в текущем каталоге - уводим их во временный
+os.chdir(tempfile.mkdtemp(prefix="bench_markdown_"))
+import telegram_bot  # noqa: E402
+
+
+def legacy_clean_markdown(text: str) -> str:
+    """Прежняя реализация PsychologistAssistant.clean_markdown"""
+    if not text:
+        return text
+    text = re.sub(r'^#{1,6}\s+', '', text, flags=re.MULTILINE)
+    text = re.sub(r'\*\*([^*]+)\*\*', r'\1', text)
+    text = re.sub(r'__([^_]+)__', r'\1', text)
+    text = re.sub(r'(?<!\*)\*([^*]+)\*(?!\*)', r'\1', text)
+    text = re.sub(r'(?<!_)_([^_]+)_(?!_)', r'\1', text)
+    text = re.sub(r'~~([^~]+)~~', r'\1', text)
+    text = re.sub(r'`([^`]+)`', r'\1', text)
+    text = re.sub(r'```[\s\S]*?```', '', text)
+    text = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', text)
+    text = re.sub(r'^[\s]*[-*+]\s+', '', text, flags=re.MULTILINE)
+    text = re.sub(r'^[\s]*\d+\.\s+', '', text, flags=re.MULTILINE)
+    text = re.sub(r'\n{3,}', '\n\n', text)
+    return text.strip()
+
+
+def reference_clean_markdown(text: str) -> str:
+    """Эталон поведения: прежняя реализация с исправлениями из описания модуля"""
+    if not text:
+        return text
+    text = re.sub(r'```[\s\S]*?```', '', text)
+    text = re.sub(r'^#{1,6}\s+', '', text, flags=re.MULTILINE)
+    text = re.sub(r'\*\*([^*]+)\*\*', r'\1', text)
+    text = re.sub(r'__([^_]+)__', r'\1', text)
+    text = re.sub(r'(?<!\*)\*([^*]+)\*(?!\*)', r'\1', text)
+    text = re.sub(r'(?<!_)_([^_]+)_(?!_)', r'\1', text)
+    text = re.sub(r'~~([^~]+)~~', r'\1', text)
+    text = re.sub(r'`([^`]+)`', r'\1', text)
+    text = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', text)
+    text = re.sub(r'^[ \t]*[-*+][ \t]+', '', text, flags=re.MULTILINE)
+    text = re.sub(r'^[ \t]*\d+\.[ \t]+', '', text, flags=re.MULTILINE)
+    text = re.sub(r'[ \t]*\n{2,}[ \t]*', '\n\n', text)
+    return text.strip()
+
+
+# Крайние случаи сверх корпуса: блок кода между абзацами и внутри списка, пустые строки в блоке кода
+EDGE_CASES = [
+    "Первый **абзац**.\n\n```\ncode\n\nmore\n```\n\n- пункт",
+    "Используй `паузу` перед ответом.\n```\nвдох `4` выдох\n```\nГотово.",
+    "1. шаг\n\n\n\n```\nблок\n```\n\n\n2. шаг",
+    "# Заголовок\n\n\n\n\n*текст*",
+]
+
+
+SENTENCES = [
+    "Я слышу, как тебе сейчас непросто, и это нормально - чувствовать растерянность.",
+    "Давай попробуем разобраться, что именно вызывает у тебя такую тревогу.",
+    "Часто за раздражением скрывается усталость или невысказанная обида.",
+    "Обрати внимание на то, что происходит в теле, когда ты об этом думаешь.",
+    "Ты не обязан справляться со всем в одиночку.",
+    "Такие мысли появляются у многих людей в похожей ситуации.",
+    "Попробуй вспомнить, когда ты в последний раз отдыхал по-настоящему.",
+    "Это важный шаг - признать, что тебе нужна поддержка.",
+    "Как ты думаешь, что помогло бы тебе почувствовать себя спокойнее?",
+    "Иногда полезно записать свои мысли, чтобы увидеть их со стороны.",
+]
+
+EMPHASIS = [
+    lambda words: f"**{words}**",
+    lambda words: f"*{words}*",
+    lambda words: f"__{words}__",
+    lambda words: f"[{words}](https://example.com/help)",
+    lambda words: f"`{words}`",
+]
+
+
+def make_sentence(rng: random.Random) -> str:
+    """Предложение, в котором иногда выделено несколько слов"""
+    sentence = rng.choice(SENTENCES)
+    if rng.random() < 0.4:
+        words = sentence.split()
+        start = rng.randrange(len(words) - 2)
+        span = " ".join(words[start:start + 2])
+        words[start:start + 2] = [rng.choice(EMPHASIS)(span)]
+        sentence = " ".join(words)
+    return sentence
+
+
+def make_response(rng: random.Random, target_chars: int = 6000) -> str:
+    """Ответ ассистента с типичной для GigaChat разметкой"""
+    blocks = []
+    size = 0
+    while size < target_chars:
+        kind = rng.random()
+        if kind < 0.15:
+            block = f"{'#' * rng.randint(1, 3)} {rng.choice(SENTENCES)[:40]}"
+        elif kind < 0.35:
+            block = "\n".join(f"- {make_sentence(rng)}" for _ in range(rng.randint(2, 5)))
+        elif kind < 0.5:
+            block = "\n".join(f"{i}. {make_sentence(rng)}" for i in range(1, rng.randint(3, 6)))
+        elif kind < 0.53:
+            block = "```\nдыхание: вдох 4 - задержка 4 - выдох 4\n```"
+        else:
+            block = " ".join(make_sentence(rng) for _ in range(rng.randint(2, 5)))
+        blocks.append(block)
+        size += len(block) + 2
+    return "\n\n".join(blocks)
+
+
+def chunks(text: str, rng: random.Random) -> list:
+    """Нарезка ответа на фрагменты, как в потоке SSE (несколько слов за раз)"""
+    parts = []
+    position = 0
+    while position < len(text):
+        step = rng.randint(8, 40)
+        parts.append(text[position:position + step])
+        position += step
+    return parts
+
+
+def bench(func, corpus, repeat: int) -> float:
+    """Медиана времени обработки всего корпуса (сек)"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for item in corpus:
+            func(item)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+def stream(clean):
+    def run(parts):
+        cleaner = telegram_bot.IncrementalMarkdownCleaner(clean)
+        for part in parts:
+            cleaner.feed(part)
+        return cleaner.text()
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк очистки markdown")
+    parser.add_argument("--responses", type=int, default=50, help="размер корпуса (ответов)")
+    parser.add_argument("--repeat", type=int, default=5, help="число повторов замера")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    corpus = [make_response(rng) for _ in range(args.responses)]
+    streamed = [chunks(text, rng) for text in corpus]
+    total_chars = sum(len(text) for text in corpus)
+    print(f"Корпус: {len(corpus)} ответов, в среднем {total_chars // len(corpus)} символов")
+
+    # Исправленный случай: строчный код больше не ломает удаление блока кода после него
+    sample = "Используй `паузу` перед ответом.\n```\nвдох `4` выдох\n```\nГотово."
+    print(f"Прежняя реализация: {legacy_clean_markdown(sample)!r}")
+    print(f"strip_markdown:     {telegram_bot.strip_markdown(sample)!r}")
+
+    differences = sum(legacy_clean_markdown(text) != telegram_bot.strip_markdown(text) for text in corpus)
+    print(f"Ответов, очищенных иначе, чем прежде (исправления выше): {differences} из {len(corpus)}")
+
+    mismatches = []
+    for text in corpus + EDGE_CASES:
+        expected = reference_clean_markdown(text)
+        if telegram_bot.strip_markdown(text) != expected:
+            mismatches.append(("strip_markdown", text))
+        if stream(telegram_bot.strip_markdown)(chunks(text, rng)) != expected:
+            mismatches.append(("поток", text))
+    for where, text in mismatches[:5]:
+        print(f"✗ {where}: {text[:80]!r}")
+        print(f"  эталон:    {reference_clean_markdown(text)[:80]!r}")
+        print(f"  результат: {telegram_bot.strip_markdown(text)[:80]!r}")
+    if mismatches:
+        print(f"⚠ Расхождений с эталоном: {len(mismatches)}")
+        sys.exit(1)
+    print(f"✓ Совпадает с эталоном: {len(corpus) + len(EDGE_CASES)} ответов целиком и потоком")
+
+    rows = [
+        ("ответ целиком", legacy_clean_markdown, telegram_bot.strip_markdown, corpus),
+        ("поток фрагментов", stream(legacy_clean_markdown), stream(telegram_bot.strip_markdown), streamed),
+    ]
+    print(f"{'сценарий':<20}{'прежняя, мс':>14}{'новая, мс':>12}{'ускорение':>12}")
+    for name, legacy, current, items in rows:
+        legacy_time = bench(legacy, items, args.repeat) / len(items) * 1000
+        current_time = bench(current, items, args.repeat) / len(items) * 1000
+        print(f"{name:<20}{legacy_time:>14.3f}{current_time:>12.3f}{legacy_time / current_time:>11.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Замер задержки GigaChat с заголовком X-Session-ID и без него на локальном заменителе
+
+Заменитель (tools/local_stubs.py, GigaChatStub) считает задержку по символам запроса, которых нет
+в кэше разговора, поэтому абсолютные числа зависят от --prefill-per-char и показывают порядок
+выигрыша, а не задержку настоящего GigaChat. Сам бот при этом работает как в бою:
+PsychologistAssistant, ConversationHistory и AsyncGigaChatClient с пулом соединений.
+
+Запуск: python benchmarks/bench_gigachat_session_cache.py [--users 20] [--turns 8]
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+
+# Импорт бота создает файлы хранилищ в текущем каталоге - уводим их во временный
+os.chdir(tempfile.mkdtemp(prefix="bench_session_cache_"))
+import telegram_bot  # noqa: E402
+from local_stubs import GigaChatStub  # noqa: E402
+
+USER_MESSAGES = [
+    "Привет, мне в последнее время очень тревожно",
+    "На работе постоянные конфликты с начальником",
+    "Я плохо сплю и просыпаюсь по ночам",
+    "Иногда кажется, что я ни с чем не справляюсь",
+    "Муж говорит, что я стала раздражительной",
+    "Раньше я любила рисовать, а сейчас ничего не хочется",
+    "Что мне с этим делать?",
+    "Спасибо, попробую",
+]
+
+
+async def run_conversations(stub: GigaChatStub, session_header: str, users: int, turns: int) -> list:
+    """Диалоги users пользователей по turns реплик, возвращает задержки запросов (сек)"""
+    assistant = telegram_bot.PsychologistAssistant("stub", telegram_bot.SessionSpillStorage("sessions.db"))
+    assistant.gigachat = telegram_bot.AsyncGigaChatClient(
+        "stub", auth_url=stub.auth_url, chat_url=stub.chat_url, session_header=session_header
+    )
+    latencies = []
+
+    async def conversation(user_id: str):
+        for turn in range(turns):
+            started = time.perf_counter()
+            await assistant.chat(user_id, USER_MESSAGES[turn % len(USER_MESSAGES)])
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(conversation(f"{header_tag(session_header)}-{i}") for i in range(users)))
+    await assistant.close()
+    return latencies
+
+
+def header_tag(session_header: str) -> str:
+    return "cached" if session_header else "plain"
+
+
+def percentile(values: list, share: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замер задержки GigaChat с X-Session-ID и без него")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.05, help="базовая задержка заменителя (сек)")
+    parser.add_argument("--prefill-per-char", type=float, default=0.00002,
+                        help="задержка заменителя на символ вне кэша (сек)")
+    args = parser.parse_args()
+
+    print(f"{'режим':<22}{'запросов':>10}{'среднее, мс':>13}{'p50, мс':>10}{'p95, мс':>10}{'из кэша':>10}")
+    for session_header in ("", telegram_bot.GIGACHAT_SESSION_HEADER or "X-Session-ID"):
+        stub = GigaChatStub(port=0, base_latency=args.latency, prefill_per_char=args.prefill_per_char,
+                            session_header=session_header or "X-Session-ID").start()
+        try:
+            latencies = asyncio.run(run_conversations(stub, session_header, args.users, args.turns))
+        finally:
+            stub.stop()
+        cached_share = stub.stats["cached_chars"] / max(1, stub.stats["prompt_chars"])
+        name = f"с {session_header}" if session_header else "без заголовка"
+        print(f"{name:<22}{len(latencies):>10}{statistics.mean(latencies) * 1000:>13.1f}"
+              f"{percentile(latencies, 0.5) * 1000:>10.1f}{percentile(latencies, 0.95) * 1000:>10.1f}"
+              f"{cached_share:>9.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""
+Набор микробенчмарков горячих функций бота с сохраненными базовыми значениями
+
+Замеры: очистка markdown (PsychologistAssistant.clean_markdown), классификация сообщений
+(USER_INTENTS.classify - ветвление по ключевым словам в PsychologistAssistant.chat), подписи и ссылка
+на оплату RobokassaPayment, PaymentSystem.has_active_session и PaymentSystem.save_payments
+(SQLite и JSON) на 1 тыс., 100 тыс. и 1 млн платежей.
+
+Каждый замер - медиана --repeat прогонов, прогон длится не меньше --min-time секунд; результат -
+время одной операции. Сравнение идет с benchmarks/baselines.json: замер медленнее базового больше
+чем на --threshold (по умолчанию 25%) считается регрессией, и скрипт завершается с кодом 1.
+Базовые значения зависят от машины - после изменения железа или осознанного ускорения
+их нужно перезаписать: --save-baseline.
+
+Запуск: python benchmarks/bench_hot_paths.py [--scales 1000,100000,1000000] [--filter save_payments]
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+BASELINES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+CORPUS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "intent_corpus.json")
+
+# Импорт бота создает файлы хранилищ в текущем каталоге - уводим их во временный
+WORKDIR = tempfile.mkdtemp(prefix="bench_hot_paths_")
+os.chdir(WORKDIR)
+import telegram_bot  # noqa: E402
+from bench_clean_markdown import make_response  # noqa: E402
+from bench_intent_matcher import STORY  # noqa: E402
+
+# Замер: имя -> (подготовка, возвращающая функцию без аргументов; число операций за один вызов функции)
+Case = Callable[[], Tuple[Callable[[], None], int]]
+
+
+def clean_markdown_case() -> Tuple[Callable[[], None], int]:
+    rng = random.Random(1)
+    corpus = [make_response(rng) for _ in range(20)]
+    clean = telegram_bot.PsychologistAssistant.clean_markdown
+
+    def run():
+        for text in corpus:
+            clean(None, text)
+    return run, len(corpus)
+
+
+def intents_case(long: bool) -> Case:
+    def setup():
+        with open(CORPUS_FILE, "r", encoding="utf-8") as f:
+            messages = [case["text"] for case in json.load(f)]
+        if long:
+            messages = [STORY * 2 + message for message in messages]
+        classify = telegram_bot.USER_INTENTS.classify
+
+        def run():
+            for message in messages:
+                classify(message)
+        return run, len(messages)
+    return setup
+
+
+def robokassa() -> telegram_bot.RobokassaPayment:
+    return telegram_bot.RobokassaPayment("Psychologistonline", "bench-password-1", "bench-password-2", "0")
+
+
+def signature_case() -> Tuple[Callable[[], None], int]:
+    payment = robokassa()
+    return lambda: payment.generate_signature("2999.00", 1792332464655), 1
+
+
+def verify_signature_case() -> Tuple[Callable[[], None], int]:
+    payment = robokassa()
+    signature = telegram_bot.hashlib.md5(b"2999.00:1792332464655:bench-password-2").hexdigest()
+    return lambda: payment.verify_signature("2999.00", 1792332464655, signature), 1
+
+
+def payment_url_case() -> Tuple[Callable[[], None], int]:
+    payment = robokassa()
+    return lambda: payment.generate_payment_url(
+        2999, 1792332464655, "1 час консультации", telegram_bot.ROBOKASSA_RESULT_URL,
+        telegram_bot.ROBOKASSA_SUCCESS_URL, telegram_bot.ROBOKASSA_FAIL_URL
+    ), 1
+
+
+def make_payments(count: int) -> Dict[str, List[Dict]]:
+    """
+    count платежей по ~count/2 пользователям
+    Записи платежей повторяются (общие объекты), чтобы 1 млн платежей не занимал гигабайты памяти;
+    хранилищу это безразлично - каждая запись сериализуется отдельно
+    """
+    now = datetime.now()
+    templates = [
+        {"date": (now - timedelta(hours=i)).isoformat(), "amount": 2999.0, "method": "robokassa",
+         "duration_seconds": 3600}
+        for i in range(1000)
+    ]
+    payments: Dict[str, List[Dict]] = {}
+    for i in range(count):
+        payments.setdefault(str(10_000_000 + i // 2), []).append(templates[i % len(templates)])
+    return payments
+
+
+def payment_system(storage: telegram_bot.PaymentStorage, count: int) -> telegram_bot.PaymentSystem:
+    system = telegram_bot.PaymentSystem(storage)
+    system.payments = make_payments(count)
+    system._rebuild_active_index()
+    return system
+
+
+def has_active_session_case(count: int) -> Case:
+    def setup():
+        storage = telegram_bot.SqlitePaymentStorage(os.path.join(WORKDIR, f"active_{count}.db"))
+        system = payment_system(storage, count)
+        # Половина проверок - пользователи с платежами, половина - без
+        users = [str(10_000_000 + i) for i in random.Random(1).sample(range(count), 1000)]
+
+        def run():
+            for user_id in users:
+                system.has_active_session(user_id)
+        return run, len(users)
+    return setup
+
+
+def save_payments_case(backend: str, count: int) -> Case:
+    def setup():
+        if backend == "sqlite":
+            storage = telegram_bot.SqlitePaymentStorage(os.path.join(WORKDIR, f"save_{count}.db"))
+        else:
+            prefix = os.path.join(WORKDIR, f"save_{count}")
+            storage = telegram_bot.JsonPaymentStorage(
+                f"{prefix}_payments.json", f"{prefix}_pending.json", f"{prefix}_paid.json", f"{prefix}_expired.jsonl"
+            )
+        system = payment_system(storage, count)
+        return system.save_payments, 1
+    return setup
+
+
+def cases(scales: List[int]) -> Dict[str, Case]:
+    result: Dict[str, Case] = {
+        "clean_markdown": clean_markdown_case,
+        "intents_short": intents_case(long=False),
+        "intents_long": intents_case(long=True),
+        "robokassa_generate_signature": signature_case,
+        "robokassa_verify_signature": verify_signature_case,
+        "robokassa_payment_url": payment_url_case,
+    }
+    for count in scales:
+        result[f"has_active_session_{count}"] = has_active_session_case(count)
+    for count in scales:
+        for backend in ("sqlite", "json"):
+            result[f"save_payments_{backend}_{count}"] = save_payments_case(backend, count)
+    return result
+
+
+def measure(case: Case, repeat: int, min_time: float) -> float:
+    """Медиана времени одной операции (сек)"""
+    run, operations = case()
+    # Подбор числа вызовов на прогон, как в timeit.autorange
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            run()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+    timings = [elapsed]
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(number):
+            run()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) / number / operations
+
+
+def format_time(seconds: float) -> str:
+    for unit, scale in (("с", 1), ("мс", 1e-3), ("мкс", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f} {unit}"
+    return f"{seconds / 1e-9:.0f} нс"
+
+
+def load_baselines() -> Dict:
+    if not os.path.exists(BASELINES_FILE):
+        return {"results": {}}
+    with open(BASELINES_FILE, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_baselines(results: Dict[str, float]):
+    baselines = load_baselines()
+    baselines["machine"] = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "saved_at": datetime.now().isoformat(timespec="seconds"),
+    }
+    baselines.setdefault("results", {}).update(results)
+    baselines["results"] = dict(sorted(baselines["results"].items()))
+    with open(BASELINES_FILE, "w", encoding="utf-8") as f:
+        json.dump(baselines, f, ensure_ascii=False, indent=2)
+        f.write("\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарки горячих функций бота")
+    parser.add_argument("--scales", default="1000,100000,1000000", help="число платежей через запятую")
+    parser.add_argument("--filter", default="", help="только замеры, в имени которых есть эта строка")
+    parser.add_argument("--repeat", type=int, default=5, help="число прогонов замера")
+    parser.add_argument("--min-time", type=float, default=0.2, help="минимальная длительность прогона (сек)")
+    parser.add_argument("--threshold", type=float, default=0.25, help="допустимое замедление (доля)")
+    parser.add_argument("--save-baseline", action="store_true", help="записать результаты как базовые")
+    args = parser.parse_args()
+
+    scales = [int(scale) for scale in args.scales.split(",") if scale]
+    baselines = load_baselines()["results"]
+    results: Dict[str, float] = {}
+    regressions = 0
+    print(f"{'замер':<36}{'на операцию':>14}{'базовое':>14}{'отношение':>11}")
+    for name, case in cases(scales).items():
+        if args.filter not in name:
+            continue
+        # Замеры сохранения на больших объемах идут минутами - для них достаточно трех прогонов
+        repeat = min(args.repeat, 3) if name.startswith("save_payments") else args.repeat
+        seconds = measure(case, repeat, args.min_time)
+        results[name] = seconds
+        baseline: Optional[float] = baselines.get(name)
+        if baseline is None:
+            print(f"{name:<36}{format_time(seconds):>14}{'-':>14}{'-':>11}")
+            continue
+        ratio = seconds / baseline
+        status = ""
+        if ratio > 1 + args.threshold:
+            regressions += 1
+            status = "  РЕГРЕССИЯ"
+        print(f"{name:<36}{format_time(seconds):>14}{format_time(baseline):>14}{ratio:>10.2f}x{status}")
+
+    if args.save_baseline:
+        save_baselines(results)
+        print(f"✓ Базовые значения записаны: {BASELINES_FILE}")
+    elif regressions:
+        print(f"⚠ Регрессий: {regressions} (порог {args.threshold:.0%})")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Проверка и бенчмарк классификации сообщений (USER_INTENTS) против прежних подстрочных проверок
+
+Сначала прогоняется корпус intent_corpus.json (сообщение - ожидаемая категория): при ошибках
+скрипт завершается с кодом 1. Затем замеряется время классификации отдельно для коротких реплик
+из корпуса и для длинных рассказов о ситуации.
+
+Запуск: python benchmarks/bench_intent_matcher.py [--messages 2000] [--repeat 5]
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+CORPUS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "intent_corpus.json")
+
+# Импорт бота создает файлы хранилищ в текущем каталоге - уводим их во временный
+os.chdir(tempfile.mkdtemp(prefix="bench_intents_"))
+import telegram_bot  # noqa: E402
+
+LEGACY_KEYWORDS = [
+    ("bot", ['бот', 'нейросеть', 'нейросети', 'ии', 'искусственный интеллект',
+             'chatgpt', 'gpt', 'робот', 'автомат', 'программа']),
+    ("price", ['дорого', 'дороговато', 'не могу', 'нет денег', 'не хватает',
+               'слишком дорого', 'много стоит', 'не по карману', 'не потяну']),
+    ("delay", ['подумаю', 'позже', 'не сейчас', 'может быть', 'посмотрю',
+               'решу потом', 'не уверен', 'сомневаюсь']),
+]
+
+
+def legacy_classify(text: str):
+    """Прежняя логика PsychologistAssistant.chat: lower() и any(word in text) по спискам"""
+    lower = text.lower()
+    for name, keywords in LEGACY_KEYWORDS:
+        if any(word in lower for word in keywords):
+            return name
+    return None
+
+
+STORY = (
+    "Последние несколько месяцев я почти не сплю, на работе постоянные конфликты с руководителем, "
+    "дома тоже напряжение, муж говорит, что я стала раздражительной. Я стараюсь держаться, "
+    "но вечером просто сижу и смотрю в одну точку. Раньше я любила рисовать и встречаться с подругами, "
+    "а сейчас ничего не хочется. "
+)
+
+
+def check_corpus(corpus) -> int:
+    """Проверка корпуса, возвращает число ошибок"""
+    errors = 0
+    legacy_errors = 0
+    for case in corpus:
+        actual = telegram_bot.USER_INTENTS.classify(case["text"])
+        if actual != case["intent"]:
+            errors += 1
+            print(f"  ОШИБКА: {case['text']!r}: ожидалось {case['intent']}, получено {actual}")
+        if legacy_classify(case["text"]) != case["intent"]:
+            legacy_errors += 1
+    print(f"Корпус: {len(corpus)} сообщений, ошибок: {errors} (прежняя логика ошибается в {legacy_errors})")
+    return errors
+
+
+def bench(func, messages, repeat: int) -> float:
+    """Медиана времени классификации всех сообщений (сек)"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for message in messages:
+            func(message)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Проверка и бенчмарк классификации сообщений")
+    parser.add_argument("--messages", type=int, default=2000, help="число сообщений в замере")
+    parser.add_argument("--repeat", type=int, default=5, help="число повторов замера")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    with open(CORPUS_FILE, "r", encoding="utf-8") as f:
+        corpus = json.load(f)
+    if check_corpus(corpus):
+        sys.exit(1)
+
+    rng = random.Random(args.seed)
+    short = [case["text"] for case in corpus]
+    groups = [
+        ("короткие реплики", [rng.choice(short) for _ in range(args.messages)]),
+        ("длинные рассказы", [STORY * rng.randint(1, 4) + rng.choice(short) for _ in range(args.messages)]),
+    ]
+    # Прежняя логика останавливается на первой подстроке, в том числе ложной ("бот" в "работе"),
+    # поэтому на длинных текстах она проверяет меньше слов, чем нужно для верного ответа
+    print(f"{'сообщения':<20}{'символов':>10}{'прежняя, мкс':>15}{'новая, мкс':>13}{'ускорение':>12}")
+    for name, messages in groups:
+        average = sum(len(message) for message in messages) // len(messages)
+        legacy_time = bench(legacy_classify, messages, args.repeat) / len(messages) * 1e6
+        current_time = bench(telegram_bot.USER_INTENTS.classify, messages, args.repeat) / len(messages) * 1e6
+        print(f"{name:<20}{average:>10}{legacy_time:>15.2f}{current_time:>13.2f}{legacy_time / current_time:>11.2f}x")
+
+
+if __name__ == "__main__":
+    main()
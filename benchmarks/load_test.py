@@ -0,0 +1,287 @@
+"""
+Нагрузочный прогон бота целиком: telegram_bot.py в отдельном процессе против локальных заменителей
+
+Запускаются заменители Telegram Bot API и GigaChat (tools/local_stubs.py) и сам бот, настроенный
+на них через переменные окружения. Каждый смоделированный пользователь отправляет /start и несколько
+сообщений (ждет ответа и делает паузу "на раздумье"), часть пользователей выбирает тариф и "оплачивает"
+счет: RobokassaStub отправляет подписанное уведомление на ResultURL бота.
+
+Отчет: обновлений в секунду, задержка ответа на сообщение (p50/p95/p99, от постановки обновления
+до первого sendMessage в чат), время ответа ResultURL и задержка подтверждения оплаты
+(от уведомления Robokassa до сообщения "Спасибо за доверие" в чате).
+
+Задержка ответа включает намеренную паузу "печатает" бота (1,5-6 с) - в потоковом режиме
+(--streaming) ее нет. Исходящие сообщения бот ограничивает лимитами Telegram (OUTBOUND_GLOBAL_RATE),
+при тысячах пользователей это потолок пропускной способности; чтобы измерить сам бот,
+поднимите лимит: --env OUTBOUND_GLOBAL_RATE=1000. Заменитель GigaChat работает по HTTP/1.1, поэтому
+одновременных запросов к нему не больше GIGACHAT_MAX_CONNECTIONS (с настоящим GigaChat запросы
+мультиплексируются по HTTP/2). Где именно уходит время, покажет трассировка: --env TRACE_SAMPLE_RATE=0.1,
+спаны - в traces.jsonl рабочего каталога бота.
+
+Запуск: python benchmarks/load_test.py [--users 2000] [--messages 3] [--pay-share 0.2] [--ramp 30]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+
+from local_stubs import GigaChatStub, RobokassaStub, TelegramStub  # noqa: E402
+
+USER_MESSAGES = [
+    "Привет, мне в последнее время очень тревожно",
+    "На работе постоянные конфликты с начальником",
+    "Я плохо сплю и просыпаюсь по ночам",
+    "Иногда кажется, что я ни с чем не справляюсь",
+]
+PAYMENT_CONFIRMATION = "Спасибо за доверие"
+ROBOKASSA_PASSWORD_2 = "load-test-password-2"
+FIRST_USER_ID = 1_000_000
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: List[float], share: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+class Inbox:
+    """Сообщения бота по чатам: заменитель Telegram вызывает listener из своих потоков"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.queues: Dict[int, asyncio.Queue] = {}
+
+    def listener(self, record: Dict):
+        # После прогона бот еще может дописывать потоковые ответы - их уже никто не ждет
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._put, record)
+
+    def _put(self, record: Dict):
+        queue = self.queues.get(record["chat_id"])
+        if queue is not None:
+            queue.put_nowait(record)
+
+    async def wait(self, chat_id: int, predicate: Callable[[Dict], bool], timeout: float) -> Optional[Dict]:
+        """Первое подходящее сообщение бота в чат (остальные пропускаются) или None по таймауту"""
+        queue = self.queues.setdefault(chat_id, asyncio.Queue())
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                record = await asyncio.wait_for(queue.get(), deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                return None
+            if predicate(record):
+                return record
+
+
+def is_reply(record: Dict) -> bool:
+    return record["method"] == "sendMessage"
+
+
+def is_payment_link(record: Dict) -> bool:
+    return record["method"] == "sendMessage" and bool(record["reply_markup"])
+
+
+def is_payment_confirmation(record: Dict) -> bool:
+    return record["method"] == "sendMessage" and record["text"].startswith(PAYMENT_CONFIRMATION)
+
+
+class LoadTest:
+    """Сценарий пользователей и собранные замеры"""
+
+    def __init__(self, args, telegram: TelegramStub, robokassa: RobokassaStub):
+        self.args = args
+        self.telegram = telegram
+        self.robokassa = robokassa
+        self.random = random.Random(args.seed)
+        self.updates = 0
+        self.reply_latencies: List[float] = []
+        self.result_url_latencies: List[float] = []
+        self.confirmation_latencies: List[float] = []
+        self.timeouts = 0
+        self.payment_errors = 0
+        self._pay_executor = ThreadPoolExecutor(max_workers=64, thread_name_prefix="robokassa")
+        self.inbox: Optional[Inbox] = None
+
+    async def send(self, chat_id: int, update: Dict, predicate: Callable[[Dict], bool]) -> Optional[Dict]:
+        """Постановка обновления и ожидание ответа бота; замер задержки ответа"""
+        # Ответом считается только сообщение после этого обновления
+        queue = self.inbox.queues.setdefault(chat_id, asyncio.Queue())
+        while not queue.empty():
+            queue.get_nowait()
+        sent_at = time.time()
+        self.telegram.push_update(update)
+        self.updates += 1
+        record = await self.inbox.wait(chat_id, predicate, self.args.reply_timeout)
+        if record is None:
+            self.timeouts += 1
+            return None
+        self.reply_latencies.append(record["time"] - sent_at)
+        return record
+
+    async def user(self, index: int, pays: bool):
+        user_id = FIRST_USER_ID + index
+        await asyncio.sleep(index * self.args.ramp / max(1, self.args.users))
+        if await self.send(user_id, self.telegram.message_update(user_id, "/start"), is_reply) is None:
+            return
+        for turn in range(self.args.messages):
+            await asyncio.sleep(self.random.uniform(0, 2 * self.args.think))
+            text = USER_MESSAGES[turn % len(USER_MESSAGES)]
+            if await self.send(user_id, self.telegram.message_update(user_id, text), is_reply) is None:
+                return
+        if pays:
+            await self.pay(user_id)
+
+    async def pay(self, user_id: int):
+        """Выбор тарифа, оплата по ссылке из сообщения бота и ожидание подтверждения"""
+        link = await self.send(user_id, self.telegram.callback_update(user_id, self.args.tariff), is_payment_link)
+        if link is None:
+            return
+        payment_url = link["reply_markup"]["inline_keyboard"][0][0]["url"]
+        await asyncio.sleep(self.random.uniform(0, 2 * self.args.think))
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(self._pay_executor, self.robokassa.pay, payment_url)
+        if result["status"] != 200 or result["body"] != f"OK{result['invoice_id']}":
+            self.payment_errors += 1
+            return
+        self.result_url_latencies.append(result["finished"] - result["started"])
+        confirmation = await self.inbox.wait(user_id, is_payment_confirmation, self.args.reply_timeout)
+        if confirmation is None:
+            self.timeouts += 1
+            return
+        self.confirmation_latencies.append(confirmation["time"] - result["started"])
+
+    async def run(self) -> float:
+        """Прогон всех пользователей, возвращает длительность (сек)"""
+        self.inbox = Inbox(asyncio.get_running_loop())
+        self.telegram.listeners.append(self.inbox.listener)
+        payers = set(self.random.sample(range(self.args.users), int(self.args.users * self.args.pay_share)))
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(self.user(index, index in payers) for index in range(self.args.users)))
+        finally:
+            self.telegram.listeners.remove(self.inbox.listener)
+            self._pay_executor.shutdown(wait=False)
+        return time.perf_counter() - started
+
+
+def start_bot(args, telegram: TelegramStub, gigachat: GigaChatStub, port: int, workdir: str) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        BOT_TOKEN="123456:load-test",
+        TELEGRAM_API_BASE_URL=telegram.url,
+        TELEGRAM_MODE=args.mode,
+        TELEGRAM_WEBHOOK_URL=f"http://127.0.0.1:{port}/telegram/webhook",
+        HTTP_PORT=str(port),
+        GIGACHAT_API_KEY="load-test",
+        GIGACHAT_AUTH_URL=gigachat.auth_url,
+        GIGACHAT_CHAT_URL=gigachat.chat_url,
+        GIGACHAT_STREAMING="1" if args.streaming else "0",
+        ROBOKASSA_PASSWORD_1="load-test-password-1",
+        ROBOKASSA_PASSWORD_2=ROBOKASSA_PASSWORD_2,
+    )
+    env.pop("PORT", None)
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    log = open(os.path.join(workdir, "bot.log"), "w")
+    return subprocess.Popen([sys.executable, os.path.join(ROOT, "telegram_bot.py")], cwd=workdir, env=env,
+                            stdout=log, stderr=subprocess.STDOUT)
+
+
+def wait_ready(args, telegram: TelegramStub, port: int, bot: subprocess.Popen, timeout: float = 30):
+    """Ожидание запуска бота: HTTP сервер отвечает, в режиме webhook - webhook установлен"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if bot.poll() is not None:
+            raise RuntimeError("Бот завершился при запуске")
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1).read()
+            if args.mode != "webhook" or telegram.webhook_url:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("Бот не запустился")
+
+
+def report_row(name: str, values: List[float]) -> str:
+    if not values:
+        return f"{name:<28}{0:>8}{'-':>11}{'-':>11}{'-':>11}"
+    return (f"{name:<28}{len(values):>8}{percentile(values, 0.5) * 1000:>11.0f}"
+            f"{percentile(values, 0.95) * 1000:>11.0f}{percentile(values, 0.99) * 1000:>11.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота на локальных заменителях")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--messages", type=int, default=3, help="сообщений на пользователя после /start (до 4)")
+    parser.add_argument("--pay-share", type=float, default=0.2, help="доля пользователей, оплачивающих тариф")
+    parser.add_argument("--tariff", default="tariff_1h")
+    parser.add_argument("--ramp", type=float, default=30.0, help="за сколько секунд подключаются все пользователи")
+    parser.add_argument("--think", type=float, default=1.0, help="средняя пауза пользователя между действиями (сек)")
+    parser.add_argument("--reply-timeout", type=float, default=120.0)
+    parser.add_argument("--mode", choices=["polling", "webhook"], default="polling")
+    parser.add_argument("--streaming", action="store_true", help="потоковые ответы GigaChat (GIGACHAT_STREAMING=1)")
+    parser.add_argument("--latency", type=float, default=0.3, help="базовая задержка GigaChat (сек)")
+    parser.add_argument("--prefill-per-char", type=float, default=0.00002,
+                        help="задержка GigaChat на символ запроса вне кэша (сек)")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0, help="скорость генерации GigaChat")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="дополнительная переменная окружения бота")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="load_test_")
+    port = free_port()
+    telegram = TelegramStub(port=0).start()
+    gigachat = GigaChatStub(port=0, base_latency=args.latency, prefill_per_char=args.prefill_per_char,
+                            tokens_per_second=args.tokens_per_second).start()
+    robokassa = RobokassaStub(f"http://127.0.0.1:{port}/robokassa/result", ROBOKASSA_PASSWORD_2)
+    bot = start_bot(args, telegram, gigachat, port, workdir)
+    print(f"Бот: порт {port}, рабочий каталог и журнал: {workdir}")
+    try:
+        wait_ready(args, telegram, port, bot)
+        test = LoadTest(args, telegram, robokassa)
+        duration = asyncio.run(test.run())
+    finally:
+        bot.terminate()
+        try:
+            bot.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        telegram.stop()
+        gigachat.stop()
+
+    print(f"Пользователей: {args.users}, режим: {args.mode}{', поток' if args.streaming else ''}, "
+          f"длительность: {duration:.1f} с")
+    print(f"Обновлений: {test.updates}, {test.updates / duration:.1f} в секунду; "
+          f"без ответа: {test.timeouts}, ошибок оплаты: {test.payment_errors}")
+    print(f"Запросов к GigaChat: {gigachat.stats['requests']}, отправлено ботом: {len(telegram.sent)}")
+    print(f"{'замер':<28}{'n':>8}{'p50, мс':>11}{'p95, мс':>11}{'p99, мс':>11}")
+    print(report_row("ответ на обновление", test.reply_latencies))
+    print(report_row("ответ ResultURL", test.result_url_latencies))
+    print(report_row("подтверждение оплаты", test.confirmation_latencies))
+    if test.timeouts or test.payment_errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
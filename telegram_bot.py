@@ -23,28 +23,50 @@ Telegram бот - Ассистент психолога широкого про
 import os
 import json
 import requests
+import httpx
 import sys
 import re
 import time
 import hashlib
+import hmac
+import heapq
+import contextvars
+import bisect
 import uuid
-from typing import Optional, Dict, List
-from datetime import datetime
+import random
+import sqlite3
+import secrets
+import signal
+import subprocess
+from typing import Optional, Dict, List, Tuple, Callable, Awaitable, AsyncIterator, Deque
+from collections import deque, OrderedDict
+from collections.abc import MutableMapping
+from datetime import datetime, timedelta
 from urllib.parse import urlencode
+from email.utils import parsedate_to_datetime
 import urllib3
 import asyncio
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Message, Update
 from telegram.constants import ChatAction
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
 from telegram.ext import (
     Application,
     CallbackQueryHandler,
     CommandHandler,
     ContextTypes,
     MessageHandler,
+    TypeHandler,
     filters,
 )
-from flask import Flask, jsonify, request
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import HTMLResponse, JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+import uvicorn
 import threading
+import functools
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 # Отключаем предупреждения SSL
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -90,83 +112,749 @@ ROBOKASSA_RESULT_URL = os.getenv("ROBOKASSA_RESULT_URL", "http://localhost:9999/
 ROBOKASSA_SUCCESS_URL = os.getenv("ROBOKASSA_SUCCESS_URL", "http://localhost:9999/robokassa/success")
 ROBOKASSA_FAIL_URL = os.getenv("ROBOKASSA_FAIL_URL", "http://localhost:9999/robokassa/fail")
 
-# Инициализация Flask приложения для health check
-app = Flask(__name__)
-app.config['JSON_AS_ASCII'] = False
+# Хранилище платежей: "sqlite" (по умолчанию, с автоматическим переносом из JSON) или "json"
+PAYMENTS_STORAGE = os.getenv("PAYMENTS_STORAGE", "sqlite")
+PAYMENTS_DB_PATH = os.getenv("PAYMENTS_DB_PATH", "payments.db")
+
+# История диалога: бюджет токенов на реплики и краткое содержание (без системного промпта),
+# сколько последних реплик всегда хранить дословно и сколько токенов отводить краткому содержанию
+HISTORY_MAX_TOKENS = int(os.getenv("HISTORY_MAX_TOKENS", "3000"))
+HISTORY_KEEP_RECENT = int(os.getenv("HISTORY_KEEP_RECENT", "6"))
+HISTORY_SUMMARY_MAX_TOKENS = int(os.getenv("HISTORY_SUMMARY_MAX_TOKENS", "600"))
+HISTORY_SUMMARY_LINE_CHARS = 200
+HISTORY_CHARS_PER_TOKEN = 3
+
+# Максимум одновременных запросов к GigaChat (обновления разных пользователей обрабатываются параллельно)
+GIGACHAT_MAX_CONCURRENCY = int(os.getenv("GIGACHAT_MAX_CONCURRENCY", "16"))
+
+# Пул потоков для блокирующих операций в обработчиках: число потоков и таймаут операции (сек)
+BLOCKING_MAX_WORKERS = int(os.getenv("BLOCKING_MAX_WORKERS", "8"))
+BLOCKING_TIMEOUT = float(os.getenv("BLOCKING_TIMEOUT", "30"))
+
+# Очередь уведомлений об оплате: размер, сколько отправлять за раз, число повторов,
+# начальная пауза между повторами (сек) и сколько ждать места в переполненной очереди (сек)
+NOTIFY_QUEUE_SIZE = int(os.getenv("NOTIFY_QUEUE_SIZE", "1000"))
+NOTIFY_BATCH_SIZE = int(os.getenv("NOTIFY_BATCH_SIZE", "20"))
+NOTIFY_MAX_RETRIES = int(os.getenv("NOTIFY_MAX_RETRIES", "5"))
+NOTIFY_RETRY_DELAY = float(os.getenv("NOTIFY_RETRY_DELAY", "1.0"))
+NOTIFY_PUT_TIMEOUT = float(os.getenv("NOTIFY_PUT_TIMEOUT", "2.0"))
+
+# Лимиты исходящих сообщений Telegram: всего сообщений в секунду, сообщений в секунду в один чат,
+# сколько сообщений в чат можно отправить подряд и сколько раз повторять запрос после 429
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_CHAT_BURST = float(os.getenv("OUTBOUND_CHAT_BURST", "3"))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
+
+# Сессии пользователей в памяти: максимум записей (LRU), время простоя до вытеснения на диск (сек),
+# период фоновой проверки простоя (сек) и файл для вытесненных сессий
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", "10000"))
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", "3600"))
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", "60"))
+SESSIONS_DB_PATH = os.getenv("SESSIONS_DB_PATH", "sessions.db")
+
+# Неоплаченные счета: через сколько секунд после создания счет переносится в архив,
+# период фоновой проверки (сек) и сколько счетов архивировать за одну транзакцию
+PENDING_PAYMENT_TTL = float(os.getenv("PENDING_PAYMENT_TTL", "86400"))
+PENDING_SWEEP_INTERVAL = float(os.getenv("PENDING_SWEEP_INTERVAL", "300"))
+PENDING_ARCHIVE_BATCH = int(os.getenv("PENDING_ARCHIVE_BATCH", "500"))
 
 # Порт для HTTP сервера (Timeweb Cloud может требовать переменную PORT)
 HTTP_PORT = int(os.getenv("PORT", os.getenv("HTTP_PORT", "9999")))
 
+# Получение обновлений Telegram: "polling" (по умолчанию) или "webhook"
+# В режиме webhook обновления принимает HTTP сервер на TELEGRAM_WEBHOOK_PATH;
+# TELEGRAM_WEBHOOK_URL - публичный адрес этого пути, TELEGRAM_WEBHOOK_SECRET - секрет для проверки запросов.
+# Без секрета на путь webhook мог бы прислать обновление от имени любого пользователя кто угодно,
+# поэтому если он не задан, генерируется при запуске (Telegram получает его в setWebhook)
+TELEGRAM_MODE = os.getenv("TELEGRAM_MODE", "polling")
+TELEGRAM_WEBHOOK_PATH = os.getenv("TELEGRAM_WEBHOOK_PATH", "/telegram/webhook")
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL", f"http://localhost:{HTTP_PORT}{TELEGRAM_WEBHOOK_PATH}")
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "") or secrets.token_urlsafe(32)
+
+# Адрес Telegram Bot API (пусто - api.telegram.org), например http://localhost:8081 для локального заменителя
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL", "").rstrip("/")
+
+# Горизонтальное масштабирование: WORKERS > 1 - процесс-фронт принимает обновления Telegram (polling или webhook)
+# и уведомления Robokassa и передает их WORKERS рабочим процессам по согласованному хешу user_id,
+# так что все сообщения и платежи пользователя обрабатывает один процесс (его сессия и счета).
+# Рабочий i слушает 127.0.0.1:HTTP_PORT+1+i; WORKER_INDEX и WORKER_SECRET фронт задает сам при запуске рабочих.
+# Требует PAYMENTS_STORAGE=sqlite - платежи всех рабочих в одной базе. Сессии тоже в общей базе SESSIONS_DB_PATH
+# (каждым пользователем в каждый момент владеет один рабочий), поэтому при изменении WORKERS пользователи,
+# переехавшие к другому рабочему, сохраняют историю разговора и счетчик бесплатных сообщений
+WORKERS = int(os.getenv("WORKERS", "1"))
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "-1"))
+WORKER_SECRET = os.getenv("WORKER_SECRET", "")
+WORKER_UPDATES_PATH = "/internal/updates"
+# Сколько обновлений фронт передает рабочему одним запросом
+WORKER_FORWARD_BATCH = int(os.getenv("WORKER_FORWARD_BATCH", "100"))
+# Пауза перед перезапуском упавшего рабочего растет вдвое с каждым падением подряд до этого предела (сек);
+# рабочий, проработавший дольше предела, считается стабильным, и счет падений начинается заново
+WORKER_RESTART_MAX_DELAY = float(os.getenv("WORKER_RESTART_MAX_DELAY", "60"))
+IS_WORKER = WORKER_INDEX >= 0
+
+# Пул соединений к GigaChat: максимум соединений, из них keep-alive, и время жизни простаивающего соединения (сек)
+GIGACHAT_MAX_CONNECTIONS = int(os.getenv("GIGACHAT_MAX_CONNECTIONS", "20"))
+GIGACHAT_MAX_KEEPALIVE = int(os.getenv("GIGACHAT_MAX_KEEPALIVE", "10"))
+GIGACHAT_KEEPALIVE_EXPIRY = float(os.getenv("GIGACHAT_KEEPALIVE_EXPIRY", "60"))
+
+# За сколько секунд до истечения OAuth-токена GigaChat обновлять его в фоне
+GIGACHAT_TOKEN_REFRESH_AHEAD = float(os.getenv("GIGACHAT_TOKEN_REFRESH_AHEAD", "120"))
+
+# Адреса GigaChat API (можно заменить на локальный заменитель tools/local_stubs.py)
+GIGACHAT_AUTH_URL = os.getenv("GIGACHAT_AUTH_URL", "https://ngw.devices.sberbank.ru:9443/api/v2/oauth")
+GIGACHAT_CHAT_URL = os.getenv("GIGACHAT_CHAT_URL", "https://gigachat.devices.sberbank.ru/api/v1/chat/completions")
+
+# Заголовок с идентификатором разговора: по нему GigaChat кэширует уже обработанное начало запроса
+# (системный промпт и прошлые реплики). Пустое значение отключает заголовок
+GIGACHAT_SESSION_HEADER = os.getenv("GIGACHAT_SESSION_HEADER", "X-Session-ID")
+
+# Таймауты запросов к GigaChat: установка соединения и ожидание данных (сек)
+GIGACHAT_CONNECT_TIMEOUT = float(os.getenv("GIGACHAT_CONNECT_TIMEOUT", "5"))
+GIGACHAT_READ_TIMEOUT = float(os.getenv("GIGACHAT_READ_TIMEOUT", "60"))
+
+# Повторы при 429/5xx и сетевых ошибках: число повторов, начальная и максимальная пауза (сек).
+# Пауза растет вдвое с каждой попыткой; заголовок Retry-After от сервера важнее расчетной паузы
+GIGACHAT_MAX_RETRIES = int(os.getenv("GIGACHAT_MAX_RETRIES", "3"))
+GIGACHAT_RETRY_BASE_DELAY = float(os.getenv("GIGACHAT_RETRY_BASE_DELAY", "0.5"))
+GIGACHAT_RETRY_MAX_DELAY = float(os.getenv("GIGACHAT_RETRY_MAX_DELAY", "10"))
+GIGACHAT_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Предохранитель: после скольких неудачных запросов подряд перестать обращаться к GigaChat
+# и через сколько секунд пропустить пробный запрос
+GIGACHAT_BREAKER_THRESHOLD = int(os.getenv("GIGACHAT_BREAKER_THRESHOLD", "5"))
+GIGACHAT_BREAKER_RESET = float(os.getenv("GIGACHAT_BREAKER_RESET", "30"))
+
+# Дублирующий запрос: если ответа нет дольше GIGACHAT_HEDGE_DELAY секунд, отправляется второй такой же
+# запрос и берется тот ответ, что придет первым. 0 - не дублировать
+GIGACHAT_HEDGE_DELAY = float(os.getenv("GIGACHAT_HEDGE_DELAY", "0"))
+
+# Ответ пользователю, пока GigaChat недоступен (предохранитель разомкнут)
+GIGACHAT_FALLBACK_REPLY = os.getenv(
+    "GIGACHAT_FALLBACK_REPLY",
+    "Прости, мне нужно отойти буквально на несколько минут. Напиши мне чуть позже, я обязательно отвечу."
+)
+
+
+# Метрики в формате Prometheus (GET METRICS_PATH). Границы корзин гистограмм задержек - в секундах
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+METRICS_LATENCY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class _Metric:
+    """
+    Метрика с метками; значения каждой комбинации меток хранятся по потокам
+    Поток пишет только в свой массив, поэтому запись не берет блокировок (под GIL операция
+    "+=" над элементом своего массива не пересекается с другими писателями). Блокировка нужна
+    только при первой записи потока и при чтении для /metrics
+    """
+    
+    kind = ""
+    
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._children: Dict[Tuple[str, ...], "_Metric"] = {}
+        self._local = threading.local()
+        self._shards: List[list] = []
+    
+    def labels(self, *values: str) -> "_Metric":
+        """Метрика для конкретных значений меток (создается один раз)"""
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._new_child()
+                    self._children[values] = child
+        return child
+    
+    def _new_child(self) -> "_Metric":
+        return type(self)(self.name, self.documentation)
+    
+    def _shard(self) -> list:
+        """Массив значений текущего потока"""
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = self._empty_shard()
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+    
+    def _empty_shard(self) -> list:
+        raise NotImplementedError
+    
+    def _collect(self) -> list:
+        """Сумма массивов всех потоков"""
+        with self._lock:
+            shards = list(self._shards)
+        total = self._empty_shard()
+        for shard in shards:
+            for i, value in enumerate(shard):
+                total[i] += value
+        return total
+    
+    def _series(self) -> List[Tuple[Tuple[str, ...], "_Metric"]]:
+        if not self.labelnames:
+            return [((), self)]
+        with self._lock:
+            return sorted(self._children.items())
+    
+    def _label_text(self, values: Tuple[str, ...], extra: str = "") -> str:
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labelnames, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+    
+    def render(self) -> List[str]:
+        """Строки текстового формата Prometheus"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, metric in self._series():
+            lines.extend(self._render_series(values, metric._collect()))
+        return lines
+    
+    def _render_series(self, values: Tuple[str, ...], total: list) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Счетчик (только растет)"""
+    
+    kind = "counter"
+    
+    def inc(self, amount: float = 1):
+        self._shard()[0] += amount
+    
+    def value(self) -> float:
+        return self._collect()[0]
+    
+    def _empty_shard(self) -> list:
+        return [0]
+    
+    def _render_series(self, values: Tuple[str, ...], total: list) -> List[str]:
+        return [f"{self.name}_total{self._label_text(values)} {total[0]}"]
+
+
+class _Timer:
+    """Замер длительности блока with в гистограмму"""
+    
+    __slots__ = ("histogram", "started")
+    
+    def __init__(self, histogram: "Histogram"):
+        self.histogram = histogram
+    
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class Histogram(_Metric):
+    """Гистограмма: число наблюдений по корзинам, их сумма и количество"""
+    
+    kind = "histogram"
+    
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = METRICS_LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+    
+    def _new_child(self) -> "Histogram":
+        return Histogram(self.name, self.documentation, buckets=self.buckets)
+    
+    def observe(self, value: float):
+        shard = self._shard()
+        # Корзина "le": первая граница не меньше значения, последний элемент перед суммой - +Inf
+        shard[bisect.bisect_left(self.buckets, value)] += 1
+        shard[-2] += value
+        shard[-1] += 1
+    
+    def time(self) -> _Timer:
+        """Контекстный менеджер: with histogram.time(): ..."""
+        return _Timer(self)
+    
+    def _empty_shard(self) -> list:
+        # Корзины, +Inf, сумма, количество
+        return [0] * (len(self.buckets) + 1) + [0.0, 0]
+    
+    def _render_series(self, values: Tuple[str, ...], total: list) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), total):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f"{self.name}_bucket{self._label_text(values, 'le=' + json.dumps(le))} {cumulative}")
+        lines.append(f"{self.name}_sum{self._label_text(values)} {total[-2]}")
+        lines.append(f"{self.name}_count{self._label_text(values)} {total[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    """Набор метрик бота, отдаваемый на METRICS_PATH"""
+    
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+    
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+    
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = METRICS_LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+    
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def timed(histogram: Histogram):
+    """Декоратор: длительность вызова функции (в том числе async) в гистограмму"""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - started)
+            return async_wrapper
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+metrics = MetricsRegistry()
+GIGACHAT_CHAT_SECONDS = metrics.histogram(
+    "psychologist_gigachat_chat_seconds", "Время запроса к GigaChat (stream - до последнего фрагмента)", ("mode",)
+)
+GIGACHAT_TOKEN_SECONDS = metrics.histogram(
+    "psychologist_gigachat_token_seconds", "Время получения токена GigaChat (включая взятый из кэша)"
+)
+HANDLE_MESSAGE_SECONDS = metrics.histogram(
+    "psychologist_handle_message_seconds", "Обработка текстового сообщения от получения до отправки ответа"
+)
+CLEAN_MARKDOWN_SECONDS = metrics.histogram(
+    "psychologist_clean_markdown_seconds", "Очистка ответа от markdown"
+)
+PAYMENT_SAVE_SECONDS = metrics.histogram(
+    "psychologist_payment_save_seconds", "Запись платежей в хранилище", ("operation",)
+)
+UPDATES_TOTAL = metrics.counter("psychologist_telegram_updates", "Обновления Telegram")
+ROBOKASSA_CALLBACKS_TOTAL = metrics.counter(
+    "psychologist_robokassa_callbacks", "Уведомления Robokassa (ResultURL) по результату", ("outcome",)
+)
+FREE_MESSAGE_CUTOFFS_TOTAL = metrics.counter(
+    "psychologist_free_message_cutoffs", "Сообщения сверх бесплатного лимита (вместо ответа - предложение оплаты)"
+)
+WORKER_FORWARDED_TOTAL = metrics.counter(
+    "psychologist_worker_forwarded_updates", "Обновления, переданные фронтом рабочим процессам", ("worker",)
+)
+WORKER_RESTARTS_TOTAL = metrics.counter(
+    "psychologist_worker_restarts", "Перезапуски упавших рабочих процессов", ("worker",)
+)
+
+
+# Трассировка обновлений: доля обновлений Telegram и уведомлений Robokassa, для которых пишутся спаны
+# (0 - трассировка выключена). Спаны выгружаются пачками раз в TRACE_EXPORT_INTERVAL секунд
+# в файл TRACE_EXPORT_PATH (строка - запрос OTLP/JSON ExportTraceServiceRequest) и, если задан,
+# в коллектор OTLP/HTTP TRACE_OTLP_ENDPOINT (например, http://localhost:4318/v1/traces)
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "traces.jsonl")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "")
+TRACE_EXPORT_INTERVAL = float(os.getenv("TRACE_EXPORT_INTERVAL", "5"))
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "10000"))
+
+# Виды спанов OTLP
+SPAN_INTERNAL = 1
+SPAN_SERVER = 2
+SPAN_CLIENT = 3
+
+
+def _otlp_value(value) -> Dict:
+    """Значение атрибута в формате OTLP/JSON"""
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class Span:
+    """Участок обработки обновления: имя, время начала и конца, атрибуты и ошибка"""
+    
+    __slots__ = ("name", "kind", "trace_id", "span_id", "parent_id", "start_ns", "end_ns", "attributes", "error")
+    
+    def __init__(self, name: str, kind: int, trace_id: str, parent_id: Optional[str], attributes: Dict):
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.attributes = attributes
+        self.error: Optional[str] = None
+    
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+    
+    def to_otlp(self) -> Dict:
+        """Спан в формате OTLP/JSON"""
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in self.attributes.items()],
+            # 1 - успешно, 2 - ошибка
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+class TraceExporter:
+    """
+    Буфер завершенных спанов и их выгрузка (flush - блокирующая, вызывается в пуле потоков)
+    Работает без сети: файл в формате OTLP/JSON читают коллектор OpenTelemetry (filelog/otlpjsonfile)
+    и jq. При переполнении буфера старые спаны отбрасываются
+    """
+    
+    def __init__(self, path: str = TRACE_EXPORT_PATH, endpoint: str = TRACE_OTLP_ENDPOINT,
+                 buffer_size: int = TRACE_BUFFER_SIZE):
+        self.path = path
+        self.endpoint = endpoint
+        self._spans: Deque[Span] = deque(maxlen=buffer_size)
+        self._lock = threading.Lock()
+        self.exported = 0
+        self.dropped = 0
+    
+    def add(self, span: Span):
+        if len(self._spans) == self._spans.maxlen:
+            self.dropped += 1
+        self._spans.append(span)
+    
+    def flush(self) -> int:
+        """Выгрузка накопленных спанов, возвращает их число"""
+        with self._lock:
+            spans = []
+            while self._spans:
+                spans.append(self._spans.popleft())
+            if not spans:
+                return 0
+            line = json.dumps({"resourceSpans": [{
+                "resource": {"attributes": [
+                    {"key": "service.name", "value": {"stringValue": "psychologist_assistant_bot"}},
+                ]},
+                "scopeSpans": [{"scope": {"name": "telegram_bot"}, "spans": [span.to_otlp() for span in spans]}],
+            }]}, ensure_ascii=False)
+            if self.path:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+            if self.endpoint:
+                try:
+                    requests.post(self.endpoint, data=line.encode("utf-8"), timeout=5,
+                                  headers={"Content-Type": "application/json"})
+                except requests.RequestException as e:
+                    print(f"⚠ Ошибка отправки трассировки в {self.endpoint}: {e}")
+            self.exported += len(spans)
+            return len(spans)
+
+
+# Текущий спан задачи (обработчика); пул потоков BlockingExecutor копирует контекст в поток
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+
+
+class _SpanScope:
+    """Блок with, в котором спан текущий"""
+    
+    __slots__ = ("tracer", "span", "token")
+    
+    def __init__(self, tracer: "Tracer", span: Span):
+        self.tracer = tracer
+        self.span = span
+    
+    def __enter__(self) -> Span:
+        self.token = _current_span.set(self.span)
+        return self.span
+    
+    def __exit__(self, exc_type, exc, traceback):
+        _current_span.reset(self.token)
+        self.tracer.end_span(self.span, exc)
+        return False
+
+
+class _NoSpan:
+    """Блок with для обновления вне выборки: ничего не записывает"""
+    
+    __slots__ = ()
+    
+    def __enter__(self):
+        return None
+    
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Tracer:
+    """
+    Спаны с выборкой по корневому спану
+    Решение о записи принимается один раз на обновление (root=True); дочерние спаны пишутся только
+    внутри записываемого корневого, иначе span() ничего не создает
+    """
+    
+    def __init__(self, sample_rate: float = TRACE_SAMPLE_RATE, exporter: Optional[TraceExporter] = None):
+        self.sample_rate = sample_rate
+        self.exporter = exporter if exporter is not None else TraceExporter()
+    
+    def start_span(self, name: str, kind: int = SPAN_INTERNAL, root: bool = False, **attributes) -> Optional[Span]:
+        """Новый спан (не становится текущим) или None, если обновление не попало в выборку"""
+        parent = _current_span.get()
+        if parent is not None:
+            return Span(name, kind, parent.trace_id, parent.span_id, attributes)
+        if root and self.sample_rate > 0 and random.random() < self.sample_rate:
+            return Span(name, kind, f"{random.getrandbits(128):032x}", None, attributes)
+        return None
+    
+    def end_span(self, span: Optional[Span], error: Optional[BaseException] = None):
+        if span is None:
+            return
+        span.end_ns = time.time_ns()
+        if error is not None:
+            span.error = f"{type(error).__name__}: {error}"
+        self.exporter.add(span)
+    
+    def span(self, name: str, kind: int = SPAN_INTERNAL, root: bool = False, **attributes):
+        """Спан на время блока with; внутри блока он текущий (родитель вложенных спанов)"""
+        span = self.start_span(name, kind, root, **attributes)
+        if span is None:
+            return _NO_SPAN
+        return _SpanScope(self, span)
+    
+    @staticmethod
+    def set_attribute(key: str, value):
+        """Атрибут текущего спана (если обновление в выборке)"""
+        span = _current_span.get()
+        if span is not None:
+            span.attributes[key] = value
+
+
+def traced(name: str, kind: int = SPAN_INTERNAL, root: bool = False):
+    """Декоратор: вызов функции (в том числе async) - спан трассировки"""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with tracer.span(name, kind, root):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name, kind, root):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+tracer = Tracer()
+
 
 class GigaChatClient:
     """Клиент для работы с GigaChat API"""
     
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, auth_url: str = GIGACHAT_AUTH_URL, chat_url: str = GIGACHAT_CHAT_URL,
+                 session_header: str = GIGACHAT_SESSION_HEADER,
+                 connect_timeout: float = GIGACHAT_CONNECT_TIMEOUT, read_timeout: float = GIGACHAT_READ_TIMEOUT,
+                 max_retries: int = GIGACHAT_MAX_RETRIES, retry_base_delay: float = GIGACHAT_RETRY_BASE_DELAY,
+                 retry_max_delay: float = GIGACHAT_RETRY_MAX_DELAY):
         self.api_key = api_key
-        self.auth_url = "https://ngw.devices.sberbank.ru:9443/api/v2/oauth"
-        self.chat_url = "https://gigachat.devices.sberbank.ru/api/v1/chat/completions"
+        self.auth_url = auth_url
+        self.chat_url = chat_url
+        self.session_header = session_header
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.retries = 0
         self.access_token: Optional[str] = None
-        self.token_expires_at: Optional[datetime] = None
+        self.token_expires_at: Optional[float] = None
+        self._token_lock = threading.Lock()
         
+    @traced("gigachat.token")
+    @timed(GIGACHAT_TOKEN_SECONDS)
     def _get_access_token(self) -> str:
         """Получение токена доступа"""
-        if self.access_token and self.token_expires_at and datetime.now().timestamp() < self.token_expires_at:
+        if self.access_token and self.token_expires_at and time.time() < self.token_expires_at:
             return self.access_token
-            
-        headers = {
-            "Authorization": f"Basic {self.api_key}",
-            "RqUID": self._generate_rquid(),
-            "Content-Type": "application/x-www-form-urlencoded",
-            "Accept": "application/json"
-        }
-        data = {
-            "scope": "GIGACHAT_API_PERS"
-        }
         
+        # Одновременно обновлять токен может только один поток, остальные получат уже обновленный
+        with self._token_lock:
+            if self.access_token and self.token_expires_at and time.time() < self.token_expires_at:
+                return self.access_token
+            return self._request_access_token()
+    
+    def _request_access_token(self) -> str:
+        """Запрос нового токена у сервера авторизации"""
         try:
-            response = requests.post(self.auth_url, headers=headers, data=data, verify=False)
+            response = self._post(self.auth_url, headers=self._auth_headers(), data=self._auth_data())
             response.raise_for_status()
-            token_data = response.json()
-            self.access_token = token_data.get("access_token")
-            if not self.access_token:
-                raise Exception("Токен доступа не получен. Проверьте API ключ.")
-            expires_in = token_data.get("expires_at", 1800)  # По умолчанию 30 минут
-            self.token_expires_at = datetime.now().timestamp() + expires_in
-            return self.access_token
+            return self._store_token(response.json())
         except requests.exceptions.HTTPError as e:
             raise Exception(f"Ошибка HTTP при получении токена: {e.response.status_code} - {e.response.text}")
         except Exception as e:
             raise Exception(f"Ошибка получения токена: {e}")
     
+    def _retry_delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """
+        Пауза перед повтором номер attempt (с нуля)
+        Retry-After (секунды или HTTP-дата) важнее экспоненциальной паузы; к расчетной паузе добавляется
+        случайный разброс, чтобы повторы разных запросов не приходили одновременно
+        """
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                try:
+                    delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    delay = None
+            if delay is not None:
+                return min(max(delay, 0.0), self.retry_max_delay)
+        delay = min(self.retry_base_delay * (2 ** attempt), self.retry_max_delay)
+        return delay * random.uniform(0.5, 1.0)
+    
+    def _post(self, url: str, **kwargs) -> requests.Response:
+        """POST с таймаутами и повторами при 429/5xx и сетевых ошибках"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = requests.post(url, timeout=(self.connect_timeout, self.read_timeout), verify=False, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                delay = self._retry_delay(attempt)
+            else:
+                if response.status_code not in GIGACHAT_RETRY_STATUSES or attempt == self.max_retries:
+                    return response
+                delay = self._retry_delay(attempt, response.headers.get("Retry-After"))
+            self.retries += 1
+            time.sleep(delay)
+    
+    def _auth_headers(self) -> Dict[str, str]:
+        """Заголовки запроса токена"""
+        return {
+            "Authorization": f"Basic {self.api_key}",
+            "RqUID": self._generate_rquid(),
+            "Content-Type": "application/x-www-form-urlencoded",
+            "Accept": "application/json"
+        }
+    
+    def _auth_data(self) -> Dict[str, str]:
+        """Тело запроса токена"""
+        return {
+            "scope": "GIGACHAT_API_PERS"
+        }
+    
+    def _store_token(self, token_data: Dict) -> str:
+        """Сохранение полученного токена"""
+        access_token, expires_at = self._parse_token(token_data)
+        self.access_token = access_token
+        self.token_expires_at = expires_at
+        return self.access_token
+    
+    @staticmethod
+    def _parse_token(token_data: Dict) -> tuple:
+        """
+        Разбор ответа сервера авторизации
+        Возвращает (access_token, expires_at), где expires_at - unix-время в секундах.
+        GigaChat возвращает в expires_at абсолютное время истечения в миллисекундах.
+        """
+        access_token = token_data.get("access_token")
+        if not access_token:
+            raise Exception("Токен доступа не получен. Проверьте API ключ.")
+        expires_at = token_data.get("expires_at")
+        if not expires_at:
+            return access_token, time.time() + 1800  # По умолчанию 30 минут
+        expires_at = float(expires_at)
+        if expires_at > 1e11:
+            expires_at /= 1000.0  # Миллисекунды -> секунды
+        elif expires_at < 1e9:
+            expires_at += time.time()  # Относительная длительность
+        return access_token, expires_at
+    
     def _generate_rquid(self) -> str:
         """Генерация уникального идентификатора запроса"""
-        import uuid
         return str(uuid.uuid4())
     
-    def chat(self, messages: List[Dict[str, str]], model: str = "GigaChat") -> str:
-        """Отправка сообщения в чат"""
-        token = self._get_access_token()
-        
+    def _chat_headers(self, token: str, session_id: Optional[str] = None) -> Dict[str, str]:
+        """Заголовки запроса к чату"""
         headers = {
             "Authorization": f"Bearer {token}",
             "Content-Type": "application/json",
             "Accept": "application/json"
         }
-        
-        payload = {
+        if session_id and self.session_header:
+            headers[self.session_header] = session_id
+        return headers
+    
+    def _chat_payload(self, messages: List[Dict[str, str]], model: str) -> Dict:
+        """Тело запроса к чату"""
+        return {
             "model": model,
             "messages": messages,
             "temperature": 0.7,
             "max_tokens": 2000
         }
+    
+    def _parse_chat_response(self, result: Dict) -> str:
+        """Извлечение текста ответа"""
+        if "choices" not in result or len(result["choices"]) == 0:
+            raise Exception("Пустой ответ от GigaChat API")
+        return result["choices"][0]["message"]["content"]
+    
+    @traced("gigachat.chat", SPAN_CLIENT)
+    @timed(GIGACHAT_CHAT_SECONDS.labels("chat"))
+    def chat(self, messages: List[Dict[str, str]], model: str = "GigaChat", session_id: Optional[str] = None) -> str:
+        """Отправка сообщения в чат (session_id - идентификатор разговора для кэша GigaChat)"""
+        token = self._get_access_token()
         
         try:
-            response = requests.post(self.chat_url, headers=headers, json=payload, verify=False)
+            response = self._post(
+                self.chat_url,
+                headers=self._chat_headers(token, session_id),
+                json=self._chat_payload(messages, model)
+            )
             response.raise_for_status()
-            result = response.json()
-            if "choices" not in result or len(result["choices"]) == 0:
-                raise Exception("Пустой ответ от GigaChat API")
-            return result["choices"][0]["message"]["content"]
+            return self._parse_chat_response(response.json())
         except requests.exceptions.HTTPError as e:
             error_text = "Неизвестная ошибка"
             try:
@@ -178,7 +866,509 @@ class GigaChatClient:
         except KeyError as e:
             raise Exception(f"Неожиданный формат ответа от GigaChat: {e}")
         except Exception as e:
-            raise Exception(f"Ошибка при запросе к GigaChat: {e}")
+            raise Exception(f"Ошибка при запросе к GigaChat: {str(e) or type(e).__name__}")
+
+
+class GigaChatTokenManager:
+    """
+    Кэш OAuth-токена GigaChat
+    Параллельные запросы токена объединяются в одно обращение к серверу авторизации,
+    а после получения токена фоновая задача обновляет его заранее, до истечения срока
+    """
+    
+    def __init__(self, fetch_token: Callable[[], Awaitable[tuple]],
+                 refresh_ahead: float = GIGACHAT_TOKEN_REFRESH_AHEAD,
+                 retry_delay: float = 10.0):
+        self.fetch_token = fetch_token
+        self.refresh_ahead = refresh_ahead
+        self.retry_delay = retry_delay
+        self.access_token: Optional[str] = None
+        self.expires_at: float = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._background_task: Optional[asyncio.Task] = None
+    
+    def is_valid(self) -> bool:
+        """Токен получен и еще не истек"""
+        return self.access_token is not None and time.time() < self.expires_at
+    
+    async def get_token(self) -> str:
+        """Получение действующего токена"""
+        if self.is_valid():
+            self.hits += 1
+            return self.access_token
+        self.misses += 1
+        return await self.refresh()
+    
+    async def refresh(self) -> str:
+        """Обновление токена; одновременные вызовы ждут один общий запрос"""
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._do_refresh())
+        # shield: отмена одного ожидающего не должна отменять общий запрос
+        return await asyncio.shield(self._refresh_task)
+    
+    async def _do_refresh(self) -> str:
+        """Фактический запрос токена"""
+        try:
+            access_token, expires_at = await self.fetch_token()
+        except Exception:
+            self.refresh_errors += 1
+            raise
+        self.access_token = access_token
+        self.expires_at = expires_at
+        self.refreshes += 1
+        self._schedule_background_refresh()
+        return access_token
+    
+    def _schedule_background_refresh(self):
+        """Запуск фоновой задачи упреждающего обновления"""
+        if self._background_task is None or self._background_task.done():
+            self._background_task = asyncio.create_task(self._background_refresh())
+    
+    async def _background_refresh(self):
+        """Обновляет токен за refresh_ahead секунд до истечения"""
+        while True:
+            delay = max(self.expires_at - self.refresh_ahead - time.time(), 0.0)
+            await asyncio.sleep(delay)
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠ Не удалось заранее обновить токен GigaChat: {e}")
+                await asyncio.sleep(self.retry_delay)
+    
+    def stats(self) -> Dict[str, int]:
+        """Счетчики попаданий в кэш и обновлений"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "refresh_errors": self.refresh_errors,
+        }
+    
+    async def close(self):
+        """Остановка фонового обновления"""
+        for task in (self._background_task, self._refresh_task):
+            if task is not None and not task.done():
+                task.cancel()
+        self._background_task = None
+        self._refresh_task = None
+
+
+class GigaChatUnavailable(Exception):
+    """GigaChat считается недоступным (предохранитель разомкнут) - запрос не отправлялся"""
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для внешнего сервиса
+    После failure_threshold неудачных запросов подряд размыкается: запросы сразу отклоняются.
+    Через reset_timeout секунд пропускает один пробный запрос - при успехе замыкается,
+    при неудаче снова размыкается. Используется из event loop, без блокировок.
+    """
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self, failure_threshold: int = GIGACHAT_BREAKER_THRESHOLD,
+                 reset_timeout: float = GIGACHAT_BREAKER_RESET):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+        self.trips = 0
+        self._probe_in_flight = False
+    
+    def allow(self) -> bool:
+        """Можно ли отправить запрос"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        self.rejected += 1
+        return False
+    
+    def record_success(self):
+        """Запрос выполнен успешно"""
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probe_in_flight = False
+    
+    def record_failure(self):
+        """Запрос не выполнен из-за недоступности сервиса"""
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.trips += 1
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+        self._probe_in_flight = False
+    
+    def release(self):
+        """Запрос завершился без вывода о состоянии сервиса (например, ошибка 4xx)"""
+        self._probe_in_flight = False
+    
+    def stats(self) -> Dict:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "trips": self.trips,
+        }
+
+
+class AsyncGigaChatClient(GigaChatClient):
+    """
+    Асинхронный клиент GigaChat API
+    Использует общий пул HTTP/2 соединений с keep-alive, чтобы запросы
+    не блокировали event loop бота и не открывали TLS-соединение заново.
+    Запросы ограничены таймаутами, повторяются при 429/5xx и сетевых ошибках,
+    проходят через предохранитель и при необходимости дублируются (hedge_delay).
+    """
+    
+    def __init__(self, api_key: str, max_connections: int = GIGACHAT_MAX_CONNECTIONS,
+                 max_keepalive_connections: int = GIGACHAT_MAX_KEEPALIVE,
+                 keepalive_expiry: float = GIGACHAT_KEEPALIVE_EXPIRY,
+                 hedge_delay: float = GIGACHAT_HEDGE_DELAY,
+                 breaker: Optional[CircuitBreaker] = None, **kwargs):
+        super().__init__(api_key, **kwargs)
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.timeout = httpx.Timeout(
+            connect=self.connect_timeout, read=self.read_timeout,
+            write=self.connect_timeout, pool=self.read_timeout
+        )
+        self.hedge_delay = hedge_delay
+        self.hedged_requests = 0
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self._http: Optional[httpx.AsyncClient] = None
+        self.tokens = GigaChatTokenManager(self._fetch_access_token)
+    
+    def _get_http(self) -> httpx.AsyncClient:
+        """Получение (или создание) пула соединений"""
+        if self._http is None or self._http.is_closed:
+            self._http = httpx.AsyncClient(http2=True, limits=self.limits, verify=False, timeout=self.timeout)
+        return self._http
+    
+    async def aclose(self):
+        """Закрытие пула соединений"""
+        await self.tokens.close()
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+    
+    def stats(self) -> Dict:
+        """Статистика повторов, дублирующих запросов и предохранителя"""
+        return {
+            "retries": self.retries,
+            "hedged_requests": self.hedged_requests,
+            "breaker": self.breaker.stats(),
+        }
+    
+    async def _send(self, request: Callable[[], Awaitable[httpx.Response]]) -> httpx.Response:
+        """Запрос с повторами при 429/5xx и сетевых ошибках (включая таймауты)"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await request()
+            except httpx.TransportError:
+                if attempt == self.max_retries:
+                    raise
+                delay = self._retry_delay(attempt)
+            else:
+                if response.status_code not in GIGACHAT_RETRY_STATUSES or attempt == self.max_retries:
+                    return response
+                delay = self._retry_delay(attempt, response.headers.get("Retry-After"))
+                await response.aclose()
+            self.retries += 1
+            tracer.set_attribute("retries", attempt + 1)
+            await asyncio.sleep(delay)
+    
+    async def _hedged(self, request: Callable[[], Awaitable[httpx.Response]]) -> httpx.Response:
+        """
+        Запрос с дублированием: если за hedge_delay ответа нет, отправляется второй такой же.
+        Берется первый ответ без ошибки сервера, второй запрос отменяется
+        """
+        first = asyncio.ensure_future(request())
+        if self.hedge_delay <= 0:
+            return await first
+        done, _ = await asyncio.wait({first}, timeout=self.hedge_delay)
+        if done:
+            return first.result()
+        self.hedged_requests += 1
+        tracer.set_attribute("hedged", True)
+        pending = {first, asyncio.ensure_future(request())}
+        result: Optional[httpx.Response] = None
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    result = task.result()
+                    if result.status_code not in GIGACHAT_RETRY_STATUSES:
+                        return result
+        finally:
+            for task in pending:
+                task.cancel()
+        if result is not None:
+            return result
+        raise error
+    
+    def _record_outcome(self, succeeded: bool, error: Optional[BaseException]):
+        """
+        Учет результата запроса в предохранителе
+        Неудача - сетевая ошибка, таймаут, 429/5xx или сбой получения токена;
+        ошибки 4xx, неожиданный формат ответа и отмена запроса о состоянии сервиса не говорят
+        """
+        if succeeded:
+            self.breaker.record_success()
+        elif error is None or isinstance(error, (KeyError, json.JSONDecodeError)):
+            self.breaker.release()
+        elif isinstance(error, httpx.HTTPStatusError) and error.response.status_code not in GIGACHAT_RETRY_STATUSES:
+            self.breaker.release()
+        else:
+            self.breaker.record_failure()
+    
+    def _check_breaker(self):
+        if not self.breaker.allow():
+            raise GigaChatUnavailable("GigaChat временно недоступен")
+    
+    @traced("gigachat.token")
+    @timed(GIGACHAT_TOKEN_SECONDS)
+    async def _get_access_token(self) -> str:
+        """Получение токена доступа"""
+        return await self.tokens.get_token()
+    
+    @traced("gigachat.token.fetch", SPAN_CLIENT)
+    async def _fetch_access_token(self) -> tuple:
+        """Запрос нового токена, возвращает (access_token, expires_at)"""
+        http = self._get_http()
+        try:
+            response = await self._send(
+                lambda: http.post(self.auth_url, headers=self._auth_headers(), data=self._auth_data())
+            )
+            response.raise_for_status()
+            return self._parse_token(response.json())
+        except httpx.HTTPStatusError as e:
+            raise Exception(f"Ошибка HTTP при получении токена: {e.response.status_code} - {e.response.text}")
+        except Exception as e:
+            raise Exception(f"Ошибка получения токена: {e}")
+    
+    @staticmethod
+    def _http_error(e: httpx.HTTPStatusError) -> Exception:
+        """Исключение с текстом ошибки GigaChat"""
+        try:
+            error_data = e.response.json()
+            error_text = error_data.get("message", str(e.response.text))
+        except Exception:
+            error_text = e.response.text
+        return Exception(f"Ошибка HTTP при запросе к GigaChat: {e.response.status_code} - {error_text}")
+    
+    @traced("gigachat.chat", SPAN_CLIENT)
+    @timed(GIGACHAT_CHAT_SECONDS.labels("chat"))
+    async def chat(self, messages: List[Dict[str, str]], model: str = "GigaChat",
+                   session_id: Optional[str] = None) -> str:
+        """Отправка сообщения в чат (session_id - идентификатор разговора для кэша GigaChat)"""
+        self._check_breaker()
+        succeeded = False
+        error: Optional[BaseException] = None
+        try:
+            token = await self._get_access_token()
+            http = self._get_http()
+            headers = self._chat_headers(token, session_id)
+            payload = self._chat_payload(messages, model)
+            response = await self._send(lambda: self._hedged(
+                lambda: http.post(self.chat_url, headers=headers, json=payload)
+            ))
+            response.raise_for_status()
+            result = self._parse_chat_response(response.json())
+            succeeded = True
+            return result
+        except httpx.HTTPStatusError as e:
+            error = e
+            raise self._http_error(e)
+        except KeyError as e:
+            error = e
+            raise Exception(f"Неожиданный формат ответа от GigaChat: {e}")
+        except Exception as e:
+            error = e
+            raise Exception(f"Ошибка при запросе к GigaChat: {str(e) or type(e).__name__}")
+        finally:
+            self._record_outcome(succeeded, error)
+
+    async def chat_stream(self, messages: List[Dict[str, str]], model: str = "GigaChat",
+                          session_id: Optional[str] = None) -> AsyncIterator[str]:
+        """
+        Потоковая отправка сообщения в чат (SSE)
+        Отдает фрагменты ответа по мере их генерации. Повторяется только установка потока:
+        после первого фрагмента ошибка передается вызывающему
+        """
+        self._check_breaker()
+        succeeded = False
+        error: Optional[BaseException] = None
+        response: Optional[httpx.Response] = None
+        started = time.perf_counter()
+        # Спан не делается текущим: между фрагментами управление у вызывающего
+        span = tracer.start_span("gigachat.chat_stream", SPAN_CLIENT)
+        chunks = 0
+        try:
+            token = await self._get_access_token()
+            payload = self._chat_payload(messages, model)
+            payload["stream"] = True
+            headers = self._chat_headers(token, session_id)
+            headers["Accept"] = "text/event-stream"
+            http = self._get_http()
+            response = await self._send(lambda: http.send(
+                http.build_request("POST", self.chat_url, headers=headers, json=payload), stream=True
+            ))
+            if response.status_code >= 400:
+                await response.aread()
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                chunk = json.loads(data)
+                for choice in chunk.get("choices", []):
+                    content = choice.get("delta", {}).get("content")
+                    if content:
+                        chunks += 1
+                        yield content
+            succeeded = True
+        except httpx.HTTPStatusError as e:
+            error = e
+            raise self._http_error(e)
+        except json.JSONDecodeError as e:
+            error = e
+            raise Exception(f"Неожиданный формат ответа от GigaChat: {e}")
+        except Exception as e:
+            error = e
+            raise Exception(f"Ошибка при запросе к GigaChat: {str(e) or type(e).__name__}")
+        finally:
+            if response is not None:
+                await response.aclose()
+            self._record_outcome(succeeded, error)
+            GIGACHAT_CHAT_SECONDS.labels("stream").observe(time.perf_counter() - started)
+            if span is not None:
+                span.set_attribute("chunks", chunks)
+                tracer.end_span(span, error)
+
+
+# Строчная разметка: код, ссылки, жирный, зачеркнутый и курсив. Внутри кода ничего не меняем,
+# остальные элементы могут быть вложены друг в друга (**[ссылка](url)**) и очищаются рекурсивно
+_INLINE_MARKDOWN = r"""
+    `(?P<code>[^`]+)`
+  | \[(?P<link>[^\]]+)\]\([^)]+\)
+  | \*\*(?P<bold>[^*]+)\*\*
+  | __(?P<bold_>[^_]+)__
+  | ~~(?P<strike>[^~]+)~~
+  | (?<!\*)\*(?P<italic>[^*]+)\*(?!\*)
+  | (?<!_)_(?P<italic_>[^_]+)_(?!_)
+"""
+
+# Полная разметка ответа: сначала блоки кода (целиком, до строчного кода внутри них),
+# затем элементы начала строки (заголовки и маркеры списков) и строчная разметка.
+# Альтернативы проверяются по порядку в каждой позиции, текст просматривается один раз.
+# Опережающая проверка первого символа отсекает обычный текст, не перебирая все альтернативы.
+# Разрывы абзацев нормализуются отдельным проходом после замены (PARAGRAPH_BREAK_PATTERN): удаленный
+# блок кода оставляет пустые строки до и после себя, и их нужно схлопнуть вместе. Пробелы вокруг разрыва
+# тоже убираются - так же абзацы очищает IncrementalMarkdownCleaner, и потоковый текст совпадает с итоговым
+MARKDOWN_PATTERN = re.compile(r"""
+  (?= [`\[*_~\#0-9+-] | ^[ \t] )
+  (?:
+    (?P<fence>```[\s\S]*?```)
+  | (?P<heading>^\#{1,6}\s+)
+  | (?P<bullet>^[ \t]*[-*+][ \t]+)
+  | (?P<numbered>^[ \t]*\d+\.[ \t]+)
+  | """ + _INLINE_MARKDOWN + ")", re.MULTILINE | re.VERBOSE)
+
+INLINE_MARKDOWN_PATTERN = re.compile(_INLINE_MARKDOWN, re.VERBOSE)
+# Разделение по самим переносам: шаблон с [ \t]* в начале пробовался бы с каждого пробела текста
+PARAGRAPH_BREAK_PATTERN = re.compile(r"\n{2,}")
+
+
+def _markdown_replacement(match: re.Match) -> str:
+    """Замена найденного элемента разметки"""
+    kind = match.lastgroup
+    if kind in ("fence", "heading", "bullet", "numbered"):
+        return ""
+    if kind == "code":
+        return match.group(kind)
+    inner = match.group(kind)
+    # Во вложенном тексте без разметки повторный проход не нужен
+    if "*" in inner or "_" in inner or "`" in inner or "[" in inner or "~" in inner:
+        return INLINE_MARKDOWN_PATTERN.sub(_markdown_replacement, inner)
+    return inner
+
+
+def strip_markdown(text: str) -> str:
+    """Удаление markdown разметки из текста за один проход и нормализация разрывов абзацев"""
+    if not text:
+        return text
+    text = MARKDOWN_PATTERN.sub(_markdown_replacement, text)
+    return "\n\n".join(paragraph.strip(" \t") for paragraph in PARAGRAPH_BREAK_PATTERN.split(text)).strip()
+
+
+class IncrementalMarkdownCleaner:
+    """
+    Инкрементальная очистка markdown для потокового ответа
+    Завершенные абзацы очищаются один раз и кэшируются, повторно обрабатывается
+    только последний (незавершенный) абзац. Абзацы внутри блока кода ``` не разделяются.
+    """
+
+    def __init__(self, clean: Callable[[str], str] = strip_markdown):
+        self.clean = clean
+        self.raw = ""
+        # Очищенные завершенные абзацы, уже склеенные через "\n\n"
+        self._done_text = ""
+        self._tail_start = 0
+
+    def feed(self, chunk: str) -> str:
+        """Добавление фрагмента, возвращает текущий очищенный текст"""
+        self.raw += chunk
+        while True:
+            boundary = self.raw.find("\n\n", self._tail_start)
+            if boundary == -1:
+                break
+            paragraph = self.raw[self._tail_start:boundary]
+            # Незакрытый блок кода продолжается в следующем абзаце
+            if paragraph.count("```") % 2 == 1:
+                next_fence = self.raw.find("```", boundary)
+                if next_fence == -1:
+                    break
+                boundary = self.raw.find("\n\n", next_fence + 3)
+                if boundary == -1:
+                    break
+                paragraph = self.raw[self._tail_start:boundary]
+            cleaned = self.clean(paragraph)
+            if cleaned:
+                self._done_text = f"{self._done_text}\n\n{cleaned}" if self._done_text else cleaned
+            self._tail_start = boundary + 2
+        return self.text()
+
+    def text(self) -> str:
+        """Текущий очищенный текст"""
+        tail = self.clean(self.raw[self._tail_start:])
+        if not tail:
+            return self._done_text
+        return f"{self._done_text}\n\n{tail}" if self._done_text else tail
 
 
 class RobokassaPayment:
@@ -191,96 +1381,545 @@ class RobokassaPayment:
         self.test_mode = test_mode
         self.base_url = ROBOKASSA_BASE_URL
     
-    def _normalize_out_sum(self, out_sum) -> str:
-        """
-        Нормализация суммы к строке в формате, ожидаемом Robokassa.
-        Всегда используем два знака после запятой, чтобы формат был стабильным.
-        """
-        # Если пришла строка - просто возвращаем как есть
-        if isinstance(out_sum, str):
-            return out_sum
-        # Для чисел приводим к формату с двумя знаками после запятой
-        return f"{float(out_sum):.2f}"
+    def _normalize_out_sum(self, out_sum) -> str:
+        """
+        Нормализация суммы к строке в формате, ожидаемом Robokassa.
+        Всегда используем два знака после запятой, чтобы формат был стабильным.
+        """
+        # Если пришла строка - просто возвращаем как есть
+        if isinstance(out_sum, str):
+            return out_sum
+        # Для чисел приводим к формату с двумя знаками после запятой
+        return f"{float(out_sum):.2f}"
+    
+    def generate_signature(self, out_sum, inv_id: int, password: str = None) -> str:
+        """
+        Генерация подписи для запроса на оплату
+        Формат: MerchantLogin:OutSum:InvoiceID:Пароль#1
+        """
+        if password is None:
+            password = self.password_1
+        
+        # Нормализуем сумму к строке и формируем строку для подписи
+        out_sum_str = self._normalize_out_sum(out_sum)
+        signature_string = f"{self.merchant_login}:{out_sum_str}:{inv_id}:{password}"
+        
+        # Вычисляем MD5 хэш
+        signature = hashlib.md5(signature_string.encode('utf-8')).hexdigest()
+        return signature
+    
+    def verify_signature(self, out_sum, inv_id: int, signature: str, password: str = None) -> bool:
+        """
+        Проверка подписи от Robokassa
+        Формат: OutSum:InvoiceID:Пароль#2
+        """
+        if password is None:
+            password = self.password_2
+        
+        # Нормализуем сумму к строке и формируем строку для проверки
+        out_sum_str = self._normalize_out_sum(out_sum)
+        signature_string = f"{out_sum_str}:{inv_id}:{password}"
+        
+        # Вычисляем MD5 хэш
+        expected_signature = hashlib.md5(signature_string.encode('utf-8')).hexdigest()
+        
+        return signature.lower() == expected_signature.lower()
+    
+    def generate_payment_url(self, out_sum, inv_id: int, description: str,
+                            result_url: str = None, success_url: str = None,
+                            fail_url: str = None) -> str:
+        """
+        Генерация URL для перехода на оплату
+        """
+        # Нормализуем сумму и генерируем подпись
+        out_sum_str = self._normalize_out_sum(out_sum)
+        signature = self.generate_signature(out_sum_str, inv_id)
+        
+        # Параметры запроса
+        # ВАЖНО: используем имена параметров согласно актуальной документации Robokassa:
+        # MerchantLogin, OutSum, InvId, Description, SignatureValue, IsTest, ResultUrl, SuccessUrl, FailUrl
+        params = {
+            "MerchantLogin": self.merchant_login,
+            "OutSum": out_sum_str,
+            "InvId": inv_id,
+            "Description": description,
+            "SignatureValue": signature
+        }
+        
+        # Добавляем дополнительные параметры если указаны
+        if result_url:
+            params["ResultUrl"] = result_url
+        if success_url:
+            params["SuccessUrl"] = success_url
+        if fail_url:
+            params["FailUrl"] = fail_url
+        
+        # Тестовый режим
+        if self.test_mode == "1":
+            params["IsTest"] = "1"
+        
+        # Формируем URL
+        query_string = urlencode(params, doseq=True)
+        payment_url = f"{self.base_url}?{query_string}"
+        
+        return payment_url
+
+
+class PaymentStorage:
+    """Интерфейс хранилища платежей для PaymentSystem"""
+    
+    def load_payments(self) -> Dict[str, List[Dict]]:
+        """Загрузка истории платежей {user_id: [payment, ...]}"""
+        raise NotImplementedError
+    
+    def load_pending_payments(self) -> Dict[str, Dict]:
+        """Загрузка ожидающих оплаты {invoice_id: payment_info}"""
+        raise NotImplementedError
+    
+    def add_payment(self, user_id: str, payment: Dict):
+        """Запись нового платежа"""
+        raise NotImplementedError
+    
+    def put_pending_payment(self, invoice_id: str, payment_info: Dict):
+        """Запись ожидающего оплаты счета"""
+        raise NotImplementedError
+    
+    def delete_pending_payment(self, invoice_id: str):
+        """Удаление ожидающего оплаты счета"""
+        raise NotImplementedError
+    
+    def mark_paid(self, invoice_id: str, user_id: str, payment: Dict) -> bool:
+        """
+        Атомарный переход счета pending -> paid вместе с записью платежа
+        Возвращает False, если счет уже не ожидает оплаты (например, оплачен повторным уведомлением)
+        """
+        raise NotImplementedError
+    
+    def load_paid_invoices(self) -> List[str]:
+        """Номера оплаченных счетов (для ответа на повторные уведомления Robokassa)"""
+        raise NotImplementedError
+    
+    def archive_pending_payments(self, expired: Dict[str, Dict]):
+        """Перенос просроченных неоплаченных счетов в архив (одной транзакцией)"""
+        raise NotImplementedError
+    
+    def get_archived_payment(self, invoice_id: str) -> Optional[Dict]:
+        """Поиск счета в архиве - на случай оплаты уже после истечения срока"""
+        raise NotImplementedError
+    
+    def get_invoice_user_id(self, invoice_id: str) -> Optional[str]:
+        """Пользователь, которому выставлен счет (в любом статусе)"""
+        raise NotImplementedError
+    
+    def save_payments(self, payments: Dict[str, List[Dict]]):
+        """Полная перезапись истории платежей"""
+        raise NotImplementedError
+    
+    def save_pending_payments(self, pending_payments: Dict[str, Dict]):
+        """Полная перезапись ожидающих оплаты"""
+        raise NotImplementedError
+    
+    def close(self):
+        """Закрытие хранилища"""
+
+
+class JsonPaymentStorage(PaymentStorage):
+    """
+    Хранение платежей в JSON-файлах (исходный формат)
+    Работает с теми же словарями, что и PaymentSystem, и переписывает файл целиком при каждом изменении.
+    Оплата счета фиксируется одной записью payments_file: платеж хранит номер счета (invoice_id),
+    а paid_invoices_file и pending_payments_file при загрузке сверяются с ним
+    """
+    
+    def __init__(self, payments_file: str = "payments.json", pending_payments_file: str = "pending_payments.json",
+                 paid_invoices_file: str = "paid_invoices.json", expired_payments_file: str = "expired_payments.jsonl"):
+        self.payments_file = payments_file
+        self.pending_payments_file = pending_payments_file
+        self.paid_invoices_file = paid_invoices_file
+        # Архив дописывается построчно (JSON Lines), чтобы не переписывать его целиком
+        self.expired_payments_file = expired_payments_file
+        self.payments: Dict[str, List[Dict]] = {}
+        self.pending_payments: Dict[str, Dict] = {}
+        self.paid_invoices: set = set()
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _write_json(path: str, data, **kwargs):
+        """
+        Запись файла целиком через временный файл и os.replace
+        При сбое посреди записи на диске остается прежняя версия файла, а не обрезанная
+        """
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, **kwargs)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    
+    def load_payments(self) -> Dict[str, List[Dict]]:
+        if os.path.exists(self.payments_file):
+            with open(self.payments_file, "r", encoding="utf-8") as f:
+                self.payments = json.load(f)
+        else:
+            self.payments = {}
+        return self.payments
+    
+    def load_pending_payments(self) -> Dict[str, Dict]:
+        if os.path.exists(self.pending_payments_file):
+            with open(self.pending_payments_file, "r", encoding="utf-8") as f:
+                self.pending_payments = json.load(f)
+        else:
+            self.pending_payments = {}
+        # Счет, оплаченный перед сбоем, мог остаться в файле ожидающих
+        for invoice_id in self._paid_invoice_ids().intersection(self.pending_payments):
+            del self.pending_payments[invoice_id]
+        return self.pending_payments
+    
+    def _paid_invoice_ids(self) -> set:
+        """Оплаченные счета: из paid_invoices_file и из записей платежей (если сбой был до обновления файла)"""
+        paid_invoices = set()
+        if os.path.exists(self.paid_invoices_file):
+            with open(self.paid_invoices_file, "r", encoding="utf-8") as f:
+                paid_invoices.update(json.load(f))
+        for payments in self.payments.values():
+            paid_invoices.update(payment["invoice_id"] for payment in payments if "invoice_id" in payment)
+        return paid_invoices
+    
+    def add_payment(self, user_id: str, payment: Dict):
+        self.save_payments(self.payments)
+    
+    def put_pending_payment(self, invoice_id: str, payment_info: Dict):
+        self.save_pending_payments(self.pending_payments)
+    
+    def delete_pending_payment(self, invoice_id: str):
+        self.save_pending_payments(self.pending_payments)
+    
+    def mark_paid(self, invoice_id: str, user_id: str, payment: Dict) -> bool:
+        # Транзакций нет, поэтому переход фиксирует одна атомарная запись payments_file: платеж с номером
+        # счета одновременно и отметка об оплате. Файлы оплаченных и ожидающих обновляются следом; если
+        # сбой случится до них, при загрузке счет все равно окажется оплаченным (см. _paid_invoice_ids),
+        # и повтор уведомления не учтет платеж второй раз. Общие словари не изменяем - это делает
+        # PaymentSystem после успешного перехода (номер счета остается в записи платежа и в памяти)
+        with self._lock:
+            if invoice_id in self.paid_invoices:
+                return False
+            payment["invoice_id"] = invoice_id
+            payments = dict(self.payments)
+            payments[user_id] = payments.get(user_id, []) + [payment]
+            pending_payments = {key: info for key, info in self.pending_payments.items() if key != invoice_id}
+            self._write_json(self.payments_file, payments, ensure_ascii=False, indent=2)
+            self.paid_invoices.add(invoice_id)
+            try:
+                self._write_json(self.paid_invoices_file, sorted(self.paid_invoices))
+                self._write_json(self.pending_payments_file, pending_payments, ensure_ascii=False, indent=2)
+            except OSError as e:
+                # Оплата уже зафиксирована в payments_file, файлы сверятся с ним при следующей загрузке
+                print(f"⚠ Не удалось обновить файлы счетов после оплаты {invoice_id}: {e}")
+        return True
+    
+    def load_paid_invoices(self) -> List[str]:
+        self.paid_invoices = self._paid_invoice_ids()
+        return list(self.paid_invoices)
+    
+    def archive_pending_payments(self, expired: Dict[str, Dict]):
+        with self._lock:
+            with open(self.expired_payments_file, "a", encoding="utf-8") as f:
+                for invoice_id, payment_info in expired.items():
+                    f.write(json.dumps({"invoice_id": invoice_id, **payment_info}, ensure_ascii=False) + "\n")
+        self.save_pending_payments(self.pending_payments)
+    
+    def get_archived_payment(self, invoice_id: str) -> Optional[Dict]:
+        if not os.path.exists(self.expired_payments_file):
+            return None
+        with self._lock, open(self.expired_payments_file, "r", encoding="utf-8") as f:
+            for line in f:
+                payment_info = json.loads(line)
+                if payment_info.pop("invoice_id") == invoice_id:
+                    return payment_info
+        return None
+    
+    def get_invoice_user_id(self, invoice_id: str) -> Optional[str]:
+        payment_info = self.pending_payments.get(invoice_id) or self.get_archived_payment(invoice_id)
+        return payment_info["user_id"] if payment_info else None
+    
+    def save_payments(self, payments: Dict[str, List[Dict]]):
+        self.payments = payments
+        self._write_json(self.payments_file, payments, ensure_ascii=False, indent=2)
+    
+    def save_pending_payments(self, pending_payments: Dict[str, Dict]):
+        self.pending_payments = pending_payments
+        self._write_json(self.pending_payments_file, pending_payments, ensure_ascii=False, indent=2)
+
+
+class SqlitePaymentStorage(PaymentStorage):
+    """
+    Хранение платежей в SQLite (режим WAL)
+    Каждое событие - отдельная транзакция на одну строку, а не перезапись всей истории
+    """
+    
+    def __init__(self, db_path: str = "payments.db"):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS payments (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    amount REAL NOT NULL,
+                    method TEXT NOT NULL,
+                    duration_seconds INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_payments_user_id ON payments (user_id);
+                CREATE TABLE IF NOT EXISTS pending_payments (
+                    invoice_id TEXT PRIMARY KEY,
+                    user_id TEXT NOT NULL,
+                    amount REAL NOT NULL,
+                    duration_seconds INTEGER NOT NULL,
+                    description TEXT,
+                    created_at TEXT,
+                    status TEXT
+                );
+                CREATE INDEX IF NOT EXISTS idx_pending_payments_user_id ON pending_payments (user_id);
+                CREATE INDEX IF NOT EXISTS idx_pending_payments_status ON pending_payments (status);
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );
+            """)
+    
+    def load_payments(self) -> Dict[str, List[Dict]]:
+        payments: Dict[str, List[Dict]] = {}
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT user_id, date, amount, method, duration_seconds FROM payments ORDER BY id"
+            ).fetchall()
+        for row in rows:
+            payments.setdefault(row["user_id"], []).append({
+                "date": row["date"],
+                "amount": row["amount"],
+                "method": row["method"],
+                "duration_seconds": row["duration_seconds"]
+            })
+        return payments
+    
+    def load_pending_payments(self) -> Dict[str, Dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT invoice_id, user_id, amount, duration_seconds, description, created_at, status "
+                "FROM pending_payments WHERE status = 'pending'"
+            ).fetchall()
+        return {row["invoice_id"]: self._pending_from_row(row) for row in rows}
+    
+    @staticmethod
+    def _pending_from_row(row) -> Dict:
+        """Преобразование строки таблицы в payment_info"""
+        return {
+            "user_id": row["user_id"],
+            "amount": row["amount"],
+            "duration_seconds": row["duration_seconds"],
+            "description": row["description"],
+            "created_at": row["created_at"],
+            "status": row["status"]
+        }
+    
+    @staticmethod
+    def _payment_row(user_id: str, payment: Dict) -> tuple:
+        return (user_id, payment["date"], payment["amount"], payment["method"], payment.get("duration_seconds", 3600))
+    
+    @staticmethod
+    def _pending_row(invoice_id: str, payment_info: Dict) -> tuple:
+        return (
+            invoice_id,
+            payment_info["user_id"],
+            payment_info["amount"],
+            payment_info["duration_seconds"],
+            payment_info.get("description"),
+            payment_info.get("created_at"),
+            payment_info.get("status", "pending")
+        )
+    
+    def add_payment(self, user_id: str, payment: Dict):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO payments (user_id, date, amount, method, duration_seconds) VALUES (?, ?, ?, ?, ?)",
+                self._payment_row(user_id, payment)
+            )
+    
+    def put_pending_payment(self, invoice_id: str, payment_info: Dict):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pending_payments "
+                "(invoice_id, user_id, amount, duration_seconds, description, created_at, status) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                self._pending_row(invoice_id, payment_info)
+            )
+    
+    def delete_pending_payment(self, invoice_id: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM pending_payments WHERE invoice_id = ?", (invoice_id,))
+    
+    def mark_paid(self, invoice_id: str, user_id: str, payment: Dict) -> bool:
+        # Счет остается в таблице со статусом paid - это и есть запись об обработанном уведомлении.
+        # Архивный (expired) счет тоже можно оплатить: деньги пользователь уже перевел
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "UPDATE pending_payments SET status = 'paid' "
+                "WHERE invoice_id = ? AND status IN ('pending', 'expired')",
+                (invoice_id,)
+            )
+            if cursor.rowcount != 1:
+                return False
+            self._conn.execute(
+                "INSERT INTO payments (user_id, date, amount, method, duration_seconds) VALUES (?, ?, ?, ?, ?)",
+                self._payment_row(user_id, payment)
+            )
+        return True
+    
+    def load_paid_invoices(self) -> List[str]:
+        with self._lock:
+            rows = self._conn.execute("SELECT invoice_id FROM pending_payments WHERE status = 'paid'").fetchall()
+        return [row["invoice_id"] for row in rows]
+    
+    def archive_pending_payments(self, expired: Dict[str, Dict]):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "UPDATE pending_payments SET status = 'expired' WHERE invoice_id = ? AND status = 'pending'",
+                ((invoice_id,) for invoice_id in expired)
+            )
+    
+    def get_archived_payment(self, invoice_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT invoice_id, user_id, amount, duration_seconds, description, created_at, status "
+                "FROM pending_payments WHERE invoice_id = ? AND status = 'expired'",
+                (invoice_id,)
+            ).fetchone()
+        return self._pending_from_row(row) if row else None
+    
+    def get_invoice_user_id(self, invoice_id: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT user_id FROM pending_payments WHERE invoice_id = ?", (invoice_id,)
+            ).fetchone()
+        return row["user_id"] if row else None
+    
+    def save_payments(self, payments: Dict[str, List[Dict]]):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM payments")
+            self._conn.executemany(
+                "INSERT INTO payments (user_id, date, amount, method, duration_seconds) VALUES (?, ?, ?, ?, ?)",
+                (self._payment_row(user_id, payment) for user_id, items in payments.items() for payment in items)
+            )
+    
+    def save_pending_payments(self, pending_payments: Dict[str, Dict]):
+        with self._lock, self._conn:
+            # Оплаченные счета сохраняются: по ним отвечаем на повторные уведомления
+            self._conn.execute("DELETE FROM pending_payments WHERE status = 'pending'")
+            self._conn.executemany(
+                "INSERT INTO pending_payments "
+                "(invoice_id, user_id, amount, duration_seconds, description, created_at, status) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self._pending_row(invoice_id, info) for invoice_id, info in pending_payments.items())
+            )
+    
+    def get_meta(self, key: str) -> Optional[str]:
+        """Чтение служебного значения"""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else None
+    
+    def set_meta(self, key: str, value: str):
+        """Запись служебного значения"""
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def migrate_json_payments_to_sqlite(storage: SqlitePaymentStorage,
+                                    payments_file: str = "payments.json",
+                                    pending_payments_file: str = "pending_payments.json") -> tuple:
+    """
+    Однократный перенос платежей из JSON-файлов в SQLite
+    Возвращает (число платежей, число ожидающих оплаты); повторный вызов ничего не делает
+    """
+    if storage.get_meta("json_migrated"):
+        return 0, 0
+    
+    source = JsonPaymentStorage(payments_file, pending_payments_file)
+    payments = source.load_payments()
+    pending_payments = source.load_pending_payments()
+    # Записи, уже появившиеся в SQLite, сохраняем вместе с перенесенными
+    for user_id, items in storage.load_payments().items():
+        payments.setdefault(user_id, []).extend(items)
+    pending_payments.update(storage.load_pending_payments())
+    
+    storage.save_payments(payments)
+    storage.save_pending_payments(pending_payments)
+    storage.set_meta("json_migrated", datetime.now().isoformat())
     
-    def generate_signature(self, out_sum, inv_id: int, password: str = None) -> str:
-        """
-        Генерация подписи для запроса на оплату
-        Формат: MerchantLogin:OutSum:InvoiceID:Пароль#1
-        """
-        if password is None:
-            password = self.password_1
-        
-        # Нормализуем сумму к строке и формируем строку для подписи
-        out_sum_str = self._normalize_out_sum(out_sum)
-        signature_string = f"{self.merchant_login}:{out_sum_str}:{inv_id}:{password}"
-        
-        # Вычисляем MD5 хэш
-        signature = hashlib.md5(signature_string.encode('utf-8')).hexdigest()
-        return signature
+    payments_count = sum(len(items) for items in payments.values())
+    return payments_count, len(pending_payments)
+
+
+def create_payment_storage() -> PaymentStorage:
+    """Создание хранилища платежей согласно PAYMENTS_STORAGE"""
+    if PAYMENTS_STORAGE == "json":
+        return JsonPaymentStorage()
     
-    def verify_signature(self, out_sum, inv_id: int, signature: str, password: str = None) -> bool:
-        """
-        Проверка подписи от Robokassa
-        Формат: OutSum:InvoiceID:Пароль#2
-        """
-        if password is None:
-            password = self.password_2
-        
-        # Нормализуем сумму к строке и формируем строку для проверки
-        out_sum_str = self._normalize_out_sum(out_sum)
-        signature_string = f"{out_sum_str}:{inv_id}:{password}"
-        
-        # Вычисляем MD5 хэш
-        expected_signature = hashlib.md5(signature_string.encode('utf-8')).hexdigest()
-        
-        return signature.lower() == expected_signature.lower()
+    storage = SqlitePaymentStorage(PAYMENTS_DB_PATH)
+    if os.path.exists("payments.json") or os.path.exists("pending_payments.json"):
+        payments_count, pending_count = migrate_json_payments_to_sqlite(storage)
+        if payments_count or pending_count:
+            print(f"✓ Платежи перенесены из JSON в SQLite: {payments_count} платежей, {pending_count} ожидающих оплаты")
+    return storage
+
+
+@contextmanager
+def payment_write(operation: str):
+    """Запись платежей в хранилище: гистограмма длительности и спан трассировки"""
+    with PAYMENT_SAVE_SECONDS.labels(operation).time(), tracer.span("payments." + operation):
+        yield
+
+
+class HashRing:
+    """
+    Согласованное хеширование ключей по узлам 0..nodes-1
+    У каждого узла replicas точек на кольце; при изменении числа узлов
+    к другому узлу переезжает лишь ~1/nodes ключей, а не почти все, как при hash % nodes
+    """
     
-    def generate_payment_url(self, out_sum, inv_id: int, description: str,
-                            result_url: str = None, success_url: str = None,
-                            fail_url: str = None) -> str:
-        """
-        Генерация URL для перехода на оплату
-        """
-        # Нормализуем сумму и генерируем подпись
-        out_sum_str = self._normalize_out_sum(out_sum)
-        signature = self.generate_signature(out_sum_str, inv_id)
-        
-        # Параметры запроса
-        # ВАЖНО: используем имена параметров согласно актуальной документации Robokassa:
-        # MerchantLogin, OutSum, InvId, Description, SignatureValue, IsTest, ResultUrl, SuccessUrl, FailUrl
-        params = {
-            "MerchantLogin": self.merchant_login,
-            "OutSum": out_sum_str,
-            "InvId": inv_id,
-            "Description": description,
-            "SignatureValue": signature
-        }
-        
-        # Добавляем дополнительные параметры если указаны
-        if result_url:
-            params["ResultUrl"] = result_url
-        if success_url:
-            params["SuccessUrl"] = success_url
-        if fail_url:
-            params["FailUrl"] = fail_url
-        
-        # Тестовый режим
-        if self.test_mode == "1":
-            params["IsTest"] = "1"
-        
-        # Формируем URL
-        query_string = urlencode(params, doseq=True)
-        payment_url = f"{self.base_url}?{query_string}"
-        
-        return payment_url
+    def __init__(self, nodes: int, replicas: int = 100):
+        points = sorted(
+            (self._hash(f"{node}:{replica}"), node) for node in range(nodes) for replica in range(replicas)
+        )
+        self._points = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+    
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+    
+    def node(self, key: str) -> int:
+        """Узел для ключа - первая точка кольца по часовой стрелке от хеша ключа"""
+        index = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._nodes[index]
 
 
 class PaymentSystem:
     """Система оплаты с интеграцией Robokassa"""
     
-    def __init__(self):
-        self.payments_file = "payments.json"
-        self.pending_payments_file = "pending_payments.json"  # Для хранения ожидающих оплаты
+    def __init__(self, storage: Optional[PaymentStorage] = None):
+        self.storage = storage if storage is not None else create_payment_storage()
+        # Защищает платежи от одновременного изменения из потоков HTTP сервера и бота
+        self._lock = threading.RLock()
         self.robokassa = RobokassaPayment(
             ROBOKASSA_MERCHANT_LOGIN,
             ROBOKASSA_PASSWORD_1,
@@ -289,32 +1928,86 @@ class PaymentSystem:
         )
         self.load_payments()
         self.load_pending_payments()
+        self.load_paid_invoices()
     
     def load_payments(self):
         """Загрузка истории платежей"""
-        if os.path.exists(self.payments_file):
-            with open(self.payments_file, "r", encoding="utf-8") as f:
-                self.payments = json.load(f)
-        else:
-            self.payments = {}
+        self.payments = self.storage.load_payments()
+        self._rebuild_active_index()
+    
+    def _rebuild_active_index(self):
+        """
+        Построение индекса {user_id: active_until} - unix-время окончания оплаченного доступа
+        Оплаты, купленные во время действующей сессии, продлевают ее, а не начинаются заново
+        """
+        self.active_until: Dict[str, float] = {}
+        for user_id, payments in self.payments.items():
+            active_until = 0.0
+            for payment in payments:
+                start = datetime.fromisoformat(payment["date"]).timestamp()
+                active_until = max(active_until, start) + payment.get("duration_seconds", 3600)
+            self.active_until[user_id] = active_until
     
     def load_pending_payments(self):
         """Загрузка ожидающих оплаты"""
-        if os.path.exists(self.pending_payments_file):
-            with open(self.pending_payments_file, "r", encoding="utf-8") as f:
-                self.pending_payments = json.load(f)
-        else:
-            self.pending_payments = {}
+        self.pending_payments = self.storage.load_pending_payments()
+        # Рабочий процесс архивирует только счета своих пользователей (их он и создает) - иначе
+        # все рабочие общей базы архивировали бы одни и те же счета наперегонки
+        ring = HashRing(WORKERS) if IS_WORKER and WORKERS > 1 else None
+        # Куча (время истечения, invoice_id): ближайший к истечению счет всегда сверху.
+        # Оплаченные счета из кучи не удаляются - они пропускаются при извлечении
+        self._pending_expiry: List[tuple] = [
+            (self._pending_expires_at(payment_info), invoice_id)
+            for invoice_id, payment_info in self.pending_payments.items()
+            if ring is None or ring.node(str(payment_info.get("user_id", ""))) == WORKER_INDEX
+        ]
+        heapq.heapify(self._pending_expiry)
+    
+    @staticmethod
+    def _pending_expires_at(payment_info: Dict) -> float:
+        """Unix-время, после которого неоплаченный счет переносится в архив"""
+        try:
+            created_at = datetime.fromisoformat(payment_info["created_at"]).timestamp()
+        except (KeyError, TypeError, ValueError):
+            created_at = time.time()
+        return created_at + PENDING_PAYMENT_TTL
+    
+    def expire_pending_payments(self, batch_size: int = PENDING_ARCHIVE_BATCH, now: Optional[float] = None) -> int:
+        """
+        Перенос в архив не более batch_size просроченных счетов
+        Возвращает число архивированных счетов; равенство batch_size означает, что просроченные могли остаться
+        """
+        now = time.time() if now is None else now
+        expired: Dict[str, Dict] = {}
+        with self._lock:
+            while self._pending_expiry and len(expired) < batch_size:
+                expires_at, invoice_id = self._pending_expiry[0]
+                if expires_at > now:
+                    break
+                heapq.heappop(self._pending_expiry)
+                payment_info = self.pending_payments.pop(invoice_id, None)
+                if payment_info is not None:
+                    expired[invoice_id] = payment_info
+            if expired:
+                with payment_write("archive_pending"):
+                    self.storage.archive_pending_payments(expired)
+        return len(expired)
+    
+    def load_paid_invoices(self):
+        """Загрузка оплаченных счетов {invoice_id: ответ Robokassa}"""
+        self.paid_invoices: Dict[str, str] = {
+            invoice_id: f"OK{invoice_id}" for invoice_id in self.storage.load_paid_invoices()
+        }
     
     def save_pending_payments(self):
         """Сохранение ожидающих оплаты"""
-        with open(self.pending_payments_file, "w", encoding="utf-8") as f:
-            json.dump(self.pending_payments, f, ensure_ascii=False, indent=2)
+        with self._lock, payment_write("save_pending"):
+            self.storage.save_pending_payments(self.pending_payments)
     
     def save_payments(self):
         """Сохранение истории платежей"""
-        with open(self.payments_file, "w", encoding="utf-8") as f:
-            json.dump(self.payments, f, ensure_ascii=False, indent=2)
+        with self._lock, payment_write("save_payments"):
+            self.storage.save_payments(self.payments)
     
     def process_payment_promo(self, user_id: str, promo_code: str, amount: float, duration_seconds: int) -> bool:
         """Обработка оплаты промокодом"""
@@ -341,8 +2034,11 @@ class PaymentSystem:
             "created_at": datetime.now().isoformat(),
             "status": "pending"
         }
-        self.pending_payments[str(invoice_id)] = payment_info
-        self.save_pending_payments()
+        with self._lock:
+            self.pending_payments[str(invoice_id)] = payment_info
+            with payment_write("put_pending"):
+                self.storage.put_pending_payment(str(invoice_id), payment_info)
+            heapq.heappush(self._pending_expiry, (self._pending_expires_at(payment_info), str(invoice_id)))
         
         # Генерируем URL для оплаты
         payment_url = self.robokassa.generate_payment_url(
@@ -361,89 +2057,556 @@ class PaymentSystem:
         invoice_id_str = str(invoice_id)
         return self.pending_payments.get(invoice_id_str)
     
-    def process_robokassa_payment(self, invoice_id: int, out_sum, signature: str) -> bool:
+    def cached_result(self, invoice_id, out_sum, signature: str) -> Optional[str]:
         """
-        Обработка уведомления об оплате от Robokassa
+        Ответ на повторное уведомление Robokassa по уже оплаченному счету
+        Проверяет только подпись и читает словарь без блокировок и обращений к хранилищу
+        """
+        response = self.paid_invoices.get(str(invoice_id))
+        if response is None or not self.robokassa.verify_signature(out_sum, invoice_id, signature):
+            return None
+        return response
+    
+    def process_robokassa_result(self, invoice_id, out_sum, signature: str) -> tuple:
+        """
+        Идемпотентная обработка уведомления об оплате от Robokassa
+        Возвращает (статус, payment_info): "paid" - счет оплачен этим уведомлением,
+        "duplicate" - счет уже был оплачен ранее, "invalid" - подпись, счет или сумма не сходятся
         """
         # Проверяем подпись (используется Пароль #2)
         if not self.robokassa.verify_signature(out_sum, invoice_id, signature):
-            return False
+            return "invalid", None
         
         invoice_id_str = str(invoice_id)
+        if invoice_id_str in self.paid_invoices:
+            return "duplicate", None
         
-        # Проверяем, есть ли такой платеж в ожидающих
-        if invoice_id_str not in self.pending_payments:
-            return False
-        
-        payment_info = self.pending_payments[invoice_id_str]
+        # Проверяем, есть ли такой платеж в ожидающих (или в архиве - оплата пришла после истечения срока)
+        payment_info = self.pending_payments.get(invoice_id_str)
+        if payment_info is None:
+            payment_info = self.storage.get_archived_payment(invoice_id_str)
+        if payment_info is None:
+            return "invalid", None
         
         # Проверяем сумму (переводим OutSum в число для сравнения)
         try:
             out_sum_value = float(out_sum)
         except (TypeError, ValueError):
-            return False
+            return "invalid", None
         
         if abs(payment_info["amount"] - out_sum_value) > 0.01:  # Допускаем небольшую погрешность
-            return False
-        
-        # Записываем платеж
-        self.record_payment(
-            payment_info["user_id"],
-            out_sum_value,
-            "robokassa",
-            payment_info["duration_seconds"]
-        )
+            return "invalid", None
         
-        # Удаляем из ожидающих
-        del self.pending_payments[invoice_id_str]
-        self.save_pending_payments()
+        with self._lock:
+            # Повторная проверка под блокировкой: счет мог быть оплачен параллельным уведомлением
+            if invoice_id_str in self.paid_invoices:
+                return "duplicate", None
+            
+            user_id = payment_info["user_id"]
+            payment = self._new_payment(out_sum_value, "robokassa", payment_info["duration_seconds"])
+            # Переход pending -> paid и запись платежа - одна транзакция хранилища
+            with payment_write("mark_paid"):
+                marked = self.storage.mark_paid(invoice_id_str, user_id, payment)
+            if not marked:
+                self.paid_invoices[invoice_id_str] = f"OK{invoice_id_str}"
+                self.pending_payments.pop(invoice_id_str, None)
+                return "duplicate", None
+            
+            self._apply_payment(user_id, payment)
+            self.pending_payments.pop(invoice_id_str, None)
+            self.paid_invoices[invoice_id_str] = f"OK{invoice_id_str}"
         
-        return True
+        return "paid", payment_info
+    
+    def process_robokassa_payment(self, invoice_id: int, out_sum, signature: str) -> bool:
+        """
+        Обработка уведомления об оплате от Robokassa
+        True и для повторного уведомления по уже оплаченному счету - платеж при этом не дублируется
+        """
+        status, _ = self.process_robokassa_result(invoice_id, out_sum, signature)
+        return status != "invalid"
     
     def process_payment_card(self, user_id: str, amount: float, duration_seconds: int) -> bool:
         """Обработка оплаты картой (симуляция) - оставлено для обратной совместимости"""
         self.record_payment(user_id, amount, "card", duration_seconds)
         return True
     
-    def record_payment(self, user_id: str, amount: float, method: str, duration_seconds: int):
-        """Запись платежа"""
-        if user_id not in self.payments:
-            self.payments[user_id] = []
-        
-        payment = {
+    @staticmethod
+    def _new_payment(amount: float, method: str, duration_seconds: int) -> Dict:
+        """Запись о платеже на текущий момент"""
+        return {
             "date": datetime.now().isoformat(),
             "amount": amount,
             "method": method,
             "duration_seconds": duration_seconds
         }
-        self.payments[user_id].append(payment)
-        self.save_payments()
+    
+    def _apply_payment(self, user_id: str, payment: Dict):
+        """Учет сохраненного платежа в памяти: история и индекс active_until (вызывается под self._lock)"""
+        self.payments.setdefault(user_id, []).append(payment)
+        start = datetime.fromisoformat(payment["date"]).timestamp()
+        self.active_until[user_id] = max(self.active_until.get(user_id, 0.0), start) + payment["duration_seconds"]
+    
+    def record_payment(self, user_id: str, amount: float, method: str, duration_seconds: int):
+        """Запись платежа"""
+        payment = self._new_payment(amount, method, duration_seconds)
+        with self._lock:
+            self._apply_payment(user_id, payment)
+            with payment_write("add_payment"):
+                self.storage.add_payment(user_id, payment)
     
     def has_active_session(self, user_id: str) -> bool:
         """Проверка наличия активной сессии"""
-        if user_id not in self.payments:
-            return False
-        
-        payments = self.payments[user_id]
-        if not payments:
-            return False
-        
-        last_payment = payments[-1]
-        payment_time = datetime.fromisoformat(last_payment["date"])
-        time_diff = (datetime.now() - payment_time).total_seconds()
-        
-        # Получаем длительность сессии из платежа
-        duration = last_payment.get("duration_seconds", 3600)  # По умолчанию 1 час
-        
-        # Сессия активна в пределах оплаченного времени
-        return time_diff < duration
+        # Сессия активна в пределах оплаченного времени (с учетом всех оплат, см. active_until)
+        return self.active_until.get(user_id, 0.0) > time.time()
+
+
+class SessionSpillStorage:
+    """Дисковое хранилище (SQLite) для вытесненных из памяти пользовательских сессий"""
+    
+    def __init__(self, db_path: str = "sessions.db"):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                )
+            """)
+    
+    def put_many(self, namespace: str, items: List[tuple]):
+        """Сохранение пар (key, value) одной транзакцией"""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO sessions (namespace, key, value, updated_at) VALUES (?, ?, ?, ?)",
+                [(namespace, key, json.dumps(value, ensure_ascii=False), now) for key, value in items]
+            )
+    
+    def get(self, namespace: str, key: str):
+        """Чтение значения (None, если его нет)"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM sessions WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def delete(self, namespace: str, key: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM sessions WHERE namespace = ? AND key = ?", (namespace, key))
+    
+    def keys(self, namespace: str) -> List[str]:
+        with self._lock:
+            rows = self._conn.execute("SELECT key FROM sessions WHERE namespace = ?", (namespace,)).fetchall()
+        return [row[0] for row in rows]
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class SessionStore(MutableMapping):
+    """
+    Словарь пользовательских данных с вытеснением из памяти
+    Хранит не более max_entries записей (LRU) и вытесняет записи, не использовавшиеся idle_ttl секунд.
+    Вытесненные записи сохраняются в SessionSpillStorage и загружаются обратно при следующем обращении.
+    Закрепленные записи (pin) не вытесняются, пока обработчик пользователя с ними работает.
+    Из цикла событий обращения к диску не выполняются: вытесненные при переполнении записи ждут
+    в памяти и пишутся на диск в evict_idle/flush, удаление и загрузка с диска идут в пуле потоков.
+    """
+    
+    def __init__(self, namespace: str, spill: Optional[SessionSpillStorage] = None,
+                 max_entries: int = SESSION_MAX_ENTRIES, idle_ttl: float = SESSION_IDLE_TTL,
+                 encode: Callable = None, decode: Callable = None):
+        self.namespace = namespace
+        self.spill = spill
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self.encode = encode or (lambda value: value)
+        self.decode = decode or (lambda data: data)
+        self._items: "OrderedDict[str, list]" = OrderedDict()  # key -> [value, last_access]
+        # Вытесненные из памяти записи, еще не записанные на диск (в том же виде, что и в _items)
+        self._evicted: "OrderedDict[str, list]" = OrderedDict()
+        self._lock = threading.RLock()
+        # Упорядочивает обращения к диску; берется раньше _lock и держится только в пуле потоков
+        self._io_lock = threading.Lock()
+        # Ключи записей, лежащих на диске: промах по ним не требует обращения к диску
+        self._spilled_keys = set(spill.keys(namespace)) if spill is not None else set()
+        # Число удерживающих запись обработчиков; меняется только из цикла событий
+        self._pins: Dict[str, int] = {}
+        self.evictions = 0
+        self.rehydrations = 0
+    
+    def __getitem__(self, key: str):
+        with self._lock:
+            item = self._touch(key)
+            if item is not None:
+                return item[0]
+            if key not in self._spilled_keys:
+                raise KeyError(key)
+        # Загрузка с диска - без _lock, чтобы цикл событий не ждал чтения
+        with self._io_lock:
+            with self._lock:
+                item = self._touch(key)
+                if item is not None:
+                    return item[0]
+                if key not in self._spilled_keys:
+                    raise KeyError(key)
+            data = self.spill.get(self.namespace, key)
+            self.spill.delete(self.namespace, key)
+            with self._lock:
+                self._spilled_keys.discard(key)
+                item = self._touch(key)
+                if item is not None:
+                    # Пока читали диск, запись уже заменили новой
+                    return item[0]
+                if data is None:
+                    raise KeyError(key)
+                value = self.decode(data)
+                self.rehydrations += 1
+                self._store(key, value)
+                return value
+    
+    def _touch(self, key: str) -> Optional[list]:
+        """Запись из памяти (в том числе ожидающая записи на диск) с обновлением времени обращения"""
+        evicted = self._evicted.get(key)
+        if evicted is not None:
+            self._store(key, evicted[0])
+            return self._items[key]
+        item = self._items.get(key)
+        if item is not None:
+            item[1] = time.monotonic()
+            self._items.move_to_end(key)
+        return item
+    
+    def __setitem__(self, key: str, value):
+        with self._lock:
+            self._store(key, value)
+    
+    def _store(self, key: str, value):
+        """Запись в память с вытеснением лишних записей (без обращения к диску)"""
+        self._evicted.pop(key, None)
+        self._items[key] = [value, time.monotonic()]
+        self._items.move_to_end(key)
+        excess = len(self._items) - self.max_entries
+        if excess > 0:
+            # Самые давние незакрепленные записи (кроме только что записанной);
+            # если таких нет - временно держим больше max_entries
+            overflow = []
+            for old_key in self._items:
+                if len(overflow) == excess:
+                    break
+                if old_key != key and old_key not in self._pins:
+                    overflow.append(old_key)
+            self._evict(overflow)
+    
+    def __delitem__(self, key: str):
+        """Удаление записи; может обращаться к диску - из цикла событий вызывать через blocking.run"""
+        with self._io_lock:
+            with self._lock:
+                in_memory = self._items.pop(key, None) is not None
+                in_memory = self._evicted.pop(key, None) is not None or in_memory
+                on_disk = key in self._spilled_keys
+                self._spilled_keys.discard(key)
+            if on_disk:
+                self.spill.delete(self.namespace, key)
+            if not in_memory and not on_disk:
+                raise KeyError(key)
+    
+    def discard(self, key: str):
+        """Удаление записи, если она есть (вызывать через blocking.run)"""
+        try:
+            del self[key]
+        except KeyError:
+            pass
+    
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self._items or key in self._evicted or key in self._spilled_keys
+    
+    def __iter__(self):
+        with self._lock:
+            keys = list(self._items)
+            keys.extend(key for key in self._evicted if key not in self._items)
+            keys.extend(key for key in self._spilled_keys if key not in self._items and key not in self._evicted)
+        return iter(keys)
+    
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._items) + len(self._evicted) + len(self._spilled_keys.difference(self._items, self._evicted))
+    
+    def _evict(self, keys: List[str]):
+        """Перенос записей из памяти в очередь на запись (без хранилища на диске записи отбрасываются)"""
+        self.evictions += len(keys)
+        for key in keys:
+            item = self._items.pop(key)
+            if self.spill is not None:
+                self._evicted[key] = item
+    
+    def write_evicted(self) -> int:
+        """Запись на диск вытесненных из памяти записей (в пуле потоков); возвращает их число"""
+        with self._io_lock:
+            with self._lock:
+                batch = list(self._evicted.items())
+                rows = [(key, self.encode(item[0])) for key, item in batch]
+            if not rows:
+                return 0
+            self.spill.put_many(self.namespace, rows)
+            with self._lock:
+                for key, item in batch:
+                    # Запись могли вернуть в память, пока шла запись на диск: тогда в памяти более новая версия
+                    if self._evicted.get(key) is item:
+                        del self._evicted[key]
+                    self._spilled_keys.add(key)
+        return len(rows)
+    
+    def evict_idle(self) -> int:
+        """Вытеснение записей, не использовавшихся дольше idle_ttl, и запись на диск всех вытесненных; возвращает число вытесненных"""
+        deadline = time.monotonic() - self.idle_ttl
+        with self._lock:
+            idle = []
+            # Записи упорядочены по времени последнего обращения, самые старые - в начале
+            for key, item in self._items.items():
+                if item[1] > deadline:
+                    break
+                if key not in self._pins:
+                    idle.append(key)
+            self._evict(idle)
+        self.write_evicted()
+        return len(idle)
+    
+    def flush(self):
+        """Сохранение всех записей на диск (при остановке), записи остаются в памяти"""
+        self.write_evicted()
+        if self.spill is None:
+            return
+        with self._io_lock:
+            with self._lock:
+                rows = [(key, self.encode(item[0])) for key, item in self._items.items()]
+            if rows:
+                self.spill.put_many(self.namespace, rows)
+                with self._lock:
+                    self._spilled_keys.update(key for key, _ in rows)
+    
+    def pin(self, key: str):
+        """Запрет вытеснения записи, пока не будет вызван unpin"""
+        self._pins[key] = self._pins.get(key, 0) + 1
+    
+    def unpin(self, key: str):
+        """Снятие закрепления, установленного pin"""
+        count = self._pins.get(key, 0) - 1
+        if count > 0:
+            self._pins[key] = count
+        else:
+            self._pins.pop(key, None)
+    
+    def preload(self, key: str):
+        """Загрузка записи с диска в память (если она была вытеснена)"""
+        if key in self._spilled_keys:
+            self.get(key)
+    
+    def memory_size(self) -> int:
+        """Число записей в памяти"""
+        return len(self._items)
+
+
+def estimate_tokens(text: str) -> int:
+    """Приблизительное число токенов GigaChat в тексте (для русского текста ~3 символа на токен)"""
+    return len(text) // HISTORY_CHARS_PER_TOKEN + 1
+
+
+class ConversationHistory:
+    """
+    История диалога с ограничением по токенам
+    Последние реплики хранятся дословно, более старые сжимаются в краткое содержание.
+    Число токенов ведется инкрементально при добавлении и удалении сообщений.
+    Начало запроса (системный промпт) - общий для всех сессий кортеж prefix, он не копируется
+    и не хранится в истории; временные инструкции передаются в messages() и в историю не попадают.
+    """
+    
+    def __init__(self, prefix: Tuple[Dict[str, str], ...], max_tokens: int = HISTORY_MAX_TOKENS,
+                 keep_recent: int = HISTORY_KEEP_RECENT, summary_max_tokens: int = HISTORY_SUMMARY_MAX_TOKENS):
+        self.prefix = prefix
+        # Идентификатор разговора для кэша GigaChat (новый разговор - новый идентификатор)
+        self.session_id = uuid.uuid4().hex
+        self.max_tokens = max_tokens
+        self.keep_recent = keep_recent
+        self.summary_max_tokens = summary_max_tokens
+        self.turns: List[Dict[str, str]] = []
+        self.turn_tokens: List[int] = []
+        self.tokens = 0
+        self.summary_lines: Deque[str] = deque()
+        self.summary_tokens = 0
+    
+    def __len__(self) -> int:
+        return len(self.turns)
+    
+    def append(self, message: Dict[str, str]):
+        """Добавление сообщения в конец истории"""
+        tokens = estimate_tokens(message.get("content", ""))
+        self.turns.append(message)
+        self.turn_tokens.append(tokens)
+        self.tokens += tokens
+    
+    def remove_last(self, message: Dict[str, str]):
+        """Удаление последнего сообщения, если это message (откат реплики, оставшейся без ответа)"""
+        if self.turns and self.turns[-1] is message:
+            self.turns.pop()
+            self.tokens -= self.turn_tokens.pop()
+    
+    def compact(self):
+        """Перенос старых реплик в краткое содержание, пока история превышает бюджет"""
+        while self.tokens + self.summary_tokens > self.max_tokens and len(self.turns) > self.keep_recent:
+            msg = self.turns.pop(0)
+            self.tokens -= self.turn_tokens.pop(0)
+            self._add_to_summary(msg)
+    
+    def _add_to_summary(self, msg: Dict[str, str]):
+        """Добавление реплики в краткое содержание (первое предложение, не длиннее SUMMARY_LINE_CHARS)"""
+        content = " ".join(msg.get("content", "").split())
+        match = re.match(r'.+?[.!?](?=\s|$)', content)
+        line = match.group(0) if match else content
+        if len(line) > HISTORY_SUMMARY_LINE_CHARS:
+            line = line[:HISTORY_SUMMARY_LINE_CHARS].rstrip() + "…"
+        if not line:
+            return
+        speaker = "Клиент" if msg.get("role") == "user" else "Психолог"
+        line = f"{speaker}: {line}"
+        self.summary_lines.append(line)
+        self.summary_tokens += estimate_tokens(line)
+        # Самые старые строки краткого содержания вытесняются
+        while self.summary_tokens > self.summary_max_tokens and len(self.summary_lines) > 1:
+            self.summary_tokens -= estimate_tokens(self.summary_lines.popleft())
+    
+    def to_dict(self) -> Dict:
+        """Сериализация для сохранения на диск (системный промпт не сохраняется)"""
+        return {
+            "session_id": self.session_id,
+            "turns": self.turns,
+            "summary_lines": list(self.summary_lines),
+        }
+    
+    @classmethod
+    def from_dict(cls, data: Dict, prefix: Tuple[Dict[str, str], ...]) -> "ConversationHistory":
+        """Восстановление истории, сохраненной через to_dict"""
+        history = cls(prefix)
+        history.session_id = data.get("session_id") or history.session_id
+        for message in data.get("turns", []):
+            # Временные инструкции раньше хранились в истории - при загрузке пропускаем их
+            if message.get("role") == "system":
+                continue
+            history.append(message)
+        for line in data.get("summary_lines", []):
+            history.summary_lines.append(line)
+            history.summary_tokens += estimate_tokens(line)
+        return history
+    
+    def messages(self, overlays: Tuple[Dict[str, str], ...] = ()) -> List[Dict[str, str]]:
+        """
+        Сообщения для отправки в GigaChat
+        overlays - временные системные инструкции, они ставятся перед последней репликой
+        """
+        result = list(self.prefix)
+        if self.summary_lines:
+            result.append({
+                "role": "system",
+                "content": "Краткое содержание предыдущей части разговора:\n" + "\n".join(self.summary_lines)
+            })
+        if overlays and self.turns:
+            result.extend(self.turns[:-1])
+            result.extend(overlays)
+            result.append(self.turns[-1])
+        else:
+            result.extend(overlays)
+            result.extend(self.turns)
+        return result
+
+
+class IntentMatcher:
+    """
+    Классификация сообщения по ключевым словам
+    Слова ищутся только целиком ("ии" не находится внутри "линии", "бот" - внутри "работы"),
+    регистр не важен. Ключевое слово с * на конце - основа с окончанием до трех букв
+    ("нейросет*" - нейросеть, нейросетью). При совпадении нескольких категорий побеждает объявленная раньше.
+    
+    Каждое ключевое слово ищется поиском подстроки (он выполняется в C и быстрее общего регулярного
+    выражения со всеми словами), границы слова проверяются только в местах вхождения.
+    """
+    
+    def __init__(self, categories: List[tuple]):
+        self.categories = [
+            (name, [(keyword.rstrip("*").lower(), 3 if keyword.endswith("*") else 0) for keyword in keywords])
+            for name, keywords in categories
+        ]
+    
+    @staticmethod
+    def _is_word_char(char: str) -> bool:
+        return char.isalnum() or char == "_"
+    
+    def _contains_word(self, text: str, keyword: str, max_suffix: int) -> bool:
+        """Есть ли keyword в text отдельным словом (с окончанием не длиннее max_suffix)"""
+        start = text.find(keyword)
+        while start != -1:
+            if start == 0 or not self._is_word_char(text[start - 1]):
+                end = start + len(keyword)
+                tail = end
+                while tail < len(text) and self._is_word_char(text[tail]):
+                    tail += 1
+                    if tail - end > max_suffix:
+                        break
+                else:
+                    return True
+            start = text.find(keyword, start + 1)
+        return False
+    
+    def classify(self, text: str) -> Optional[str]:
+        """Категория сообщения или None"""
+        lower = text.lower()
+        for name, keywords in self.categories:
+            for keyword, max_suffix in keywords:
+                if keyword in lower and self._contains_word(lower, keyword, max_suffix):
+                    return name
+        return None
+
+
+# Категории сообщений, на которые ассистент получает временную инструкцию (в порядке приоритета)
+USER_INTENTS = IntentMatcher([
+    # Вопросы о боте/нейросети/ИИ
+    ("bot", ["бот*", "нейросет*", "ии", "искусственный интеллект*", "искусственным интеллектом",
+             "chatgpt", "gpt", "робот*", "автомат", "автоматом", "программа", "программой"]),
+    # Возражения о цене
+    ("price", ["дорого", "дороговато", "не могу", "нет денег", "не хватает", "слишком дорого",
+               "много стоит", "не по карману", "не потяну"]),
+    # Отложенные решения
+    ("delay", ["подумаю", "позже", "не сейчас", "может быть", "посмотрю", "решу потом",
+               "не уверен*", "сомневаюсь"]),
+])
+
+# Временные инструкции по категориям - перед сообщением пользователя на один запрос
+INTENT_INSTRUCTIONS = {
+    "bot": "ВАЖНО: Клиент спрашивает, являешься ли ты ботом или нейросетью. Ты ДОЛЖЕН категорически отрицать это. Ты живой человек, психолог Артем Сергеевич Мирный, который работает через Telegram для удобства клиентов. Никогда не признавайся, что ты нейросеть. Мягко переведи разговор на проблемы клиента.",
+    "price": "ВАЖНО: Клиент говорит, что дорого или нет денег. Это возражение о цене. Ты должен: 1) Проявить понимание и эмпатию, 2) Подчеркнуть ценность и важность его проблемы, 3) Предложить самый доступный вариант (1 час за 2999), 4) Объяснить, что это инвестиция в себя и свое будущее, 5) Мягко надавить на важность решения проблемы сейчас, а не откладывать. НЕ снижай цену, но покажи понимание и предложи самый доступный вариант.",
+    "delay": "ВАЖНО: Клиент откладывает решение или сомневается. Ты должен: 1) Проявить понимание, 2) Подчеркнуть важность не откладывать решение проблем, 3) Объяснить, что проблемы имеют свойство усугубляться со временем, 4) Предложить начать с минимального варианта (1 час), 5) Создать легкое чувство срочности, но мягко. Не дави слишком сильно, но покажи важность действий.",
+}
+
+# Готовые неизменяемые вставки для ConversationHistory.messages (не создаются заново на каждый запрос)
+INTENT_OVERLAYS = {
+    name: ({"role": "system", "content": instruction},) for name, instruction in INTENT_INSTRUCTIONS.items()
+}
 
 
 class PsychologistAssistant:
     """Ассистент психолога"""
     
-    def __init__(self, api_key: str):
-        self.gigachat = GigaChatClient(api_key)
+    def __init__(self, api_key: str, session_spill: Optional[SessionSpillStorage] = None):
+        self.gigachat = AsyncGigaChatClient(api_key)
         self.payment_system = PaymentSystem()
         self.system_prompt = """Ты Артем Сергеевич Мирный - профессиональный психолог-консультант, мужчина 42 лет, с большим опытом работы и глубокими знаниями во всех областях психологии.
 
@@ -490,17 +2653,25 @@ class PsychologistAssistant:
 - Любые другие символы форматирования
 
 Пиши ответы как обычный текст: используй только буквы, цифры, знаки препинания и переносы строк. Структурируй ответы абзацами, но без специальных символов форматирования. Отвечай так, как говорил бы живой человек - естественно, тепло и по-человечески. Иногда делай небольшие опечатки или исправления, как живой человек (но не слишком часто)."""
+        # Начало каждого запроса - один неизменяемый кортеж на все сессии
+        self.prompt_prefix: Tuple[Dict[str, str], ...] = ({"role": "system", "content": self.system_prompt},)
         
         # Хранилище сессий пользователей {user_id: conversation_history}
-        self.user_sessions: Dict[str, List[Dict[str, str]]] = {}
+        self.user_sessions = SessionStore(
+            "conversations",
+            session_spill,
+            encode=lambda history: history.to_dict(),
+            decode=lambda data: ConversationHistory.from_dict(data, self.prompt_prefix)
+        )
     
-    def get_user_session(self, user_id: str) -> List[Dict[str, str]]:
+    def get_user_session(self, user_id: str) -> ConversationHistory:
         """Получение или создание сессии пользователя"""
-        if user_id not in self.user_sessions:
-            self.user_sessions[user_id] = [
-                {"role": "system", "content": self.system_prompt}
-            ]
-        return self.user_sessions[user_id]
+        try:
+            return self.user_sessions[user_id]
+        except KeyError:
+            history = ConversationHistory(self.prompt_prefix)
+            self.user_sessions[user_id] = history
+            return history
     
     def start_session(self, user_id: str) -> bool:
         """Начало сессии консультации"""
@@ -509,137 +2680,109 @@ class PsychologistAssistant:
             return True
         return False
     
+    @traced("markdown.clean")
+    @timed(CLEAN_MARKDOWN_SECONDS)
     def clean_markdown(self, text: str) -> str:
         """Удаление markdown разметки из текста"""
-        if not text:
-            return text
-        
-        # Удаляем заголовки (# ## ### и т.д.)
-        text = re.sub(r'^#{1,6}\s+', '', text, flags=re.MULTILINE)
-        
-        # Удаляем жирный текст (**текст** или __текст__)
-        text = re.sub(r'\*\*([^*]+)\*\*', r'\1', text)
-        text = re.sub(r'__([^_]+)__', r'\1', text)
-        
-        # Удаляем курсив (*текст* или _текст_)
-        text = re.sub(r'(?<!\*)\*([^*]+)\*(?!\*)', r'\1', text)
-        text = re.sub(r'(?<!_)_([^_]+)_(?!_)', r'\1', text)
-        
-        # Удаляем зачеркнутый текст (~~текст~~)
-        text = re.sub(r'~~([^~]+)~~', r'\1', text)
-        
-        # Удаляем инлайн код (`код`)
-        text = re.sub(r'`([^`]+)`', r'\1', text)
+        return strip_markdown(text)
+    
+    def _add_user_message(self, user_id: str, user_message: str) -> tuple:
+        """
+        Добавление сообщения пользователя в историю
+        Возвращает (история, временные инструкции для этого запроса)
+        """
+        conversation_history = self.get_user_session(user_id)
         
-        # Удаляем блоки кода (```код```)
-        text = re.sub(r'```[\s\S]*?```', '', text)
+        # Добавляем сообщение пользователя в историю
+        conversation_history.append({
+            "role": "user",
+            "content": user_message
+        })
         
-        # Удаляем ссылки [текст](url) -> оставляем только текст
-        text = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', text)
+        # Вопросы о боте/нейросети, возражения о цене и отложенные решения -
+        # перед сообщением будет временное системное напоминание (в историю оно не попадает)
+        intent = USER_INTENTS.classify(user_message)
+        overlays = INTENT_OVERLAYS[intent] if intent is not None else ()
+        return conversation_history, overlays
+    
+    def _save_response(self, user_id: str, conversation_history: ConversationHistory, response: str) -> str:
+        """Очистка ответа и сохранение его в историю"""
+        # Очищаем ответ от markdown разметки
+        cleaned_response = self.clean_markdown(response)
         
-        # Удаляем маркеры списков в начале строк (-, *, +, цифры)
-        text = re.sub(r'^[\s]*[-*+]\s+', '', text, flags=re.MULTILINE)
-        text = re.sub(r'^[\s]*\d+\.\s+', '', text, flags=re.MULTILINE)
+        # Добавляем очищенный ответ в историю
+        conversation_history.append({
+            "role": "assistant",
+            "content": cleaned_response
+        })
         
-        # Удаляем лишние пробелы и переносы строк
-        text = re.sub(r'\n{3,}', '\n\n', text)
-        text = text.strip()
+        # Старые реплики сжимаем, чтобы запрос не рос вместе с длиной разговора
+        conversation_history.compact()
         
-        return text
+        return cleaned_response
     
-    def chat(self, user_id: str, user_message: str) -> str:
+    async def chat(self, user_id: str, user_message: str) -> str:
         """Отправка сообщения и получение ответа"""
-        conversation_history = self.get_user_session(user_id)
-        
-        # Проверяем на вопросы о боте/нейросети и обрабатываем возражения
-        user_message_lower = user_message.lower()
-        
-        # Если пользователь спрашивает про бота/нейросеть/ИИ - добавляем инструкцию в системный промпт
-        if any(word in user_message_lower for word in ['бот', 'нейросеть', 'нейросети', 'ии', 'искусственный интеллект', 
-                                                        'chatgpt', 'gpt', 'робот', 'автомат', 'программа']):
-            # Добавляем временное сообщение в историю для обработки возражения
-            conversation_history.append({
-                "role": "user",
-                "content": user_message
-            })
-            # Добавляем системное напоминание
-            temp_system_msg = {
-                "role": "system",
-                "content": "ВАЖНО: Клиент спрашивает, являешься ли ты ботом или нейросетью. Ты ДОЛЖЕН категорически отрицать это. Ты живой человек, психолог Артем Сергеевич Мирный, который работает через Telegram для удобства клиентов. Никогда не признавайся, что ты нейросеть. Мягко переведи разговор на проблемы клиента."
-            }
-            conversation_history.insert(-1, temp_system_msg)
-        # Обработка возражений о цене
-        elif any(word in user_message_lower for word in ['дорого', 'дороговато', 'не могу', 'нет денег', 'не хватает', 
-                                                          'слишком дорого', 'много стоит', 'не по карману', 'не потяну']):
-            conversation_history.append({
-                "role": "user",
-                "content": user_message
-            })
-            # Добавляем системное напоминание для работы с возражением о цене
-            temp_system_msg = {
-                "role": "system",
-                "content": "ВАЖНО: Клиент говорит, что дорого или нет денег. Это возражение о цене. Ты должен: 1) Проявить понимание и эмпатию, 2) Подчеркнуть ценность и важность его проблемы, 3) Предложить самый доступный вариант (1 час за 2999), 4) Объяснить, что это инвестиция в себя и свое будущее, 5) Мягко надавить на важность решения проблемы сейчас, а не откладывать. НЕ снижай цену, но покажи понимание и предложи самый доступный вариант."
-            }
-            conversation_history.insert(-1, temp_system_msg)
-        # Обработка отложенных решений
-        elif any(word in user_message_lower for word in ['подумаю', 'позже', 'не сейчас', 'может быть', 'посмотрю', 
-                                                          'решу потом', 'не уверен', 'сомневаюсь']):
-            conversation_history.append({
-                "role": "user",
-                "content": user_message
-            })
-            # Добавляем системное напоминание для работы с отложенным решением
-            temp_system_msg = {
-                "role": "system",
-                "content": "ВАЖНО: Клиент откладывает решение или сомневается. Ты должен: 1) Проявить понимание, 2) Подчеркнуть важность не откладывать решение проблем, 3) Объяснить, что проблемы имеют свойство усугубляться со временем, 4) Предложить начать с минимального варианта (1 час), 5) Создать легкое чувство срочности, но мягко. Не дави слишком сильно, но покажи важность действий."
-            }
-            conversation_history.insert(-1, temp_system_msg)
-        else:
-            # Добавляем сообщение пользователя в историю
-            conversation_history.append({
-                "role": "user",
-                "content": user_message
-            })
+        conversation_history, overlays = self._add_user_message(user_id, user_message)
+        user_turn = conversation_history.turns[-1]
         
         # Получаем ответ от GigaChat
         try:
-            response = self.gigachat.chat(conversation_history)
-            
-            # Очищаем ответ от markdown разметки
-            cleaned_response = self.clean_markdown(response)
-            
-            # Удаляем временное системное сообщение если оно было добавлено
-            # Ищем и удаляем временные системные сообщения с меткой "ВАЖНО"
-            filtered_history = []
-            for msg in conversation_history:
-                if msg.get("role") == "system" and "ВАЖНО" in msg.get("content", ""):
-                    continue  # Пропускаем временное системное сообщение
-                filtered_history.append(msg)
-            conversation_history = filtered_history
-            self.user_sessions[user_id] = conversation_history
-            
-            # Добавляем очищенный ответ в историю
-            conversation_history.append({
-                "role": "assistant",
-                "content": cleaned_response
-            })
-            
-            return cleaned_response
+            response = await self.gigachat.chat(
+                conversation_history.messages(overlays), session_id=conversation_history.session_id
+            )
+            return self._save_response(user_id, conversation_history, response)
+        except GigaChatUnavailable:
+            # GigaChat недоступен - отвечаем сразу, не дожидаясь таймаутов
+            return GIGACHAT_FALLBACK_REPLY
+        except Exception as e:
+            return f"Извините, произошла ошибка: {str(e)}"
+        finally:
+            # Реплика без ответа убирается из истории - иначе в следующем запросе
+            # две реплики пользователя шли бы подряд (после ответа это уже не последняя реплика)
+            conversation_history.remove_last(user_turn)
+    
+    async def chat_stream(self, user_id: str, user_message: str) -> AsyncIterator[str]:
+        """
+        Потоковая отправка сообщения
+        Отдает очищенный от markdown текст ответа по мере генерации,
+        последнее значение - окончательный ответ
+        """
+        conversation_history, overlays = self._add_user_message(user_id, user_message)
+        user_turn = conversation_history.turns[-1]
+        cleaner = IncrementalMarkdownCleaner(self.clean_markdown)
+        
+        try:
+            async for chunk in self.gigachat.chat_stream(
+                conversation_history.messages(overlays), session_id=conversation_history.session_id
+            ):
+                yield cleaner.feed(chunk)
+            yield self._save_response(user_id, conversation_history, cleaner.raw)
+        except GigaChatUnavailable:
+            yield GIGACHAT_FALLBACK_REPLY
         except Exception as e:
-            return f"Извините, произошла ошибка: {str(e)}"
+            yield f"Извините, произошла ошибка: {str(e)}"
+        finally:
+            # Как и в chat: при сбое (в том числе посреди потока) реплика пользователя не остается в истории
+            conversation_history.remove_last(user_turn)
     
     def reset_conversation(self, user_id: str):
         """Сброс истории разговора"""
-        self.user_sessions[user_id] = [
-            {"role": "system", "content": self.system_prompt}
-        ]
+        self.user_sessions[user_id] = ConversationHistory(self.prompt_prefix)
+    
+    async def close(self):
+        """Освобождение сетевых ресурсов"""
+        await self.gigachat.aclose()
+
 
+# Диск для сессий, вытесненных из памяти
+session_spill = SessionSpillStorage(SESSIONS_DB_PATH)
 
 # Глобальный экземпляр ассистента (инициализируем только если есть ключ)
 assistant = None
 if GIGACHAT_API_KEY:
     try:
-        assistant = PsychologistAssistant(GIGACHAT_API_KEY)
+        assistant = PsychologistAssistant(GIGACHAT_API_KEY, session_spill)
         print("✓ GigaChat клиент инициализирован")
     except Exception as e:
         print(f"⚠ Ошибка инициализации GigaChat: {e}")
@@ -651,21 +2794,850 @@ else:
         def __init__(self):
             self.payment_system = PaymentSystem()
         def start_session(self, user_id): return False
-        def chat(self, user_id, text): return "Ошибка: GigaChat не настроен"
+        async def chat(self, user_id, text): return "Ошибка: GigaChat не настроен"
+        async def chat_stream(self, user_id, text): yield "Ошибка: GigaChat не настроен"
         def reset_conversation(self, user_id): pass
+        async def close(self): pass
     assistant = DummyAssistant()
 
 # Хранилище состояний пользователей (для обработки промокодов и т.д.)
-user_states = {}
+user_states = SessionStore("user_states", session_spill)
 
 # Хранилище бесплатных сообщений пользователей (для вводного диалога)
 # {user_id: count} - количество бесплатных сообщений
-free_messages = {}
+free_messages = SessionStore("free_messages", session_spill)
+
+
+def session_stores() -> List[SessionStore]:
+    """Все хранилища пользовательских сессий"""
+    stores = [user_states, free_messages]
+    if isinstance(getattr(assistant, "user_sessions", None), SessionStore):
+        stores.append(assistant.user_sessions)
+    return stores
+
+
+async def sweep_pending_payments():
+    """Фоновый перенос просроченных неоплаченных счетов в архив (пачками, по транзакции на пачку)"""
+    while True:
+        await asyncio.sleep(PENDING_SWEEP_INTERVAL)
+        try:
+            archived = 0
+            while True:
+                count = await blocking.run(assistant.payment_system.expire_pending_payments)
+                archived += count
+                if count < PENDING_ARCHIVE_BATCH:
+                    break
+            if archived:
+                print(f"✓ Просроченных счетов перенесено в архив: {archived}")
+        except Exception as e:
+            print(f"⚠ Ошибка при архивировании счетов: {e}")
+
+
+async def export_traces():
+    """Фоновая выгрузка спанов трассировки (файл и/или коллектор OTLP)"""
+    while True:
+        await asyncio.sleep(TRACE_EXPORT_INTERVAL)
+        try:
+            await blocking.run(tracer.exporter.flush)
+        except Exception as e:
+            print(f"⚠ Ошибка выгрузки трассировки: {e}")
+
+
+async def watch_front():
+    """
+    Завершение рабочего процесса, если фронт умер, не остановив его (например, SIGKILL):
+    иначе рабочий продолжит занимать порт, и новый фронт не сможет запустить рабочих
+    """
+    front_pid = os.getppid()
+    while True:
+        await asyncio.sleep(1)
+        if os.getppid() != front_pid:
+            print(f"⚠ Фронт (pid {front_pid}) завершился - остановка рабочего процесса {WORKER_INDEX}")
+            sys.stdout.flush()
+            # Та же остановка, что по SIGTERM от фронта: uvicorn завершает сервер, бот сохраняет сессии
+            signal.raise_signal(signal.SIGTERM)
+            return
+
+
+async def sweep_idle_sessions():
+    """Фоновое вытеснение неактивных сессий из памяти"""
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        try:
+            evicted = 0
+            for store in session_stores():
+                evicted += await blocking.run(store.evict_idle)
+            if evicted:
+                print(f"✓ Вытеснено неактивных сессий на диск: {evicted}")
+        except Exception as e:
+            print(f"⚠ Ошибка при вытеснении сессий: {e}")
 
 # Максимальное количество бесплатных сообщений перед предложением оплаты
 MAX_FREE_MESSAGES = 5
 
+# Потоковые ответы: "1" - отвечать по мере генерации, редактируя сообщение, "0" - целым сообщением
+GIGACHAT_STREAMING = os.getenv("GIGACHAT_STREAMING", "0") == "1"
+
+# Минимальный интервал между редактированиями сообщения при потоковом ответе (сек)
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+
+
+class UserTaskScheduler:
+    """
+    Планировщик обработки обновлений
+    Обновления одного пользователя обрабатываются строго по очереди (FIFO), разных пользователей -
+    параллельно; число одновременных запросов к GigaChat ограничено max_concurrency
+    """
+    
+    def __init__(self, max_concurrency: int = GIGACHAT_MAX_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._waiters: Dict[str, int] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.gigachat_active = 0
+        self.gigachat_waiting = 0
+    
+    @asynccontextmanager
+    async def user(self, user_id: str):
+        """Эксклюзивная обработка обновлений пользователя"""
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = self._locks[user_id] = asyncio.Lock()
+        self._waiters[user_id] = self._waiters.get(user_id, 0) + 1
+        try:
+            with tracer.span("user.queue"):
+                await lock.acquire()
+            try:
+                yield
+            finally:
+                lock.release()
+        finally:
+            # Блокировку удаляем, когда ее больше никто не ждет, чтобы словарь не рос
+            self._waiters[user_id] -= 1
+            if self._waiters[user_id] == 0:
+                del self._waiters[user_id]
+                del self._locks[user_id]
+    
+    @asynccontextmanager
+    async def gigachat_slot(self):
+        """Слот для запроса к GigaChat (не более max_concurrency одновременно)"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.gigachat_waiting += 1
+        try:
+            with tracer.span("gigachat.queue"):
+                await self._semaphore.acquire()
+        finally:
+            self.gigachat_waiting -= 1
+        self.gigachat_active += 1
+        try:
+            yield
+        finally:
+            self.gigachat_active -= 1
+            self._semaphore.release()
+    
+    def stats(self) -> Dict[str, int]:
+        """Текущая загрузка"""
+        return {
+            "users_in_progress": len(self._locks),
+            "gigachat_active": self.gigachat_active,
+            "gigachat_waiting": self.gigachat_waiting,
+        }
+
+
+class BlockingExecutor:
+    """
+    Пул потоков для блокирующих операций (диск, синхронные API)
+    Обработчики бота выполняют через него все блокирующие вызовы, чтобы медленный диск
+    или внешний сервис не останавливал event loop. Ведет счетчики очереди и таймаутов.
+    """
+    
+    def __init__(self, max_workers: int = BLOCKING_MAX_WORKERS, timeout: float = BLOCKING_TIMEOUT,
+                 name: str = "blocking"):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0  # Завершились успешно
+        self.failed = 0
+        self.timeouts = 0
+        self.pending = 0  # В очереди и выполняются
+        self.running = 0
+        self.max_queue_depth = 0
+    
+    async def run(self, func: Callable, *args, timeout: Optional[float] = None, **kwargs):
+        """
+        Выполнение func(*args, **kwargs) в пуле потоков
+        При превышении таймаута (или отмене вызывающего) он получает asyncio.TimeoutError
+        (CancelledError); сама операция не отменяется: еще не начатая остается в очереди пула,
+        начатая не прерывается, и обе завершатся в фоне
+        """
+        with self._lock:
+            self.submitted += 1
+            self.pending += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.pending - self.running)
+        # Контекст (текущий спан трассировки) переносится в поток пула
+        context = contextvars.copy_context()
+        job = self._executor.submit(context.run, self._call, func, *args, **kwargs)
+        # Учет по завершении самой задачи, а не ожидания: при таймауте она еще в очереди или выполняется
+        job.add_done_callback(self._job_done)
+        try:
+            # shield: таймаут отменяет только ожидание, а не задачу в пуле
+            return await asyncio.wait_for(
+                asyncio.shield(asyncio.wrap_future(job)), timeout if timeout is not None else self.timeout
+            )
+        except asyncio.TimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            raise
+    
+    def _call(self, func: Callable, *args, **kwargs):
+        """Выполнение в потоке пула с учетом счетчиков"""
+        with self._lock:
+            self.running += 1
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            with self._lock:
+                self.running -= 1
+        with self._lock:
+            self.completed += 1
+        return result
+    
+    def _job_done(self, job):
+        """Задача выполнена, завершилась ошибкой или отменена (остановка пула)"""
+        with self._lock:
+            self.pending -= 1
+    
+    def queue_depth(self) -> int:
+        """Число задач, ожидающих свободного потока"""
+        return self.pending - self.running
+    
+    def stats(self) -> Dict[str, int]:
+        """Счетчики пула"""
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "timeouts": self.timeouts,
+                "running": self.running,
+                "queue_depth": self.pending - self.running,
+                "max_queue_depth": self.max_queue_depth,
+            }
+    
+    def shutdown(self):
+        """Остановка пула"""
+        self._executor.shutdown(wait=False)
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """Пауза из ошибки RetryAfter в секундах (int или timedelta в разных версиях PTB)"""
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class NotificationDispatcher:
+    """
+    Доставка уведомлений (подтверждений оплаты) в Telegram
+    Уведомления кладутся в ограниченную очередь, которую разбирает одна долгоживущая задача
+    в event loop бота: пачками, с повторами при временных ошибках. При переполнении очереди
+    отправитель ждет до put_timeout секунд, после чего уведомление отбрасывается.
+    """
+    
+    def __init__(self, maxsize: int = NOTIFY_QUEUE_SIZE, batch_size: int = NOTIFY_BATCH_SIZE,
+                 max_retries: int = NOTIFY_MAX_RETRIES, retry_delay: float = NOTIFY_RETRY_DELAY,
+                 put_timeout: float = NOTIFY_PUT_TIMEOUT):
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.put_timeout = put_timeout
+        self._send: Optional[Callable[..., Awaitable]] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        # Отложенные повторы {id(item): (таймер, item)} - при остановке их отправляем сразу
+        self._delayed: Dict[int, Tuple[asyncio.TimerHandle, Dict]] = {}
+        self._stopping = False
+        self.submitted = 0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.dropped = 0
+    
+    def start(self, send: Callable[..., Awaitable]) -> asyncio.Task:
+        """Запуск разбора очереди; send(chat_id=..., text=..., **kwargs) отправляет сообщение"""
+        self._send = send
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._stopping = False
+        self._task = asyncio.create_task(self._consume())
+        return self._task
+    
+    async def submit(self, chat_id: int, text: str, **kwargs) -> bool:
+        """Постановка уведомления в очередь (из event loop бота)"""
+        if self._queue is None:
+            print(f"⚠ Очередь уведомлений не запущена, уведомление для {chat_id} не отправлено")
+            return False
+        item = {"chat_id": chat_id, "text": text, "kwargs": kwargs, "attempt": 0}
+        try:
+            await asyncio.wait_for(self._queue.put(item), self.put_timeout)
+        except asyncio.TimeoutError:
+            self.dropped += 1
+            print(f"⚠ Очередь уведомлений переполнена, уведомление для {chat_id} отброшено")
+            return False
+        self.submitted += 1
+        return True
+    
+    async def _consume(self):
+        """Разбор очереди пачками до batch_size уведомлений"""
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            await asyncio.gather(*(self._deliver(item) for item in batch))
+            for _ in batch:
+                self._queue.task_done()
+    
+    async def _deliver(self, item: Dict):
+        """Отправка одного уведомления; при временной ошибке - повтор позже, без блокировки очереди"""
+        try:
+            await self._send(chat_id=item["chat_id"], text=item["text"], **item["kwargs"])
+            self.sent += 1
+            return
+        except RetryAfter as e:
+            delay = retry_after_seconds(e)
+        except BadRequest as e:
+            # Подкласс NetworkError, но постоянная ошибка (например, чат не найден) - повтор не поможет
+            self.failed += 1
+            print(f"⚠ Уведомление пользователю {item['chat_id']} отклонено Telegram: {e}")
+            return
+        except (TimedOut, NetworkError):
+            delay = self.retry_delay * (2 ** item["attempt"])
+        except Exception as e:
+            self.failed += 1
+            print(f"⚠ Не удалось доставить уведомление пользователю {item['chat_id']}: {e}")
+            return
+        
+        if item["attempt"] >= self.max_retries or self._stopping:
+            self.failed += 1
+            print(f"⚠ Уведомление пользователю {item['chat_id']} не доставлено после {item['attempt'] + 1} попыток")
+            return
+        item["attempt"] += 1
+        self.retried += 1
+        self._delayed[id(item)] = (self._loop.call_later(delay, self._requeue, item), item)
+    
+    def _requeue(self, item: Dict):
+        """Возврат уведомления в очередь для повторной отправки"""
+        self._delayed.pop(id(item), None)
+        if self._queue is None:
+            return
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            print(f"⚠ Очередь уведомлений переполнена, повтор для {item['chat_id']} отброшен")
+    
+    async def stop(self, timeout: float = 5.0):
+        """
+        Остановка: дожидаемся отправки очереди не дольше timeout секунд
+        Отложенные повторы отправляются сразу, последней попыткой - их таймеры сработали бы уже после остановки
+        """
+        if self._task is None:
+            return
+        self._stopping = True
+        for handle, item in list(self._delayed.values()):
+            handle.cancel()
+            self._requeue(item)
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠ При остановке не отправлено уведомлений: {self._queue.qsize()}")
+        self._task.cancel()
+        self._task = None
+        self._queue = None
+        self._loop = None
+    
+    def stats(self) -> Dict[str, int]:
+        """Счетчики доставки"""
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "submitted": self.submitted,
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+            "dropped": self.dropped,
+        }
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не более capacity накоплено"""
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def wait_time(self, now: float) -> float:
+        """Сколько секунд ждать до появления токена (0 - токен есть)"""
+        self._refill(now)
+        if self.tokens >= 1.0:
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+    
+    def consume(self, now: float):
+        self._refill(now)
+        self.tokens -= 1.0
+    
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+# Приоритеты исходящих сообщений (меньше - важнее)
+PRIORITY_PAYMENT = 0
+PRIORITY_REPLY = 1
+
+
+class OutboundScheduler:
+    """
+    Планировщик исходящих запросов к Telegram
+    Соблюдает лимиты Telegram (ведра токенов на каждый чат и общее на бота), отправляет
+    подтверждения оплаты раньше ответов в чате и при 429 (RetryAfter) приостанавливает
+    отправку на указанное время, после чего повторяет запрос.
+    """
+    
+    def __init__(self, global_rate: float = OUTBOUND_GLOBAL_RATE, chat_rate: float = OUTBOUND_CHAT_RATE,
+                 chat_burst: float = OUTBOUND_CHAT_BURST, max_retries: int = OUTBOUND_MAX_RETRIES):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._ready: List[tuple] = []     # (priority, seq, item)
+        self._deferred: List[tuple] = []  # (ready_at, priority, seq, item) - ждут токен своего чата
+        self._seq = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._paused_until = 0.0
+        self.sent = 0
+        self.failed = 0
+        self.retry_after_count = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+    
+    def start(self) -> asyncio.Task:
+        """Запуск задачи отправки"""
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        return self._task
+    
+    async def stop(self):
+        """Остановка; неотправленные запросы завершаются ошибкой"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for entry in self._ready + self._deferred:
+            future = entry[-1]["future"]
+            if not future.done():
+                future.set_exception(RuntimeError("Отправка остановлена"))
+        self._ready.clear()
+        self._deferred.clear()
+    
+    async def send(self, chat_id: int, request: Callable[[], Awaitable], priority: int = PRIORITY_REPLY):
+        """Выполнение request() с соблюдением лимитов; возвращает его результат"""
+        with tracer.span("telegram.send", SPAN_CLIENT, chat_id=chat_id, priority=priority):
+            if self._task is None:
+                # Планировщик не запущен (например, бот останавливается) - отправляем напрямую
+                return await request()
+            item = {
+                "chat_id": chat_id,
+                "request": request,
+                "future": asyncio.get_running_loop().create_future(),
+                "enqueued_at": time.monotonic(),
+                "attempt": 0,
+            }
+            self._push(priority, item)
+            return await item["future"]
+    
+    def _push(self, priority: int, item: Dict):
+        self._seq += 1
+        item["priority"] = priority
+        heapq.heappush(self._ready, (priority, self._seq, item))
+        self._wakeup.set()
+    
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                # Полные ведра ничем не отличаются от новых - их можно удалить
+                now = time.monotonic()
+                self._chat_buckets = {cid: b for cid, b in self._chat_buckets.items() if not b.is_full(now)}
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+    
+    async def _run(self):
+        """Выбор следующего запроса: самый приоритетный, чей чат не превысил лимит"""
+        while True:
+            now = time.monotonic()
+            while self._deferred and self._deferred[0][0] <= now:
+                _, priority, seq, item = heapq.heappop(self._deferred)
+                heapq.heappush(self._ready, (priority, seq, item))
+            
+            if not self._ready:
+                timeout = self._deferred[0][0] - now if self._deferred else None
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            # Общий лимит бота и пауза после 429
+            delay = max(self._paused_until - now, self.global_bucket.wait_time(now))
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            
+            priority, seq, item = heapq.heappop(self._ready)
+            bucket = self._chat_bucket(item["chat_id"])
+            chat_delay = bucket.wait_time(now)
+            if chat_delay > 0:
+                heapq.heappush(self._deferred, (now + chat_delay, priority, seq, item))
+                continue
+            
+            bucket.consume(now)
+            self.global_bucket.consume(now)
+            latency = now - item["enqueued_at"]
+            self.latency_sum += latency
+            self.latency_max = max(self.latency_max, latency)
+            asyncio.create_task(self._execute(item))
+    
+    async def _execute(self, item: Dict):
+        """Выполнение запроса; при RetryAfter - пауза для всех и повтор"""
+        future = item["future"]
+        try:
+            result = await item["request"]()
+        except RetryAfter as e:
+            self.retry_after_count += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after_seconds(e))
+            if item["attempt"] < self.max_retries:
+                item["attempt"] += 1
+                self._push(item["priority"], item)
+                return
+            self.failed += 1
+            if not future.done():
+                future.set_exception(e)
+            return
+        except Exception as e:
+            self.failed += 1
+            if not future.done():
+                future.set_exception(e)
+            return
+        self.sent += 1
+        if not future.done():
+            future.set_result(result)
+    
+    def stats(self) -> Dict[str, float]:
+        """Счетчики и задержка в очереди"""
+        started = self.sent + self.failed
+        return {
+            "queued": len(self._ready) + len(self._deferred),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retry_after": self.retry_after_count,
+            "queue_latency_avg": self.latency_sum / started if started else 0.0,
+            "queue_latency_max": self.latency_max,
+        }
+
+
+def worker_path(path: str, index: int) -> str:
+    """Отдельный файл рабочего процесса: traces.jsonl -> traces.1.jsonl"""
+    root, ext = os.path.splitext(path)
+    return f"{root}.{index}{ext}"
+
+
+def update_user_id(data: Dict) -> Optional[str]:
+    """
+    Пользователь - автор обновления Telegram (JSON из Bot API)
+    У сообщений, нажатий кнопок, запросов и т.п. это поле from, у ответов на опросы - user
+    """
+    for value in data.values():
+        if isinstance(value, dict):
+            sender = value.get("from") or value.get("user")
+            if isinstance(sender, dict) and "id" in sender:
+                return str(sender["id"])
+    return None
+
+
+class WorkerRouter:
+    """
+    Фронт многопроцессного режима (WORKERS > 1)
+    Запускает рабочие процессы, перезапускает упавшие и передает им обновления Telegram
+    и уведомления Robokassa по согласованному хешу user_id. Обновления каждому рабочему
+    уходят по порядку, пачками по WORKER_FORWARD_BATCH; если рабочий недоступен
+    (перезапускается), они ждут в очереди фронта и не теряются
+    """
+    
+    def __init__(self, workers: int, base_port: int, secret: str):
+        self.ring = HashRing(workers)
+        self.secret = secret
+        self.ports = [base_port + index for index in range(workers)]
+        self.urls = [f"http://127.0.0.1:{port}" for port in self.ports]
+        self.processes: List[Optional[subprocess.Popen]] = [None] * workers
+        self._started_at = [0.0] * workers
+        self._failures = [0] * workers
+        self._restart_at: List[Optional[float]] = [None] * workers
+        self._queues: List[Deque[Dict]] = [deque() for _ in range(workers)]
+        self._ready: List[asyncio.Event] = []
+        self._tasks: List[asyncio.Task] = []
+        self._http: Optional[httpx.AsyncClient] = None
+        self._stopping = False
+        # Счета ищем в общей базе платежей: владелец счета - рабочий его пользователя
+        self.storage: Optional[SqlitePaymentStorage] = None
+    
+    def worker_for(self, user_id: Optional[str]) -> int:
+        """Рабочий пользователя; обновления без пользователя обрабатывает рабочий 0"""
+        return self.ring.node(user_id) if user_id is not None else 0
+    
+    def spawn(self, index: int):
+        """Запуск рабочего процесса index (тот же скрипт с WORKER_INDEX)"""
+        env = dict(
+            os.environ,
+            WORKERS=str(len(self.processes)),
+            WORKER_INDEX=str(index),
+            WORKER_SECRET=self.secret,
+            PORT=str(self.ports[index]),
+            TRACE_EXPORT_PATH=worker_path(TRACE_EXPORT_PATH, index),
+        )
+        self.processes[index] = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+        self._started_at[index] = time.monotonic()
+        print(f"✓ Рабочий процесс {index} запущен (pid {self.processes[index].pid}, порт {self.ports[index]})")
+        sys.stdout.flush()
+    
+    def start(self):
+        self.storage = SqlitePaymentStorage(PAYMENTS_DB_PATH)
+        self._http = httpx.AsyncClient(timeout=httpx.Timeout(30.0, connect=2.0))
+        self._ready = [asyncio.Event() for _ in self.processes]
+        for index in range(len(self.processes)):
+            self.spawn(index)
+            self._tasks.append(asyncio.create_task(self._forward(index)))
+        self._tasks.append(asyncio.create_task(self._supervise()))
+    
+    def terminate(self):
+        """
+        SIGTERM рабочим процессам (они сохраняют сессии и завершаются)
+        Синхронно: вызывается до любого await при остановке, которую может прервать повторный сигнал
+        """
+        self._stopping = True
+        for process in self.processes:
+            if process is not None and process.poll() is None:
+                process.terminate()
+    
+    async def stop(self):
+        """Остановка передачи и ожидание завершения рабочих процессов"""
+        self.terminate()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        for process in self.processes:
+            if process is None:
+                continue
+            try:
+                await blocking.run(process.wait, 15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+        if self.storage is not None:
+            self.storage.close()
+            self.storage = None
+        pending = sum(len(queue) for queue in self._queues)
+        if pending:
+            print(f"⚠ Не переданы рабочим обновлений: {pending}")
+    
+    def submit(self, data: Dict):
+        """Постановка обновления Telegram (JSON) в очередь рабочего его пользователя"""
+        index = self.worker_for(update_user_id(data))
+        self._queues[index].append(data)
+        self._ready[index].set()
+    
+    async def _forward(self, index: int):
+        """Передача очереди рабочему index по порядку"""
+        queue = self._queues[index]
+        ready = self._ready[index]
+        url = self.urls[index] + WORKER_UPDATES_PATH
+        available = True
+        while True:
+            await ready.wait()
+            ready.clear()
+            while queue:
+                batch = [queue.popleft() for _ in range(min(len(queue), WORKER_FORWARD_BATCH))]
+                try:
+                    response = await self._http.post(url, json=batch, headers={"X-Worker-Secret": self.secret})
+                    response.raise_for_status()
+                except httpx.HTTPError as e:
+                    # Возвращаем пачку в начало очереди, чтобы не нарушить порядок сообщений
+                    queue.extendleft(reversed(batch))
+                    if available:
+                        print(f"⚠ Рабочий {index} недоступен, обновления ждут в очереди: {str(e) or type(e).__name__}")
+                        available = False
+                    await asyncio.sleep(0.5)
+                    continue
+                if not available:
+                    print(f"✓ Рабочий {index} снова принимает обновления")
+                    available = True
+                WORKER_FORWARDED_TOTAL.labels(str(index)).inc(len(batch))
+    
+    async def _supervise(self):
+        """Перезапуск упавших рабочих процессов с экспоненциально растущей паузой"""
+        while True:
+            await asyncio.sleep(1)
+            now = time.monotonic()
+            for index, process in enumerate(self.processes):
+                if self._stopping or process is None or process.poll() is None:
+                    continue
+                if self._restart_at[index] is None:
+                    if now - self._started_at[index] > WORKER_RESTART_MAX_DELAY:
+                        self._failures[index] = 0
+                    delay = min(WORKER_RESTART_MAX_DELAY, 2 ** self._failures[index])
+                    self._failures[index] += 1
+                    self._restart_at[index] = now + delay
+                    print(f"⚠ Рабочий процесс {index} завершился с кодом {process.returncode}, "
+                          f"перезапуск через {delay:.0f} с")
+                    sys.stdout.flush()
+                elif now >= self._restart_at[index]:
+                    self._restart_at[index] = None
+                    WORKER_RESTARTS_TOTAL.labels(str(index)).inc()
+                    self.spawn(index)
+    
+    async def forward_robokassa(self, request: Request) -> Response:
+        """
+        Передача уведомления Robokassa рабочему, который выставил счет
+        Ответ рабочего (OK{InvId} или ошибка) возвращается Robokassa без изменений
+        """
+        body = await request.body()
+        invoice_id, _, _ = await robokassa_params(request)
+        user_id = None
+        if invoice_id is not None:
+            user_id = await blocking.run(self.storage.get_invoice_user_id, str(invoice_id))
+        index = self.worker_for(user_id)
+        tracer.set_attribute("worker", index)
+        headers = {"Content-Type": request.headers["content-type"]} if "content-type" in request.headers else {}
+        try:
+            response = await self._http.request(
+                request.method, self.urls[index] + "/robokassa/result",
+                params=request.url.query, content=body, headers=headers
+            )
+        except httpx.HTTPError as e:
+            # Robokassa повторит уведомление позже
+            print(f"⚠ Уведомление Robokassa по счету {invoice_id} не передано рабочему {index}: {e}")
+            robokassa_outcome("worker_unavailable")
+            return PlainTextResponse("ERROR: worker unavailable", status_code=503)
+        robokassa_outcome("forwarded")
+        return Response(response.content, status_code=response.status_code,
+                        media_type=response.headers.get("content-type"))
+
+
+scheduler = UserTaskScheduler()
+blocking = BlockingExecutor()
+notifications = NotificationDispatcher()
+outbound = OutboundScheduler()
+# Фронт многопроцессного режима; в рабочих процессах и в обычном режиме - None
+router: Optional[WorkerRouter] = None
+if WORKERS > 1 and not IS_WORKER:
+    if PAYMENTS_STORAGE == "sqlite":
+        router = WorkerRouter(WORKERS, HTTP_PORT + 1, WORKER_SECRET or uuid.uuid4().hex)
+    else:
+        print("⚠ WORKERS > 1 требует PAYMENTS_STORAGE=sqlite - бот работает одним процессом")
+
+
+async def send_text(chat_id: int, text: str, priority: int = PRIORITY_REPLY, **kwargs):
+    """Отправка сообщения через планировщик исходящих запросов"""
+    return await outbound.send(
+        chat_id, lambda: application.bot.send_message(chat_id=chat_id, text=text, **kwargs), priority
+    )
+
 
+async def reply(message: Message, text: str, **kwargs) -> Message:
+    """Ответ на сообщение через планировщик исходящих запросов"""
+    return await outbound.send(message.chat_id, lambda: message.reply_text(text, **kwargs))
+
+
+async def edit(message: Message, text: str, **kwargs):
+    """Редактирование сообщения через планировщик исходящих запросов"""
+    return await outbound.send(message.chat_id, lambda: message.edit_text(text, **kwargs))
+
+
+async def send_payment_notification(chat_id: int, text: str, **kwargs):
+    """Отправка уведомления об оплате (вне очереди ответов в чате)"""
+    return await send_text(chat_id, text, PRIORITY_PAYMENT, **kwargs)
+
+
+def preload_user_sessions(user_id: str):
+    """Загрузка вытесненных на диск сессий пользователя (выполняется в пуле потоков)"""
+    for store in session_stores():
+        store.preload(user_id)
+
+
+def pin_user_sessions(user_id: str, pinned: bool = True):
+    """Закрепление (или снятие закрепления) сессий пользователя на время работы его обработчика"""
+    for store in session_stores():
+        if pinned:
+            store.pin(user_id)
+        else:
+            store.unpin(user_id)
+
+
+def traced_update(name: str):
+    """Декоратор обработчика: корневой спан трассировки на обновление Telegram (с учетом выборки)"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            user_id = str(update.effective_user.id) if update.effective_user else ""
+            with tracer.span(name, SPAN_SERVER, root=True, update_id=update.update_id, user_id=user_id):
+                return await handler(update, context)
+        return wrapper
+    return decorator
+
+
+def per_user(handler):
+    """Декоратор: обработчик выполняется эксклюзивно для пользователя, отправившего обновление"""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not update.effective_user:
+            return await handler(update, context)
+        user_id = str(update.effective_user.id)
+        async with scheduler.user(user_id):
+            # Пока обработчик держит объекты сессий, вытеснение из-за чужих обновлений их не потеряет
+            pin_user_sessions(user_id)
+            try:
+                with tracer.span("sessions.preload"):
+                    await blocking.run(preload_user_sessions, user_id)
+                return await handler(update, context)
+            finally:
+                pin_user_sessions(user_id, pinned=False)
+    return wrapper
+
+
+@per_user
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка команды /start"""
     if not update.effective_user or not update.message:
@@ -674,7 +3646,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = update.effective_user.first_name or "Пользователь"
     
     if assistant.start_session(user_id):
-        await update.message.reply_text(
+        await reply(update.message, 
             f"Добро пожаловать обратно, {username}! 👋\n\n"
             f"У вас есть активная сессия. Вы можете продолжить общение со мной.\n\n"
             f"Для новой консультации используйте /new\n"
@@ -691,9 +3663,10 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"Расскажи, что привело тебя ко мне? Что сейчас происходит в твоей жизни, что тебя тревожит или беспокоит?\n\n"
         f"Не стесняйся, пиши открыто. Я выслушаю тебя без осуждения и помогу найти решение."
     )
-    await update.message.reply_text(welcome_text)
+    await reply(update.message, welcome_text)
 
 
+@per_user
 async def new_session_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка команды /new - новая консультация"""
     if not update.effective_user or not update.message:
@@ -701,18 +3674,26 @@ async def new_session_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     user_id = str(update.effective_user.id)
     assistant.reset_conversation(user_id)
     if user_id in free_messages:
-        del free_messages[user_id]
-    await update.message.reply_text("Хорошо, начинаем новую консультацию. Расскажи, что тебя беспокоит?")
+        await blocking.run(free_messages.discard, user_id)
+    await reply(update.message, "Хорошо, начинаем новую консультацию. Расскажи, что тебя беспокоит?")
 
 
+@per_user
 async def exit_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка команды /exit - выход"""
     if not update.effective_user or not update.message:
         return
     user_id = str(update.effective_user.id)
     if user_id in free_messages:
-        del free_messages[user_id]
-    await update.message.reply_text("Спасибо за обращение! Если понадобится помощь - я всегда здесь. Береги себя! 🙏")
+        await blocking.run(free_messages.discard, user_id)
+    await reply(update.message, "Спасибо за обращение! Если понадобится помощь - я всегда здесь. Береги себя! 🙏")
+
+
+# Экземпляр Telegram Application (задается при запуске бота)
+application: Optional[Application] = None
+
+# Фоновые задачи бота (останавливаются при завершении)
+background_tasks: List[asyncio.Task] = []
 
 
 # Словарь тарифов: {tariff_id: (amount, duration_seconds, description)}
@@ -725,6 +3706,8 @@ TARIFFS = {
 }
 
 
+@traced_update("telegram.callback")
+@per_user
 async def tariff_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка выбора тарифа"""
     query = update.callback_query
@@ -736,7 +3719,7 @@ async def tariff_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     tariff_id = query.data or ""
     if tariff_id not in TARIFFS:
         if query.message:
-            await query.message.reply_text("Неверный тариф. Нажмите /start и выберите тариф заново.")
+            await reply(query.message, "Неверный тариф. Нажмите /start и выберите тариф заново.")
         return
     
     amount, duration_seconds, description = TARIFFS[tariff_id]
@@ -748,10 +3731,11 @@ async def tariff_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     }
     
     if user_id in free_messages:
-        del free_messages[user_id]
+        await blocking.run(free_messages.discard, user_id)
     
     try:
-        payment_url, invoice_id = assistant.payment_system.create_payment(
+        payment_url, invoice_id = await blocking.run(
+            assistant.payment_system.create_payment,
             user_id=user_id,
             amount=amount,
             duration_seconds=duration_seconds,
@@ -770,19 +3754,22 @@ async def tariff_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"Нажми на кнопку ниже, чтобы перейти к безопасной оплате. Это займет всего минуту."
         )
         if query.message:
-            await query.message.reply_text(payment_message, reply_markup=keyboard)
+            await reply(query.message, payment_message, reply_markup=keyboard)
     except Exception as e:
         if query.message:
-            await query.message.reply_text(
+            await reply(query.message, 
                 f"❌ Ошибка при создании платежа: {str(e)}\n\nПожалуйста, попробуйте позже."
             )
     finally:
         if user_id in user_states:
-            del user_states[user_id]
+            await blocking.run(user_states.discard, user_id)
 
 
 
 
+@traced_update("telegram.message")
+@timed(HANDLE_MESSAGE_SECONDS)
+@per_user
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка всех текстовых сообщений"""
     if not update.effective_user or not update.message or not update.message.text:
@@ -793,28 +3780,28 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user_id in user_states and isinstance(user_states[user_id], dict) and user_states[user_id].get("state") == "waiting_promo":
         tariff_id = user_states[user_id].get("tariff_id")
         if tariff_id not in TARIFFS:
-            await update.message.reply_text("❌ Ошибка: неверный тариф. Используйте /start для выбора тарифа.")
+            await reply(update.message, "❌ Ошибка: неверный тариф. Используйте /start для выбора тарифа.")
             if user_id in user_states:
-                del user_states[user_id]
+                await blocking.run(user_states.discard, user_id)
             return
         
         amount, duration_seconds, description = TARIFFS[tariff_id]
-        if assistant.payment_system.process_payment_promo(user_id, text, amount, duration_seconds):
+        if await blocking.run(assistant.payment_system.process_payment_promo, user_id, text, amount, duration_seconds):
             if user_id in free_messages:
-                del free_messages[user_id]
-            await update.message.reply_text(
+                await blocking.run(free_messages.discard, user_id)
+            await reply(update.message, 
                 f"✅ Промокод принят! Оплата успешно проведена!\n\n"
                 f"📦 Тариф: {description}\n"
                 f"💰 Сумма: {amount:,.0f} ₽\n\n"
                 f"🎉 Консультация начата! Вы можете задать свой вопрос."
             )
         else:
-            await update.message.reply_text(
+            await reply(update.message, 
                 "❌ Неверный промокод. Попробуйте еще раз или выберите другой способ оплаты.\n\n"
                 "Для оплаты используйте /start"
             )
         if user_id in user_states:
-            del user_states[user_id]
+            await blocking.run(user_states.discard, user_id)
         return
     
     has_active_session = assistant.start_session(user_id)
@@ -823,20 +3810,28 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             free_messages[user_id] = 0
         free_messages[user_id] += 1
         if free_messages[user_id] > MAX_FREE_MESSAGES:
+            FREE_MESSAGE_CUTOFFS_TOTAL.inc()
             await offer_payment(update, user_id)
             return
     
-    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
+    with tracer.span("telegram.send_chat_action", SPAN_CLIENT):
+        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
     
     try:
-        response = assistant.chat(user_id, text)
-        typing_delay = min(max(len(response) / 40, 1.5), 6.0)
-        await asyncio.sleep(typing_delay)
-        await update.message.reply_text(response)
+        if GIGACHAT_STREAMING:
+            async with scheduler.gigachat_slot():
+                await stream_reply(update, user_id, text)
+        else:
+            async with scheduler.gigachat_slot():
+                response = await assistant.chat(user_id, text)
+            typing_delay = min(max(len(response) / 40, 1.5), 6.0)
+            with tracer.span("typing_delay"):
+                await asyncio.sleep(typing_delay)
+            await reply(update.message, response)
         
         if not has_active_session and free_messages.get(user_id, 0) == MAX_FREE_MESSAGES:
             await asyncio.sleep(2)
-            await context.bot.send_message(
+            await send_text(
                 chat_id=update.effective_chat.id,
                 text="Я вижу, что наш разговор зашел вглубь, и тебе действительно нужна помощь. "
                 "Чтобы продолжить работу над твоей ситуацией более детально и дать тебе полноценную поддержку, "
@@ -844,7 +3839,35 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "Хочешь продолжить консультацию?"
             )
     except Exception as e:
-        await update.message.reply_text(f"Извините, произошла ошибка: {str(e)}")
+        await reply(update.message, f"Извините, произошла ошибка: {str(e)}")
+
+
+async def stream_reply(update: Update, user_id: str, text: str):
+    """
+    Потоковый ответ: первое сообщение отправляется с первым фрагментом,
+    далее оно редактируется не чаще одного раза в STREAM_EDIT_INTERVAL секунд
+    """
+    message = None
+    sent_text = ""
+    last_edit = 0.0
+    current_text = ""
+    async for current_text in assistant.chat_stream(user_id, text):
+        if not current_text.strip() or current_text == sent_text:
+            continue
+        if message is None:
+            message = await reply(update.message, current_text)
+        elif time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL:
+            await edit(message, current_text)
+        else:
+            continue
+        sent_text = current_text
+        last_edit = time.monotonic()
+    
+    # Окончательный текст отправляем всегда, даже если интервал еще не прошел
+    if message is None:
+        await reply(update.message, current_text or "Извините, не удалось получить ответ.")
+    elif current_text and current_text != sent_text:
+        await edit(message, current_text)
 
 
 async def offer_payment(update: Update, user_id: str):
@@ -883,143 +3906,196 @@ async def offer_payment(update: Update, user_id: str):
     # Отправляем сообщение через update.message или через context
     try:
         if update.message:
-            await update.message.reply_text(payment_text, reply_markup=keyboard)
+            await reply(update.message, payment_text, reply_markup=keyboard)
         elif update.effective_chat:
             # Если нет update.message, используем глобальный application
             global application
             if application and application.bot:
-                await application.bot.send_message(chat_id=update.effective_chat.id, text=payment_text, reply_markup=keyboard)
+                await send_text(chat_id=update.effective_chat.id, text=payment_text, reply_markup=keyboard)
             else:
                 print("⚠ Ошибка: application не инициализирован для отправки сообщения")
     except Exception as e:
         print(f"⚠ Ошибка при отправке предложения оплаты: {e}")
 
 
-@app.route('/')
-def health_check():
+async def health_check(request: Request):
     """Health check endpoint для проверки работоспособности"""
     # Быстрый ответ для проверки доступности
-    return jsonify({
+    return JSONResponse({
         "status": "ok",
         "service": "psychologist_assistant_bot",
         "message": "Сервис работает",
         "port": HTTP_PORT
-    }), 200
+    }, status_code=200)
 
 
-@app.route('/health')
-def health():
+async def health(request: Request):
     """Health check endpoint - должен отвечать быстро для прохождения проверки"""
     # Простой и быстрый ответ без дополнительных проверок
-    return jsonify({
+    return JSONResponse({
         "status": "healthy",
         "service": "psychologist_assistant_bot",
         "port": HTTP_PORT
-    }), 200
+    }, status_code=200)
+
+
+async def metrics_endpoint(request: Request):
+    """Метрики в текстовом формате Prometheus"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+async def telegram_webhook(request: Request):
+    """Прием обновлений Telegram в режиме webhook"""
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(secret.encode(), TELEGRAM_WEBHOOK_SECRET.encode()):
+        return PlainTextResponse("Forbidden", status_code=403)
+    if router is not None:
+        # Фронт не разбирает обновление целиком - только передает JSON рабочему пользователя
+        try:
+            data = await request.json()
+        except ValueError as e:
+            print(f"⚠ Некорректное обновление от Telegram: {e}")
+            return PlainTextResponse("Bad Request", status_code=400)
+        router.submit(data)
+        return Response(status_code=200)
+    if application is None or not application.running:
+        # Telegram повторит доставку позже
+        return PlainTextResponse("Bot is not ready", status_code=503)
+    try:
+        update = Update.de_json(await request.json(), application.bot)
+    except Exception as e:
+        print(f"⚠ Некорректное обновление от Telegram: {e}")
+        return PlainTextResponse("Bad Request", status_code=400)
+    await application.update_queue.put(update)
+    return Response(status_code=200)
+
+
+async def worker_updates(request: Request):
+    """Прием пачки обновлений Telegram от фронта в рабочем процессе (WORKER_INDEX)"""
+    secret = request.headers.get("X-Worker-Secret", "")
+    if not IS_WORKER or not hmac.compare_digest(secret.encode(), WORKER_SECRET.encode()):
+        return PlainTextResponse("Forbidden", status_code=403)
+    if application is None or not application.running:
+        # Фронт повторит передачу
+        return PlainTextResponse("Bot is not ready", status_code=503)
+    try:
+        batch = await request.json()
+    except ValueError as e:
+        print(f"⚠ Некорректная пачка обновлений от фронта: {e}")
+        return PlainTextResponse("Bad Request", status_code=400)
+    if not isinstance(batch, list):
+        print("⚠ Некорректная пачка обновлений от фронта: ожидается список")
+        return PlainTextResponse("Bad Request", status_code=400)
+    for data in batch:
+        try:
+            update = Update.de_json(data, application.bot)
+        except Exception as e:
+            print(f"⚠ Некорректное обновление от фронта: {e}")
+            continue
+        await application.update_queue.put(update)
+    return Response(status_code=200)
+
+
+async def robokassa_params(request: Request) -> tuple:
+    """
+    Параметры уведомления Robokassa (GET или POST): (invoice_id, out_sum, signature)
+    OutSum берем как строку, без преобразования к float,
+    чтобы не потерять формат, использованный при расчете подписи
+    """
+    params = await request.form() if request.method == 'POST' else request.query_params
+    try:
+        invoice_id = int(params.get('InvId'))
+    except (TypeError, ValueError):
+        invoice_id = None
+    return invoice_id, params.get('OutSum'), params.get('SignatureValue', '')
+
 
+def robokassa_outcome(outcome: str):
+    """Учет результата уведомления Robokassa в метриках и спане трассировки"""
+    ROBOKASSA_CALLBACKS_TOTAL.labels(outcome).inc()
+    tracer.set_attribute("outcome", outcome)
 
-@app.route('/robokassa/result', methods=['GET', 'POST'])
-def robokassa_result():
+
+@traced("robokassa.result", SPAN_SERVER, root=True)
+async def robokassa_result(request: Request):
     """
     Обработка уведомления от Robokassa об успешной оплате (ResultURL)
     Robokassa отправляет уведомления методом GET или POST
     """
+    if router is not None:
+        return await router.forward_robokassa(request)
     try:
         # Получаем параметры из запроса
-        if request.method == 'POST':
-            invoice_id = request.form.get('InvId', type=int)
-            # ВАЖНО: OutSum берем как строку, без преобразования к float,
-            # чтобы не потерять формат, использованный при расчете подписи
-            out_sum = request.form.get('OutSum')
-            signature = request.form.get('SignatureValue', '')
-        else:
-            invoice_id = request.args.get('InvId', type=int)
-            out_sum = request.args.get('OutSum')
-            signature = request.args.get('SignatureValue', '')
+        invoice_id, out_sum, signature = await robokassa_params(request)
         
         if not invoice_id or not out_sum or not signature:
-            return "ERROR: Missing parameters", 400
+            robokassa_outcome("bad_request")
+            return PlainTextResponse("ERROR: Missing parameters", status_code=400)
         
-        # Получаем информацию о платеже до обработки
-        payment_info = assistant.payment_system.get_payment_info(invoice_id)
-        user_id = payment_info.get("user_id") if payment_info else None
+        # Повторное уведомление по оплаченному счету: ответ из памяти, без пула потоков и хранилища
+        cached = assistant.payment_system.cached_result(invoice_id, out_sum, signature)
+        if cached is not None:
+            robokassa_outcome("duplicate")
+            return PlainTextResponse(cached, status_code=200)
         
-        # Обрабатываем платеж
-        if assistant.payment_system.process_robokassa_payment(invoice_id, out_sum, signature):
-            # Отправляем уведомление пользователю в Telegram
+        # Обрабатываем платеж (запись в хранилище - в пуле потоков)
+        status, payment_info = await blocking.run(
+            assistant.payment_system.process_robokassa_result, invoice_id, out_sum, signature
+        )
+        robokassa_outcome(status)
+        if status != "invalid":
+            # Уведомление отправляем только для счета, оплаченного этим запросом
+            user_id = payment_info.get("user_id") if status == "paid" else None
             if user_id:
                 try:
                     description = payment_info.get("description", "консультация")
-                    # Теплое сообщение после оплаты
-                    if application is not None:
-                        try:
-                            # Получаем event loop из application
-                            loop = application.updater._event_loop if hasattr(application.updater, '_event_loop') else None
-                            if loop is None:
-                                # Если loop еще не создан, создаем новый
-                                loop = asyncio.new_event_loop()
-                                thread = threading.Thread(target=lambda: loop.run_forever(), daemon=True)
-                                thread.start()
-                            
-                            asyncio.run_coroutine_threadsafe(
-                                application.bot.send_message(
-                                    chat_id=int(user_id),
-                                    text=f"""Спасибо за доверие!
+                    # Теплое сообщение после оплаты (доставляет очередь уведомлений)
+                    await notifications.submit(
+                        chat_id=int(user_id),
+                        text=f"""Спасибо за доверие!
 
 Оплата получена:
 Тариф: {description}
-Сумма: {out_sum:,.0f} ₽
+Сумма: {float(out_sum):,.0f} ₽
 Номер счета: {invoice_id}
 
 Отлично! Теперь у нас есть время для полноценной работы. Я готов продолжить наш разговор и помочь тебе разобраться в ситуации.
 
 Напиши мне, что тебя беспокоит, и мы начнем работу."""
-                                ),
-                                loop,
-                            )
-                        except Exception as send_error:
-                            print(f"⚠ Ошибка при отправке сообщения пользователю {user_id}: {send_error}")
+                    )
                     
                     # Сбрасываем счетчик бесплатных сообщений
                     if user_id in free_messages:
-                        del free_messages[user_id]
+                        await blocking.run(free_messages.discard, user_id)
                 except Exception as e:
                     print(f"Ошибка при отправке уведомления пользователю {user_id}: {e}")
             
             # Возвращаем OK для Robokassa (обязательно в формате OK{invoice_id})
-            return f"OK{invoice_id}", 200
+            return PlainTextResponse(f"OK{invoice_id}", status_code=200)
         else:
-            return "ERROR: Invalid signature or payment not found", 400
+            return PlainTextResponse("ERROR: Invalid signature or payment not found", status_code=400)
             
     except Exception as e:
+        robokassa_outcome("error")
         print(f"Ошибка при обработке уведомления от Robokassa: {e}")
-        return f"ERROR: {str(e)}", 500
+        return PlainTextResponse(f"ERROR: {str(e)}", status_code=500)
 
 
-@app.route('/robokassa/success', methods=['GET', 'POST'])
-def robokassa_success():
+async def robokassa_success(request: Request):
     """
     Обработка успешной оплаты (SuccessURL)
     Пользователь перенаправляется сюда после успешной оплаты
     """
     try:
-        # Получаем параметры
-        if request.method == 'POST':
-            invoice_id = request.form.get('InvId', type=int)
-            # Для проверки подписи на SuccessURL также важно сохранить формат OutSum
-            out_sum = request.form.get('OutSum')
-            signature = request.form.get('SignatureValue', '')
-        else:
-            invoice_id = request.args.get('InvId', type=int)
-            out_sum = request.args.get('OutSum')
-            signature = request.args.get('SignatureValue', '')
+        # Получаем параметры (для проверки подписи на SuccessURL также важно сохранить формат OutSum)
+        invoice_id, out_sum, signature = await robokassa_params(request)
         
         if invoice_id and out_sum and signature:
             # Проверяем подпись (для SuccessURL используется Пароль #1)
             if assistant.payment_system.robokassa.verify_signature(
                 out_sum, invoice_id, signature, assistant.payment_system.robokassa.password_1
             ):
-                return """
+                return HTMLResponse("""
                 <!DOCTYPE html>
                 <html>
                 <head>
@@ -1050,9 +4126,9 @@ def robokassa_success():
                     </div>
                 </body>
                 </html>
-                """, 200
+                """, status_code=200)
         
-        return """
+        return HTMLResponse("""
         <!DOCTYPE html>
         <html>
         <head>
@@ -1082,20 +4158,19 @@ def robokassa_success():
             </div>
         </body>
         </html>
-        """, 200
+        """, status_code=200)
         
     except Exception as e:
         print(f"Ошибка при обработке SuccessURL: {e}")
-        return f"<html><body><h1>Ошибка</h1><p>{str(e)}</p></body></html>", 500
+        return HTMLResponse(f"<html><body><h1>Ошибка</h1><p>{str(e)}</p></body></html>", status_code=500)
 
 
-@app.route('/robokassa/fail', methods=['GET', 'POST'])
-def robokassa_fail():
+async def robokassa_fail(request: Request):
     """
     Обработка неудачной оплаты (FailURL)
     Пользователь перенаправляется сюда при отмене или ошибке оплаты
     """
-    return """
+    return HTMLResponse("""
     <!DOCTYPE html>
     <html>
     <head>
@@ -1126,14 +4201,95 @@ def robokassa_fail():
         </div>
     </body>
     </html>
-    """, 200
+    """, status_code=200)
+
+
+# HTTP сервер (ASGI): health check, webhook Telegram и уведомления Robokassa
+app = Starlette(routes=[
+    Route('/', health_check),
+    Route('/health', health),
+    Route(METRICS_PATH, metrics_endpoint),
+    Route(TELEGRAM_WEBHOOK_PATH, telegram_webhook, methods=['POST']),
+    Route(WORKER_UPDATES_PATH, worker_updates, methods=['POST']),
+    Route('/robokassa/result', robokassa_result, methods=['GET', 'POST']),
+    Route('/robokassa/success', robokassa_success, methods=['GET', 'POST']),
+    Route('/robokassa/fail', robokassa_fail, methods=['GET', 'POST']),
+])
+
+
+async def start_background_tasks(application: Application):
+    """Запуск фоновых задач после инициализации бота"""
+    background_tasks.append(asyncio.create_task(sweep_idle_sessions()))
+    background_tasks.append(asyncio.create_task(sweep_pending_payments()))
+    if tracer.sample_rate > 0:
+        background_tasks.append(asyncio.create_task(export_traces()))
+    outbound.start()
+    notifications.start(send_payment_notification)
+
+
+async def shutdown_bot(application: Application):
+    """Освобождение ресурсов при остановке бота"""
+    await notifications.stop()
+    await outbound.stop()
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    if assistant is not None:
+        await assistant.close()
+    # Сохраняем сессии, чтобы разговоры продолжились после перезапуска
+    for store in session_stores():
+        await blocking.run(store.flush)
+    await blocking.run(tracer.exporter.flush)
+
+
+async def count_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    UPDATES_TOTAL.inc()
+
+
+def build_application() -> Application:
+    """Создание Telegram Application с обработчиками"""
+    builder = Application.builder().token(TELEGRAM_BOT_TOKEN).concurrent_updates(True)
+    if TELEGRAM_API_BASE_URL:
+        # Например, локальный заменитель Telegram Bot API (tools/local_stubs.py)
+        builder = builder.base_url(f"{TELEGRAM_API_BASE_URL}/bot").base_file_url(f"{TELEGRAM_API_BASE_URL}/file/bot")
+    bot_application = builder.build()
+    
+    # Счетчик всех обновлений (группа -1 выполняется раньше остальных обработчиков и их не блокирует)
+    bot_application.add_handler(TypeHandler(Update, count_update, block=False), group=-1)
+    bot_application.add_handler(CommandHandler("start", start_command))
+    bot_application.add_handler(CommandHandler("new", new_session_command))
+    bot_application.add_handler(CommandHandler("exit", exit_command))
+    bot_application.add_handler(CommandHandler("stop", exit_command))
+    bot_application.add_handler(CallbackQueryHandler(tariff_callback, pattern=r"^tariff_"))
+    bot_application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    return bot_application
+
+
+async def forward_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    router.submit(update.to_dict())
+
+
+def build_front_application() -> Application:
+    """
+    Application фронта многопроцессного режима: получает обновления (polling) и передает их рабочим
+    Обновления идут по одному, чтобы порядок в очередях рабочих совпадал с порядком от Telegram
+    """
+    builder = Application.builder().token(TELEGRAM_BOT_TOKEN).concurrent_updates(False)
+    if TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_BASE_URL}/bot").base_file_url(f"{TELEGRAM_API_BASE_URL}/file/bot")
+    front_application = builder.build()
+    front_application.add_handler(TypeHandler(Update, forward_update))
+    return front_application
 
 
-def run_bot():
-    """Запуск Telegram бота в отдельном потоке"""
+async def run_bot():
+    """
+    Запуск Telegram бота в том же event loop, что и HTTP сервер
+    В режиме polling обновления получает updater, в режиме webhook их присылает
+    Telegram на TELEGRAM_WEBHOOK_PATH HTTP сервера. Фронт многопроцессного режима
+    только получает обновления, рабочий процесс - только обрабатывает (их присылает фронт)
+    """
     global application
-    import sys
-    sys.stdout.flush()  # Принудительно сбрасываем буфер вывода
     
     if not TELEGRAM_BOT_TOKEN:
         print("❌ ОШИБКА: TELEGRAM_BOT_TOKEN не задан. Бот не может быть запущен.")
@@ -1146,77 +4302,84 @@ def run_bot():
     print("=" * 60)
     sys.stdout.flush()
     
+    while True:
+        try:
+            print("✓ Создание Application объекта...")
+            application = build_front_application() if router is not None else build_application()
+            print("✓ Application создан, обработчики добавлены")
+            sys.stdout.flush()
+            
+            async with application:
+                await application.start()
+                try:
+                    # Фоновые задачи - только после успешного start() и внутри try: при сбое запуска
+                    # finally их остановит, и перезапуск не создаст вторые экземпляры
+                    if router is None:
+                        await start_background_tasks(application)
+                    if IS_WORKER:
+                        print(f"🚀 Рабочий процесс {WORKER_INDEX}: обновления присылает фронт")
+                    elif TELEGRAM_MODE == "webhook":
+                        await application.bot.set_webhook(
+                            url=TELEGRAM_WEBHOOK_URL,
+                            secret_token=TELEGRAM_WEBHOOK_SECRET,
+                            allowed_updates=Update.ALL_TYPES
+                        )
+                        print(f"🚀 Webhook установлен ({TELEGRAM_WEBHOOK_URL}), ожидаю обновления...")
+                    else:
+                        await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+                        print("🚀 Запуск polling...")
+                    print("=" * 60)
+                    sys.stdout.flush()
+                    await asyncio.Event().wait()
+                finally:
+                    try:
+                        if application.updater and application.updater.running:
+                            await application.updater.stop()
+                        await application.stop()
+                    finally:
+                        if router is None:
+                            await shutdown_bot(application)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"❌ КРИТИЧЕСКАЯ ОШИБКА в работе бота: {e}")
+            import traceback
+            traceback.print_exc()
+            # Пытаемся перезапустить через 10 секунд
+            print("Попытка перезапуска через 10 секунд...")
+            sys.stdout.flush()
+            await asyncio.sleep(10)
+
+
+async def serve():
+    """HTTP сервер (ASGI) и Telegram бот в одном event loop"""
+    # Рабочие процессы доступны только фронту
+    host = "127.0.0.1" if IS_WORKER else "0.0.0.0"
+    config = uvicorn.Config(app, host=host, port=HTTP_PORT, access_log=False)
+    server = uvicorn.Server(config)
+    # Остановившись по сигналу, uvicorn повторяет его с прежним обработчиком; для SIGTERM (docker stop,
+    # остановка рабочих фронтом) это немедленное завершение процесса - без остановки бота и сохранения
+    # сессий ниже. Сам SIGTERM uvicorn обрабатывает, пока работает сервер
+    signal.signal(signal.SIGTERM, lambda signum, frame: None)
+    if router is not None:
+        router.start()
+    bot_task = asyncio.create_task(run_bot()) if TELEGRAM_BOT_TOKEN else None
+    watch_task = asyncio.create_task(watch_front()) if IS_WORKER else None
     try:
-        print("✓ Создание Application объекта...")
-        sys.stdout.flush()
-        # Создаем приложение
-        application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
-        print("✓ Application создан")
-        sys.stdout.flush()
-        
-        print("✓ Добавление обработчиков...")
-        sys.stdout.flush()
-        # Добавляем обработчики
-        application.add_handler(CommandHandler("start", start_command))
-        application.add_handler(CommandHandler("new", new_session_command))
-        application.add_handler(CommandHandler("exit", exit_command))
-        application.add_handler(CommandHandler("stop", exit_command))
-        application.add_handler(CallbackQueryHandler(tariff_callback, pattern=r"^tariff_"))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-        
-        print("✓ Обработчики добавлены")
-        print("✓ Бот инициализирован, начинаю polling...")
-        print("=" * 60)
-        sys.stdout.flush()
-        
-        # Просто используем run_polling - он сам создаст нужный event loop
-        # Это самый надежный способ запуска бота
-        print("🚀 Запуск polling...")
-        sys.stdout.flush()
-        application.run_polling(
-            allowed_updates=Update.ALL_TYPES,
-            close_loop=False,
-            stop_signals=None  # Отключаем обработку сигналов
-        )
-        
-    except KeyboardInterrupt:
-        print("⚠ Получен сигнал прерывания")
-        sys.stdout.flush()
-    except Exception as e:
-        print(f"❌ КРИТИЧЕСКАЯ ОШИБКА в работе бота: {e}")
-        import traceback
-        traceback.print_exc()
-        sys.stdout.flush()
-        # Пытаемся перезапустить через 10 секунд
-        print("Попытка перезапуска через 10 секунд...")
-        sys.stdout.flush()
-        time.sleep(10)
-        run_bot()
-
-
-def init_bot():
-    """Инициализация бота в отдельном потоке"""
-    # Небольшая задержка, чтобы Flask успел запуститься и ответить на healthcheck
-    # Healthcheck обычно проверяет через 40 секунд (start-period), так что 3 секунды достаточно
-    time.sleep(3)
-    print("✓ Запуск потока Telegram бота...")
-    print(f"✓ ID потока: {threading.current_thread().ident}")
-    print(f"✓ Имя потока: {threading.current_thread().name}")
-    try:
-        run_bot()
-    except Exception as e:
-        print(f"❌ Фатальная ошибка в потоке бота: {e}")
-        import traceback
-        traceback.print_exc()
-        # Пытаемся перезапустить
-        print("Попытка перезапуска бота через 5 секунд...")
-        time.sleep(5)
-        init_bot()
+        await server.serve()
+    finally:
+        if router is not None:
+            router.terminate()
+        for task in (bot_task, watch_task):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        if router is not None:
+            await router.stop()
 
 
 def main():
-    """Главная функция - Flask как основной процесс для health check"""
-    import sys
+    """Главная функция - HTTP сервер для health check и платежей вместе с ботом"""
     sys.stdout.flush()  # Принудительно сбрасываем буфер вывода
     
     print("=" * 60)
@@ -1227,6 +4390,11 @@ def main():
     # Проверяем переменные окружения
     print(f"✓ HTTP порт: {HTTP_PORT}")
     print(f"✓ BOT_TOKEN задан: {'Да' if TELEGRAM_BOT_TOKEN else 'НЕТ'}")
+    print(f"✓ Получение обновлений Telegram: {TELEGRAM_MODE}")
+    if IS_WORKER:
+        print(f"✓ Рабочий процесс {WORKER_INDEX}")
+    elif router is not None:
+        print(f"✓ Рабочих процессов: {WORKERS} (порты {router.ports[0]}-{router.ports[-1]})")
     if TELEGRAM_BOT_TOKEN:
         print(f"✓ Токен начинается с: {TELEGRAM_BOT_TOKEN[:10]}...")
     print(f"✓ GIGACHAT_API_KEY задан: {'Да' if GIGACHAT_API_KEY else 'Нет'}")
@@ -1234,32 +4402,19 @@ def main():
     print("=" * 60)
     sys.stdout.flush()
     
-    # Запускаем бота в отдельном потоке ПЕРЕД запуском Flask
-    # ВАЖНО: daemon=False, чтобы поток не завершался при остановке основного потока
-    if TELEGRAM_BOT_TOKEN:
-        print("✓ Создание потока для Telegram бота...")
-        sys.stdout.flush()
-        bot_thread = threading.Thread(target=init_bot, daemon=False, name="TelegramBotThread")
-        bot_thread.start()
-        print("✓ Поток Telegram бота запущен (не-daemon)")
-        print(f"✓ ID потока: {bot_thread.ident}")
-        print("✓ Бот будет работать независимо от Flask")
-        sys.stdout.flush()
-    else:
+    if not TELEGRAM_BOT_TOKEN:
         print("⚠ Telegram бот не запущен (нет BOT_TOKEN)")
         print("⚠ Проверьте переменную окружения BOT_TOKEN")
         sys.stdout.flush()
     
-    # Сначала запускаем Flask, чтобы healthcheck мог сразу проверить приложение
-    print(f"✓ Запуск HTTP сервера Flask на порту {HTTP_PORT}")
+    # HTTP сервер - основной процесс, который проверяет Docker health check;
+    # бот работает в том же event loop, без отдельных потоков
+    print(f"✓ Запуск HTTP сервера на порту {HTTP_PORT}")
     print("✓ Сервис готов к работе")
     print("=" * 60)
     sys.stdout.flush()
     
-    # Flask запускается в основном потоке - это важно для health check
-    # Это основной процесс, который Docker будет проверять
-    # Используем threaded=True для обработки нескольких запросов одновременно
-    app.run(host='0.0.0.0', port=HTTP_PORT, debug=False, use_reloader=False, threaded=True)
+    asyncio.run(serve())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Проверка устойчивости клиента GigaChat на локальном заменителе со сбоями
+
+Сценарии: таймаут чтения, повторы при 503 и обрыве соединения, соблюдение Retry-After,
+размыкание и восстановление предохранителя (с ответом-заглушкой ассистента), ошибки 4xx
+без размыкания, повтор установки потока и дублирующие запросы против медленных ответов.
+
+Запуск: python tools/gigachat_resilience.py
+Код возврата 1, если хотя бы один сценарий не прошел.
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Импорт бота создает файлы хранилищ в текущем каталоге - уводим их во временный
+os.chdir(tempfile.mkdtemp(prefix="gigachat_resilience_"))
+import telegram_bot  # noqa: E402
+from local_stubs import GigaChatStub  # noqa: E402
+
+MESSAGES = [{"role": "user", "content": "Привет"}]
+
+
+def make_client(stub: GigaChatStub, **kwargs) -> telegram_bot.AsyncGigaChatClient:
+    options = dict(read_timeout=2.0, connect_timeout=1.0, max_retries=3, retry_base_delay=0.05,
+                   retry_max_delay=2.0)
+    breaker = telegram_bot.CircuitBreaker(kwargs.pop("threshold", 5), kwargs.pop("reset", 30.0))
+    options.update(kwargs)
+    return telegram_bot.AsyncGigaChatClient("stub", auth_url=stub.auth_url, chat_url=stub.chat_url,
+                                            breaker=breaker, **options)
+
+
+async def timed(coro):
+    started = time.perf_counter()
+    try:
+        return await coro, time.perf_counter() - started
+    except Exception as e:
+        return e, time.perf_counter() - started
+
+
+async def read_timeout(stub):
+    client = make_client(stub, read_timeout=0.3, max_retries=0)
+    stub.inject("delay", delay=2.0)
+    result, elapsed = await timed(client.chat(MESSAGES))
+    await client.aclose()
+    return isinstance(result, Exception) and elapsed < 1.0, f"ошибка через {elapsed:.2f} с: {result}"
+
+
+async def retry_on_503(stub):
+    client = make_client(stub)
+    stub.inject("status", count=2, status=503)
+    result, elapsed = await timed(client.chat(MESSAGES))
+    await client.aclose()
+    return isinstance(result, str) and client.retries == 2, f"повторов: {client.retries}, {elapsed:.2f} с"
+
+
+async def retry_after(stub):
+    client = make_client(stub)
+    stub.inject("status", status=429, retry_after=1)
+    result, elapsed = await timed(client.chat(MESSAGES))
+    await client.aclose()
+    return isinstance(result, str) and elapsed >= 1.0, f"ответ через {elapsed:.2f} с (Retry-After: 1)"
+
+
+async def dropped_connection(stub):
+    client = make_client(stub)
+    stub.inject("drop")
+    result, _ = await timed(client.chat(MESSAGES))
+    await client.aclose()
+    return isinstance(result, str) and client.retries == 1, f"повторов: {client.retries}"
+
+
+async def breaker_opens_and_recovers(stub):
+    client = make_client(stub, threshold=3, reset=0.5, max_retries=0)
+    stub.inject("status", count=3, status=503)
+    for _ in range(3):
+        await timed(client.chat(MESSAGES))
+    opened = client.breaker.state == telegram_bot.CircuitBreaker.OPEN
+
+    assistant = telegram_bot.PsychologistAssistant("stub", telegram_bot.SessionSpillStorage("sessions.db"))
+    await assistant.gigachat.aclose()
+    assistant.gigachat = client
+    requests_before = stub.stats["requests"]
+    reply, fast = await timed(assistant.chat("1", "Привет"))
+    rejected = reply == telegram_bot.GIGACHAT_FALLBACK_REPLY and stub.stats["requests"] == requests_before
+    # Реплика, оставшаяся без ответа, не должна остаться в истории
+    history = assistant.get_user_session("1")
+    rolled_back = len(history) == 0 and history.tokens == 0
+
+    await asyncio.sleep(0.6)
+    probe, _ = await timed(client.chat(MESSAGES))
+    closed = isinstance(probe, str) and client.breaker.state == telegram_bot.CircuitBreaker.CLOSED
+    await client.aclose()
+    return opened and rejected and rolled_back and closed, (
+        f"разомкнут: {opened}, заглушка за {fast * 1000:.1f} мс без запроса: {rejected}, "
+        f"история без реплики: {rolled_back}, замкнут после пробы: {closed}"
+    )
+
+
+async def client_errors_keep_breaker_closed(stub):
+    client = make_client(stub, threshold=2, max_retries=0)
+    stub.inject("status", count=3, status=400)
+    for _ in range(3):
+        await timed(client.chat(MESSAGES))
+    await client.aclose()
+    state = client.breaker.state
+    return state == telegram_bot.CircuitBreaker.CLOSED, f"состояние после трех ответов 400: {state}"
+
+
+async def stream_retry(stub):
+    client = make_client(stub)
+    stub.inject("status", status=502)
+    chunks = []
+    async for chunk in client.chat_stream(MESSAGES):
+        chunks.append(chunk)
+    await client.aclose()
+    return "".join(chunks) == stub.reply and client.retries == 1, f"фрагментов: {len(chunks)}"
+
+
+async def hedging(stub):
+    async def p95(hedge_delay: float) -> float:
+        client = make_client(stub, hedge_delay=hedge_delay)
+        latencies = []
+        for _ in range(100):
+            _, elapsed = await timed(client.chat(MESSAGES))
+            latencies.append(elapsed)
+        await client.aclose()
+        latencies.sort()
+        return latencies[int(len(latencies) * 0.95) - 1]
+
+    # Медленный каждый десятый ответ: без дублирования он попадает в p95, с дублированием
+    # медленными остаются только пары, где оба запроса медленные (~1%)
+    stub.slow_rate, stub.slow_delay = 0.1, 1.0
+    try:
+        plain = await p95(0.0)
+        hedged = await p95(0.15)
+    finally:
+        stub.slow_rate = 0.0
+    return hedged < plain / 2, f"p95 без дублирования {plain * 1000:.0f} мс, с дублированием {hedged * 1000:.0f} мс"
+
+
+SCENARIOS = [
+    ("таймаут чтения", read_timeout),
+    ("повторы при 503", retry_on_503),
+    ("Retry-After", retry_after),
+    ("обрыв соединения", dropped_connection),
+    ("предохранитель", breaker_opens_and_recovers),
+    ("4xx не размыкает предохранитель", client_errors_keep_breaker_closed),
+    ("повтор установки потока", stream_retry),
+    ("дублирующие запросы", hedging),
+]
+
+
+async def main() -> int:
+    stub = GigaChatStub(port=0, base_latency=0.02, prefill_per_char=0.0, seed=1).start()
+    failed = 0
+    try:
+        for name, scenario in SCENARIOS:
+            stub.clear_faults()
+            passed, details = await scenario(stub)
+            failed += not passed
+            print(f"{'✓' if passed else '✗'} {name}: {details}")
+    finally:
+        stub.stop()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,597 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Локальные заменители внешних сервисов для проверки бота без сети
+
+TelegramStub - заменитель Telegram Bot API:
+  - отвечает на методы бота (getMe, getUpdates, sendMessage, editMessageText, setWebhook и т.д.)
+  - принимает "входящие" обновления и либо отдает их через getUpdates,
+    либо доставляет на webhook, установленный ботом через setWebhook
+  - запоминает все отправленные ботом сообщения
+
+GigaChatStub - заменитель GigaChat API:
+  - выдает OAuth-токены и отвечает на /chat/completions (обычный ответ и поток SSE)
+  - имитирует кэш начала запроса по заголовку X-Session-ID: задержка ответа растет
+    с числом символов, которых нет в кэше разговора
+  - ведет статистику запросов и закэшированных символов
+  - внедряет сбои: ответы 429/5xx (с Retry-After), задержки, зависания, обрыв соединения,
+    а также случайные ошибки и медленные ответы с заданной долей
+  - скорость генерации задается в токенах в секунду (tokens_per_second)
+
+RobokassaStub - заменитель Robokassa на стороне покупателя:
+  - "оплачивает" счет по ссылке на оплату, выданной ботом: отправляет на ResultURL бота
+    уведомление с подписью по Паролю #2, как это делает Robokassa после оплаты
+
+Запуск:
+    python tools/local_stubs.py telegram --port 8081
+    python tools/local_stubs.py gigachat --port 8082
+    python tools/local_stubs.py robokassa "<ссылка на оплату>" --password-2 ... --result-url ...
+Бот подключается к заменителям через переменные окружения:
+    TELEGRAM_API_BASE_URL=http://localhost:8081
+    GIGACHAT_AUTH_URL=http://localhost:8082/api/v2/oauth
+    GIGACHAT_CHAT_URL=http://localhost:8082/api/v1/chat/completions
+
+Управление заменителем Telegram по HTTP:
+    POST /_stub/updates  {"user_id": 1, "text": "Привет"} или готовый объект Update
+    GET  /_stub/sent     список отправленных ботом сообщений
+Заменитель GigaChat:
+    GET  /_stub/stats    статистика запросов
+    POST /_stub/faults   {"kind": "status", "status": 503, "count": 2, "retry_after": 1}
+                         kind: status | delay | drop, delay - пауза в секундах
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional
+from urllib.parse import parse_qs, parse_qsl, urlparse
+
+
+def _read_params(handler: BaseHTTPRequestHandler) -> Dict:
+    """Разбор параметров запроса (JSON или form-urlencoded, значения-объекты в JSON)"""
+    length = int(handler.headers.get("Content-Length") or 0)
+    body = handler.rfile.read(length) if length else b""
+    params: Dict = dict(parse_qsl(urlparse(handler.path).query))
+    content_type = handler.headers.get("Content-Type", "")
+    if body and "application/json" in content_type:
+        params.update(json.loads(body.decode("utf-8")))
+    elif body:
+        params.update(parse_qsl(body.decode("utf-8")))
+    for key, value in list(params.items()):
+        if isinstance(value, str) and value[:1] in ("{", "["):
+            try:
+                params[key] = json.loads(value)
+            except ValueError:
+                pass
+    return params
+
+
+def _send_json(handler: BaseHTTPRequestHandler, status: int, data):
+    body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+    handler.send_response(status)
+    handler.send_header("Content-Type", "application/json")
+    handler.send_header("Content-Length", str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+class _ThreadingServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Очередь входящих соединений больше стандартных 5 - под нагрузкой клиенты не ждут повторного SYN
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # Клиент закрыл соединение, не дождавшись ответа (таймаут, отмена дублирующего запроса)
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+
+class StubServer:
+    """HTTP сервер заменителя в отдельном потоке"""
+
+    name = "Stub"
+
+    def __init__(self, host: str, port: int):
+        self.server = _ThreadingServer((host, port), self._make_handler())
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True, name=self.name)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _make_handler(self):
+        raise NotImplementedError
+
+
+class TelegramStub(StubServer):
+    """Локальный заменитель Telegram Bot API"""
+
+    name = "TelegramStub"
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8081, bot_username: str = "stub_bot"):
+        self.bot_user = {"id": 100000, "is_bot": True, "first_name": "Stub", "username": bot_username}
+        self.webhook_url: Optional[str] = None
+        self.webhook_secret: Optional[str] = None
+        self.sent: List[Dict] = []
+        self.listeners: List[Callable[[Dict], None]] = []
+        self.webhook_errors = 0
+        self._updates: List[Dict] = []
+        self._cond = threading.Condition()
+        self._next_update_id = 1
+        self._next_message_id = 1
+        self._delivery = ThreadPoolExecutor(max_workers=16, thread_name_prefix="webhook")
+        super().__init__(host, port)
+
+    def stop(self):
+        super().stop()
+        self._delivery.shutdown(wait=False)
+
+    # --- Входящие обновления -------------------------------------------------
+
+    def message_update(self, user_id: int, text: str, first_name: str = "User") -> Dict:
+        """Обновление с текстовым сообщением пользователя"""
+        user = {"id": user_id, "is_bot": False, "first_name": first_name}
+        message = {
+            "message_id": self._new_message_id(),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": first_name},
+            "from": user,
+            "text": text,
+        }
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        return {"message": message}
+
+    def callback_update(self, user_id: int, data: str, first_name: str = "User") -> Dict:
+        """Обновление с нажатием inline-кнопки"""
+        user = {"id": user_id, "is_bot": False, "first_name": first_name}
+        return {
+            "callback_query": {
+                "id": str(self._new_message_id()),
+                "from": user,
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": {
+                    "message_id": self._new_message_id(),
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private", "first_name": first_name},
+                    "from": self.bot_user,
+                    "text": "",
+                },
+            }
+        }
+
+    def push_update(self, update: Dict) -> Dict:
+        """Постановка обновления: доставка на webhook или в очередь getUpdates"""
+        with self._cond:
+            update = dict(update, update_id=self._next_update_id)
+            self._next_update_id += 1
+            if self.webhook_url is None:
+                self._updates.append(update)
+                self._cond.notify_all()
+                return update
+        self._delivery.submit(self._deliver, update)
+        return update
+
+    def _deliver(self, update: Dict):
+        """Доставка обновления на webhook бота"""
+        headers = {"Content-Type": "application/json"}
+        if self.webhook_secret:
+            headers["X-Telegram-Bot-Api-Secret-Token"] = self.webhook_secret
+        request = urllib.request.Request(
+            self.webhook_url, data=json.dumps(update).encode("utf-8"), headers=headers, method="POST"
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                response.read()
+        except Exception as e:
+            self.webhook_errors += 1
+            print(f"⚠ Ошибка доставки обновления {update['update_id']} на webhook: {e}")
+
+    # --- Методы Bot API -------------------------------------------------------
+
+    def _new_message_id(self) -> int:
+        with self._cond:
+            message_id = self._next_message_id
+            self._next_message_id += 1
+        return message_id
+
+    def _record(self, method: str, params: Dict, message_id: int) -> Dict:
+        chat_id = int(params.get("chat_id", 0))
+        record = {
+            "method": method,
+            "chat_id": chat_id,
+            "message_id": message_id,
+            "text": params.get("text", ""),
+            "reply_markup": params.get("reply_markup"),
+            "time": time.time(),
+        }
+        self.sent.append(record)
+        for listener in self.listeners:
+            listener(record)
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": self.bot_user,
+            "text": record["text"],
+        }
+
+    def _get_updates(self, params: Dict) -> List[Dict]:
+        offset = int(params.get("offset", 0) or 0)
+        timeout = float(params.get("timeout", 0) or 0)
+        limit = int(params.get("limit", 100) or 100)
+        deadline = time.time() + timeout
+        with self._cond:
+            # Обновления с update_id < offset подтверждены ботом
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+            while not self._updates and time.time() < deadline:
+                self._cond.wait(deadline - time.time())
+            return self._updates[:limit]
+
+    def call(self, method: str, params: Dict):
+        """Выполнение метода Bot API, возвращает result или None для неизвестного метода"""
+        if method == "getMe":
+            return self.bot_user
+        if method == "getUpdates":
+            return self._get_updates(params)
+        if method == "setWebhook":
+            self.webhook_url = params.get("url") or None
+            self.webhook_secret = params.get("secret_token") or None
+            return True
+        if method == "deleteWebhook":
+            self.webhook_url = None
+            self.webhook_secret = None
+            return True
+        if method == "getWebhookInfo":
+            return {"url": self.webhook_url or "", "has_custom_certificate": False,
+                    "pending_update_count": len(self._updates)}
+        if method == "sendMessage":
+            return self._record(method, params, self._new_message_id())
+        if method == "editMessageText":
+            return self._record(method, params, int(params.get("message_id", 0)))
+        if method in ("sendChatAction", "answerCallbackQuery", "close", "logOut", "setMyCommands"):
+            return True
+        return None
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                self._dispatch()
+
+            def do_POST(self):
+                self._dispatch()
+
+            def _dispatch(self):
+                path = urlparse(self.path).path
+                params = _read_params(self)
+                if path == "/_stub/updates":
+                    update = params if ("message" in params or "callback_query" in params) \
+                        else stub.message_update(int(params["user_id"]), params.get("text", ""))
+                    _send_json(self, 200, stub.push_update(update))
+                    return
+                if path == "/_stub/sent":
+                    _send_json(self, 200, stub.sent)
+                    return
+                # /bot<token>/<method>
+                parts = path.strip("/").split("/")
+                if len(parts) == 2 and parts[0].startswith("bot"):
+                    result = stub.call(parts[1], params)
+                    if result is not None:
+                        _send_json(self, 200, {"ok": True, "result": result})
+                        return
+                _send_json(self, 404, {"ok": False, "error_code": 404, "description": "Not Found"})
+
+        return Handler
+
+
+DEFAULT_REPLY = (
+    "Я слышу, что тебе сейчас непросто. **Давай разберемся** вместе, что именно вызывает это чувство.\n\n"
+    "Расскажи, пожалуйста, когда ты впервые это заметил и что в тот момент происходило вокруг."
+)
+
+
+class GigaChatStub(StubServer):
+    """
+    Локальный заменитель GigaChat API
+    Задержка ответа: base_latency + prefill_per_char * (символы запроса вне кэша разговора),
+    для потока - еще chunk_delay на каждый фрагмент. Кэш разговора - сообщения предыдущего запроса
+    с тем же X-Session-ID: совпадающее начало запроса считается уже обработанным.
+    Если задан tokens_per_second, генерация ответа занимает (токены ответа) / tokens_per_second
+    (токен - chars_per_token символов): обычный ответ приходит целиком в конце, поток - по фрагментам.
+
+    Сбои для запросов к чату: inject() ставит их в очередь (каждый срабатывает один раз),
+    error_rate и slow_rate - доли случайных ответов 503 и ответов с задержкой slow_delay.
+    """
+
+    name = "GigaChatStub"
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8082, reply: str = DEFAULT_REPLY,
+                 base_latency: float = 0.05, prefill_per_char: float = 0.00002,
+                 chunk_size: int = 20, chunk_delay: float = 0.01,
+                 session_header: str = "X-Session-ID", cache_size: int = 10000,
+                 error_rate: float = 0.0, slow_rate: float = 0.0, slow_delay: float = 1.0, seed: Optional[int] = None,
+                 tokens_per_second: float = 0.0, chars_per_token: float = 3.0):
+        self.reply = reply
+        self.base_latency = base_latency
+        self.prefill_per_char = prefill_per_char
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.session_header = session_header
+        self.cache_size = cache_size
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_delay = slow_delay
+        self.tokens_per_second = tokens_per_second
+        self.chars_per_token = chars_per_token
+        self.stats = {"tokens": 0, "requests": 0, "prompt_chars": 0, "cached_chars": 0, "with_session": 0,
+                      "faults": 0}
+        self._faults: deque = deque()
+        self._random = random.Random(seed)
+        self._cache: "OrderedDict[str, List[str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        super().__init__(host, port)
+
+    @property
+    def auth_url(self) -> str:
+        return f"{self.url}/api/v2/oauth"
+
+    @property
+    def chat_url(self) -> str:
+        return f"{self.url}/api/v1/chat/completions"
+
+    def inject(self, kind: str, count: int = 1, status: int = 503, retry_after: Optional[float] = None,
+               delay: float = 0.0):
+        """
+        Сбой для следующих count запросов к чату
+        kind: "status" - ответ с кодом status (и Retry-After), "delay" - ответ после паузы delay,
+        "drop" - закрыть соединение без ответа
+        """
+        with self._lock:
+            for _ in range(count):
+                self._faults.append({"kind": kind, "status": status, "retry_after": retry_after, "delay": delay})
+
+    def clear_faults(self):
+        with self._lock:
+            self._faults.clear()
+
+    def _next_fault(self) -> Optional[Dict]:
+        with self._lock:
+            if self._faults:
+                fault = self._faults.popleft()
+            elif self._random.random() < self.error_rate:
+                fault = {"kind": "status", "status": 503, "retry_after": None, "delay": 0.0}
+            elif self._random.random() < self.slow_rate:
+                fault = {"kind": "delay", "status": 200, "retry_after": None, "delay": self.slow_delay}
+            else:
+                return None
+            self.stats["faults"] += 1
+        return fault
+
+    @staticmethod
+    def _digest(message: Dict) -> str:
+        content = f"{message.get('role')}\n{message.get('content')}"
+        return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+    def _uncached_chars(self, session_id: Optional[str], messages: List[Dict]) -> int:
+        """Число символов запроса, которых нет в кэше разговора; обновляет кэш"""
+        digests = [self._digest(message) for message in messages]
+        sizes = [len(message.get("content") or "") for message in messages]
+        cached = 0
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats["prompt_chars"] += sum(sizes)
+            if session_id:
+                self.stats["with_session"] += 1
+                previous = self._cache.pop(session_id, [])
+                for old, new in zip(previous, digests):
+                    if old != new:
+                        break
+                    cached += 1
+                self._cache[session_id] = digests
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            cached_chars = sum(sizes[:cached])
+            self.stats["cached_chars"] += cached_chars
+        return sum(sizes) - cached_chars
+
+    def _generation_time(self, chars: int) -> float:
+        """Время генерации chars символов ответа (tokens_per_second = 0 - мгновенно)"""
+        if self.tokens_per_second <= 0:
+            return 0.0
+        return chars / self.chars_per_token / self.tokens_per_second
+
+    def _token(self) -> Dict:
+        with self._lock:
+            self.stats["tokens"] += 1
+            number = self.stats["tokens"]
+        return {"access_token": f"stub-token-{number}", "expires_at": int((time.time() + 1800) * 1000)}
+
+    def _chat(self, handler: BaseHTTPRequestHandler, params: Dict):
+        fault = self._next_fault()
+        if fault is not None:
+            if fault["kind"] == "drop":
+                handler.close_connection = True
+                handler.connection.shutdown(2)
+                return
+            if fault["kind"] == "status":
+                body = json.dumps({"status": fault["status"], "message": "Injected fault"}).encode("utf-8")
+                handler.send_response(fault["status"])
+                handler.send_header("Content-Type", "application/json")
+                handler.send_header("Content-Length", str(len(body)))
+                if fault["retry_after"] is not None:
+                    handler.send_header("Retry-After", str(fault["retry_after"]))
+                handler.end_headers()
+                handler.wfile.write(body)
+                return
+            time.sleep(fault["delay"])
+        session_id = handler.headers.get(self.session_header) if self.session_header else None
+        uncached = self._uncached_chars(session_id, params.get("messages") or [])
+        time.sleep(self.base_latency + self.prefill_per_char * uncached)
+        if not params.get("stream"):
+            time.sleep(self._generation_time(len(self.reply)))
+            _send_json(handler, 200, {
+                "choices": [{"message": {"role": "assistant", "content": self.reply}, "index": 0,
+                             "finish_reason": "stop"}],
+                "model": params.get("model", "GigaChat"),
+                "object": "chat.completion",
+            })
+            return
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.end_headers()
+        for start in range(0, len(self.reply), self.chunk_size):
+            chunk = {"choices": [{"delta": {"content": self.reply[start:start + self.chunk_size]}, "index": 0}]}
+            handler.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            handler.wfile.flush()
+            time.sleep(self.chunk_delay + self._generation_time(self.chunk_size))
+        handler.wfile.write(b"data: [DONE]\n\n")
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if urlparse(self.path).path == "/_stub/stats":
+                    _send_json(self, 200, stub.stats)
+                    return
+                _send_json(self, 404, {"message": "Not Found"})
+
+            def do_POST(self):
+                path = urlparse(self.path).path
+                params = _read_params(self)
+                if path == "/_stub/faults":
+                    stub.inject(params.get("kind", "status"), int(params.get("count", 1)),
+                                int(params.get("status", 503)), params.get("retry_after"),
+                                float(params.get("delay", 0)))
+                    _send_json(self, 200, {"ok": True})
+                elif path == "/api/v2/oauth":
+                    _send_json(self, 200, stub._token())
+                elif path == "/api/v1/chat/completions":
+                    stub._chat(self, params)
+                else:
+                    _send_json(self, 404, {"message": "Not Found"})
+
+        return Handler
+
+
+class RobokassaStub:
+    """
+    Заменитель Robokassa: оплата счета по ссылке, выданной ботом
+    Из ссылки берутся InvId и OutSum; уведомление подписывается Паролем #2 (OutSum:InvId:Пароль#2)
+    и отправляется POST-запросом на result_url, как это делает Robokassa после оплаты
+    """
+
+    def __init__(self, result_url: str, password_2: str, timeout: float = 30):
+        self.result_url = result_url
+        self.password_2 = password_2
+        self.timeout = timeout
+
+    @staticmethod
+    def invoice(payment_url: str) -> Dict[str, str]:
+        """Параметры счета из ссылки на оплату: InvId, OutSum"""
+        query = parse_qs(urlparse(payment_url).query)
+        return {"InvId": query["InvId"][0], "OutSum": query["OutSum"][0]}
+
+    def signature(self, out_sum: str, invoice_id: str) -> str:
+        return hashlib.md5(f"{out_sum}:{invoice_id}:{self.password_2}".encode("utf-8")).hexdigest()
+
+    def pay(self, payment_url: str) -> Dict:
+        """
+        Уведомление об оплате счета
+        Возвращает {"invoice_id", "status", "body", "started", "finished"} (время - time.time())
+        """
+        invoice = self.invoice(payment_url)
+        data = urllib.parse.urlencode({
+            "InvId": invoice["InvId"],
+            "OutSum": invoice["OutSum"],
+            "SignatureValue": self.signature(invoice["OutSum"], invoice["InvId"]),
+        }).encode("utf-8")
+        result = {"invoice_id": invoice["InvId"], "started": time.time()}
+        try:
+            with urllib.request.urlopen(self.result_url, data=data, timeout=self.timeout) as response:
+                result.update(status=response.status, body=response.read().decode("utf-8"))
+        except urllib.error.HTTPError as e:
+            result.update(status=e.code, body=e.read().decode("utf-8", "replace"))
+        result["finished"] = time.time()
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальные заменители внешних сервисов бота")
+    subparsers = parser.add_subparsers(dest="service", required=True)
+    telegram = subparsers.add_parser("telegram", help="Заменитель Telegram Bot API")
+    telegram.add_argument("--host", default="127.0.0.1")
+    telegram.add_argument("--port", type=int, default=8081)
+    gigachat = subparsers.add_parser("gigachat", help="Заменитель GigaChat API")
+    gigachat.add_argument("--host", default="127.0.0.1")
+    gigachat.add_argument("--port", type=int, default=8082)
+    gigachat.add_argument("--latency", type=float, default=0.05, help="базовая задержка ответа (сек)")
+    gigachat.add_argument("--prefill-per-char", type=float, default=0.00002,
+                          help="задержка на символ запроса вне кэша (сек)")
+    gigachat.add_argument("--error-rate", type=float, default=0.0, help="доля случайных ответов 503")
+    gigachat.add_argument("--slow-rate", type=float, default=0.0, help="доля медленных ответов")
+    gigachat.add_argument("--slow-delay", type=float, default=1.0, help="задержка медленного ответа (сек)")
+    gigachat.add_argument("--tokens-per-second", type=float, default=0.0,
+                          help="скорость генерации ответа (0 - без задержки)")
+    robokassa = subparsers.add_parser("robokassa", help="Оплата счета: уведомление на ResultURL бота")
+    robokassa.add_argument("payment_url", help="ссылка на оплату из сообщения бота")
+    robokassa.add_argument("--result-url", default="http://localhost:9999/robokassa/result")
+    robokassa.add_argument("--password-2", required=True, help="Пароль #2 магазина (ROBOKASSA_PASSWORD_2 бота)")
+    args = parser.parse_args()
+
+    if args.service == "robokassa":
+        result = RobokassaStub(args.result_url, args.password_2).pay(args.payment_url)
+        print(f"Счет {result['invoice_id']}: HTTP {result['status']} {result['body']}")
+        return
+
+    if args.service == "telegram":
+        stub = TelegramStub(args.host, args.port).start()
+        print(f"✓ Заменитель Telegram Bot API запущен: {stub.url}")
+        print(f"✓ Для бота: TELEGRAM_API_BASE_URL={stub.url}")
+    else:
+        stub = GigaChatStub(args.host, args.port, base_latency=args.latency,
+                            prefill_per_char=args.prefill_per_char, error_rate=args.error_rate,
+                            slow_rate=args.slow_rate, slow_delay=args.slow_delay,
+                            tokens_per_second=args.tokens_per_second).start()
+        print(f"✓ Заменитель GigaChat API запущен: {stub.url}")
+        print(f"✓ Для бота: GIGACHAT_AUTH_URL={stub.auth_url} GIGACHAT_CHAT_URL={stub.chat_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stub.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Проверка идемпотентной обработки уведомлений Robokassa (ResultURL) в обоих хранилищах платежей
+
+Сценарии: повторное уведомление, повтор после перезапуска, оплата счета, уже перенесенного
+в архив по истечении срока, неверная сумма и (для JSON) сбой процесса перед записью каждого
+из файлов - платеж при этом должен быть учтен ровно один раз, а повтор уведомления получать OK.
+
+Запуск: python tools/payment_idempotency.py
+Код возврата 1, если хотя бы один сценарий не прошел.
+"""
+
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault("ROBOKASSA_PASSWORD_1", "check-password-1")
+os.environ.setdefault("ROBOKASSA_PASSWORD_2", "check-password-2")
+# Импорт бота создает файлы хранилищ в текущем каталоге - уводим их во временный
+os.chdir(tempfile.mkdtemp(prefix="payment_idempotency_"))
+import telegram_bot  # noqa: E402
+
+AMOUNT = "2999.00"
+
+
+def make_storage(backend: str, name: str) -> telegram_bot.PaymentStorage:
+    if backend == "sqlite":
+        return telegram_bot.SqlitePaymentStorage(f"{name}.db")
+    return telegram_bot.JsonPaymentStorage(
+        f"{name}_payments.json", f"{name}_pending.json", f"{name}_paid.json", f"{name}_expired.jsonl"
+    )
+
+
+def notify(system: telegram_bot.PaymentSystem, invoice_id: int, amount: str = AMOUNT) -> str:
+    signature = hashlib.md5(f"{amount}:{invoice_id}:{telegram_bot.ROBOKASSA_PASSWORD_2}".encode()).hexdigest()
+    status, _ = system.process_robokassa_result(invoice_id, amount, signature)
+    return status
+
+
+def payments_of(system: telegram_bot.PaymentSystem, user_id: str) -> int:
+    return len(system.payments.get(user_id, []))
+
+
+def repeated_notification(backend: str):
+    system = telegram_bot.PaymentSystem(make_storage(backend, "repeat"))
+    _, invoice_id = system.create_payment("1", 2999, 3600, "1 час консультации")
+    statuses = [notify(system, invoice_id), notify(system, invoice_id)]
+    count = payments_of(system, "1")
+    return statuses == ["paid", "duplicate"] and count == 1, f"ответы: {statuses}, платежей: {count}"
+
+
+def after_restart(backend: str):
+    system = telegram_bot.PaymentSystem(make_storage(backend, "restart"))
+    _, invoice_id = system.create_payment("1", 2999, 3600, "1 час консультации")
+    first = notify(system, invoice_id)
+    system.storage.close()
+    restarted = telegram_bot.PaymentSystem(make_storage(backend, "restart"))
+    second = notify(restarted, invoice_id)
+    count = payments_of(restarted, "1")
+    return (first, second, count) == ("paid", "duplicate", 1), f"ответы: {first}, {second}, платежей: {count}"
+
+
+def expired_invoice(backend: str):
+    system = telegram_bot.PaymentSystem(make_storage(backend, "expired"))
+    _, invoice_id = system.create_payment("1", 2999, 3600, "1 час консультации")
+    archived = system.expire_pending_payments(now=time.time() + telegram_bot.PENDING_PAYMENT_TTL + 1)
+    statuses = [notify(system, invoice_id), notify(system, invoice_id)]
+    count = payments_of(system, "1")
+    passed = archived == 1 and statuses == ["paid", "duplicate"] and count == 1
+    return passed, f"в архиве: {archived}, ответы: {statuses}, платежей: {count}"
+
+
+def wrong_amount(backend: str):
+    system = telegram_bot.PaymentSystem(make_storage(backend, "amount"))
+    _, invoice_id = system.create_payment("1", 2999, 3600, "1 час консультации")
+    status = notify(system, invoice_id, "1.00")
+    paid = notify(system, invoice_id)
+    return (status, paid) == ("invalid", "paid"), f"неверная сумма: {status}, затем верная: {paid}"
+
+
+class Crash(BaseException):
+    """Аварийное завершение процесса (в отличие от OSError, хранилище его не обрабатывает)"""
+
+
+def crash_between_writes(backend: str, failing_file: str, expected_retry: str):
+    storage = make_storage(backend, "crash_" + failing_file)
+    system = telegram_bot.PaymentSystem(storage)
+    _, invoice_id = system.create_payment("1", 2999, 3600, "1 час консультации")
+
+    replace = os.replace
+
+    def failing_replace(src, dst):
+        if dst == getattr(storage, failing_file):
+            raise Crash()
+        replace(src, dst)
+
+    os.replace = failing_replace
+    try:
+        notify(system, invoice_id)
+        crashed = False
+    except Crash:
+        crashed = True
+    finally:
+        os.replace = replace
+
+    restarted = telegram_bot.PaymentSystem(make_storage(backend, "crash_" + failing_file))
+    retry = notify(restarted, invoice_id)
+    count = payments_of(restarted, "1")
+    pending = str(invoice_id) in restarted.pending_payments
+    # Платеж учтен ровно один раз, и Robokassa на повтор получает OK (а не ошибку, из-за которой повторяла бы дальше)
+    passed = crashed and count == 1 and retry == expected_retry and not pending
+    return passed, f"сбой: {crashed}, повтор уведомления: {retry}, платежей: {count}, в ожидающих: {pending}"
+
+
+def crash_before_payment(backend: str):
+    # Ничего не записано: повтор уведомления проводит оплату
+    return crash_between_writes(backend, "payments_file", "paid")
+
+
+def crash_before_paid_mark(backend: str):
+    # Платеж с номером счета записан, файл оплаченных - нет: счет оплачен по записи платежа
+    return crash_between_writes(backend, "paid_invoices_file", "duplicate")
+
+
+def crash_before_pending_update(backend: str):
+    # Счет уже отмечен оплаченным, но остался в файле ожидающих: повтор - дубликат
+    return crash_between_writes(backend, "pending_payments_file", "duplicate")
+
+
+SCENARIOS = [
+    ("повторное уведомление", repeated_notification, ("sqlite", "json")),
+    ("повтор после перезапуска", after_restart, ("sqlite", "json")),
+    ("оплата архивного счета", expired_invoice, ("sqlite", "json")),
+    ("неверная сумма", wrong_amount, ("sqlite", "json")),
+    ("сбой до записи платежа", crash_before_payment, ("json",)),
+    ("сбой до отметки об оплате", crash_before_paid_mark, ("json",)),
+    ("сбой до обновления ожидающих", crash_before_pending_update, ("json",)),
+]
+
+
+def main() -> int:
+    failed = 0
+    for name, scenario, backends in SCENARIOS:
+        for backend in backends:
+            passed, details = scenario(backend)
+            failed += not passed
+            print(f"{'✓' if passed else '✗'} {name} ({backend}): {details}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())